@@ -0,0 +1,115 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import numpy as np
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+from cosyvoice.transformer.embedding import EspnetRelPositionalEncoding
+from cosyvoice.transformer.attention import RelPositionMultiHeadedAttention, SdpaRelPositionMultiHeadedAttention
+
+# same names as COSYVOICE_ATTENTION_CLASSES, which imports all models
+ATTENTION_CLASSES = {'rel_selfattn': RelPositionMultiHeadedAttention, 'rel_selfattn_sdpa': SdpaRelPositionMultiHeadedAttention}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='compare matmul and sdpa attention backends of cosyvoice/transformer on cpu')
+    parser.add_argument('--lengths',
+                        type=str,
+                        default='1000,2000,3000',
+                        help='comma separated sequence lengths')
+    parser.add_argument('--attention_heads',
+                        type=int,
+                        default=8,
+                        help='number of heads, same as flow encoder in cosyvoice2.yaml')
+    parser.add_argument('--output_size',
+                        type=int,
+                        default=512,
+                        help='attention dim, same as flow encoder in cosyvoice2.yaml')
+    parser.add_argument('--num_runs',
+                        type=int,
+                        default=5,
+                        help='number of measured runs')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def build(layer_type, args):
+    torch.manual_seed(0)
+    # same random weights for both backends, parameters are interchangeable
+    attn = ATTENTION_CLASSES[layer_type](args.attention_heads, args.output_size, 0.0).eval()
+    pos_enc = EspnetRelPositionalEncoding(args.output_size, 0.0).eval()
+    return attn, pos_enc
+
+
+def run(layer_type, length, args):
+    attn, pos_enc = build(layer_type, args)
+    torch.manual_seed(1)
+    x = torch.randn(1, length, args.output_size)
+    mask = torch.ones(1, length, length, dtype=torch.bool)
+    with torch.inference_mode():
+        x, pos_emb = pos_enc(x)
+        # warmup
+        attn(x, x, x, mask, pos_emb)
+        latency = []
+        for _ in range(args.num_runs):
+            start_time = time.time()
+            output, _ = attn(x, x, x, mask, pos_emb)
+            latency.append(time.time() - start_time)
+    return output, np.mean(latency)
+
+
+def measure_peak_memory(layer_type, length, args, queue):
+    # ru_maxrss never goes down, so every measurement runs in a fresh process
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    run(layer_type, length, args)
+    queue.put((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024)
+
+
+def peak_memory(layer_type, length, args):
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    p = ctx.Process(target=measure_peak_memory, args=(layer_type, length, args, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    for length in [int(i) for i in args.lengths.split(',')]:
+        output, latency = run('rel_selfattn', length, args)
+        sdpa_output, sdpa_latency = run('rel_selfattn_sdpa', length, args)
+        max_diff = (output - sdpa_output).abs().max().item()
+        assert max_diff < 1e-4, 'sdpa output differs from matmul at length {}, max abs diff {:.2e}'.format(length, max_diff)
+        memory, sdpa_memory = peak_memory('rel_selfattn', length, args), peak_memory('rel_selfattn_sdpa', length, args)
+        logging.info('T={} max abs diff {:.2e}, latency {:.1f}ms -> {:.1f}ms, peak memory {:.1f}MB -> {:.1f}MB'.format(
+            length, max_diff, latency * 1000, sdpa_latency * 1000, memory, sdpa_memory))
+
+
+if __name__ == '__main__':
+    main()
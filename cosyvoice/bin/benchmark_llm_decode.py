@@ -0,0 +1,129 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import sys
+import time
+import torch
+from hyperpyyaml import load_hyperpyyaml
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='compare dynamic and static kv cache decoding of TransformerLM (cosyvoice) or Qwen2LM (cosyvoice2), report tokens/sec')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice2-0.5B',
+                        help='local path, cosyvoice.yaml or cosyvoice2.yaml is used')
+    parser.add_argument('--prompt_len',
+                        type=int,
+                        default=150,
+                        help='number of prefilled positions, like sos + text + task_id + prompt speech token')
+    parser.add_argument('--num_steps',
+                        type=int,
+                        default=300,
+                        help='number of single token decode steps')
+    parser.add_argument('--compile',
+                        action='store_true',
+                        default=False,
+                        help='also measure static kv cache with torch.compile, cosyvoice2 only')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def decode_v1(llm, lm_input, tokens, static_kv_cache):
+    # same steps as TransformerLM.inference
+    if static_kv_cache:
+        cache = llm.llm.init_static_cache(lm_input.shape[1] + len(tokens), lm_input.dtype, lm_input.device)
+
+        def step(xs, offset, cache):
+            return llm.llm.forward_static_step(xs, cache)
+    else:
+        cache = torch.zeros((0, 0, 0, 0), device=lm_input.device)
+
+        def step(xs, offset, cache):
+            y_pred, cache, _ = llm.llm.forward_chunk(xs, offset=offset, required_cache_size=-1, att_cache=cache,
+                                                     cnn_cache=torch.zeros((0, 0, 0, 0), device=xs.device),
+                                                     att_mask=torch.tril(torch.ones((1, xs.shape[1], cache.size(2) + xs.shape[1]),
+                                                                                    device=xs.device), diagonal=cache.size(2)).to(torch.bool))
+            return y_pred, cache
+    logp = []
+    y_pred, cache = step(lm_input, 0, cache)
+    logp.append(llm.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1))
+    start_time = time.time()
+    for i, token in enumerate(tokens):
+        y_pred, cache = step(llm.speech_embedding.weight[token].reshape(1, 1, -1), lm_input.shape[1] + i, cache)
+        logp.append(llm.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1))
+    return torch.concat(logp, dim=0), len(tokens) / (time.time() - start_time)
+
+
+def decode(llm, lm_input, tokens, static_kv_cache):
+    # same steps as Qwen2LM.inference_wrapper, tokens are fixed so that every mode sees the same inputs
+    cache = llm.llm.init_static_cache(lm_input.shape[1] + len(tokens), lm_input.dtype, lm_input.device) if static_kv_cache else None
+    logp = []
+    y_pred, cache = llm.decode_one_step(lm_input, cache)
+    logp.append(llm.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1))
+    start_time = time.time()
+    for token in tokens:
+        y_pred, cache = llm.decode_one_step(llm.speech_embedding.weight[token].reshape(1, 1, -1), cache)
+        logp.append(llm.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1))
+    return torch.concat(logp, dim=0), len(tokens) / (time.time() - start_time)
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    if os.path.exists('{}/cosyvoice2.yaml'.format(args.model_dir)):
+        with open('{}/cosyvoice2.yaml'.format(args.model_dir), 'r') as f:
+            configs = load_hyperpyyaml(f, overrides={'qwen_pretrain_path': os.path.join(args.model_dir, 'CosyVoice-BlankEN')})
+        decode_fn = decode
+    else:
+        with open('{}/cosyvoice.yaml'.format(args.model_dir), 'r') as f:
+            configs = load_hyperpyyaml(f)
+        decode_fn = decode_v1
+    llm = configs['llm']
+    llm.load_state_dict(torch.load('{}/llm.pt'.format(args.model_dir), map_location='cpu'), strict=True)
+    llm.eval()
+    torch.manual_seed(0)
+    lm_input = torch.concat([llm.llm_embedding.weight[llm.sos_eos].reshape(1, 1, -1),
+                             llm.speech_embedding(torch.randint(0, llm.speech_token_size, (1, args.prompt_len - 1)))], dim=1)
+    tokens = torch.randint(0, llm.speech_token_size, (args.num_steps,)).tolist()
+    with torch.inference_mode():
+        # warmup
+        decode_fn(llm, lm_input, tokens[:10], False)
+        decode_fn(llm, lm_input, tokens[:10], True)
+        ref_logp, ref_speed = decode_fn(llm, lm_input, tokens, False)
+        logging.info('dynamic kv cache {:.1f} tokens/sec'.format(ref_speed))
+        logp, speed = decode_fn(llm, lm_input, tokens, True)
+        max_diff = (logp - ref_logp).abs().max().item()
+        assert max_diff < 1e-3, 'static kv cache differs from dynamic kv cache, max abs diff {:.2e}'.format(max_diff)
+        logging.info('static kv cache {:.1f} tokens/sec, max abs logp diff {:.2e}'.format(speed, max_diff))
+        if args.compile and decode_fn is decode:
+            llm.llm.compile_static_step()
+            decode(llm, lm_input, tokens[:10], True)
+            logp, speed = decode(llm, lm_input, tokens, True)
+            max_diff = (logp - ref_logp).abs().max().item()
+            assert max_diff < 1e-3, 'compiled static kv cache differs from dynamic kv cache, max abs diff {:.2e}'.format(max_diff)
+            logging.info('compiled static kv cache {:.1f} tokens/sec, max abs logp diff {:.2e}'.format(speed, max_diff))
+
+
+if __name__ == '__main__':
+    main()
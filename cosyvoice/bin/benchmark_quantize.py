@@ -0,0 +1,123 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import gc
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import time
+import numpy as np
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import CosyVoice, CosyVoice2
+from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.utils.file_utils import load_wav
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='compare int8 quantized or bf16 autocast cpu inference against fp32, report token agreement, mel l1 and rtf')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice2-0.5B',
+                        help='local path')
+    parser.add_argument('--quantize',
+                        type=str,
+                        default='int8',
+                        help='quantize option of CosyVoice/CosyVoice2')
+    parser.add_argument('--dtype',
+                        type=str,
+                        default=None,
+                        help='dtype option of CosyVoice/CosyVoice2, e.g. bf16, measured instead of --quantize if set')
+    parser.add_argument('--prompt_wav',
+                        type=str,
+                        required=True,
+                        help='prompt wav for zero shot inference')
+    parser.add_argument('--prompt_text',
+                        type=str,
+                        default='希望你以后能够做的比我还好呦。',
+                        help='transcription of prompt wav')
+    parser.add_argument('--tts_text',
+                        type=str,
+                        default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。',
+                        help='text to synthesize')
+    parser.add_argument('--num_runs',
+                        type=int,
+                        default=3,
+                        help='number of measured runs')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def speech_token(cosyvoice, model_input):
+    # same call as CosyVoiceModel.llm_job, with a fixed seed
+    set_all_random_seed(0)
+    return list(cosyvoice.model.llm.inference(text=model_input['text'],
+                                              text_len=torch.tensor([model_input['text'].shape[1]], dtype=torch.int32),
+                                              prompt_text=model_input['prompt_text'],
+                                              prompt_text_len=torch.tensor([model_input['prompt_text'].shape[1]], dtype=torch.int32),
+                                              prompt_speech_token=model_input['llm_prompt_speech_token'],
+                                              prompt_speech_token_len=torch.tensor([model_input['llm_prompt_speech_token'].shape[1]], dtype=torch.int32),
+                                              embedding=model_input['llm_embedding']))
+
+
+def evaluate(cosyvoice, args, prompt_speech_16k):
+    model_input = cosyvoice.frontend.frontend_zero_shot(args.tts_text, args.prompt_text, prompt_speech_16k, cosyvoice.sample_rate, '')
+    token = speech_token(cosyvoice, model_input)
+    rtf = []
+    for i in range(args.num_runs + 1):
+        # same seed for every run so that fp32 and quantized/bf16 models decode from the same random draws
+        set_all_random_seed(0)
+        start_time = time.time()
+        speech = torch.concat([j['tts_speech'] for j in cosyvoice.inference_zero_shot(args.tts_text, args.prompt_text, prompt_speech_16k)], dim=1)
+        # first run is warmup
+        if i != 0:
+            rtf.append((time.time() - start_time) / (speech.shape[1] / cosyvoice.sample_rate))
+    return token, speech, np.mean(rtf)
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    model_cls = CosyVoice2 if os.path.exists('{}/cosyvoice2.yaml'.format(args.model_dir)) else CosyVoice
+    prompt_speech_16k = load_wav(args.prompt_wav, 16000)
+    option = {'dtype': args.dtype} if args.dtype is not None else {'quantize': args.quantize}
+    results = []
+    for kwargs in [{}, option]:
+        cosyvoice = model_cls(args.model_dir, **kwargs)
+        results.append(evaluate(cosyvoice, args, prompt_speech_16k))
+        feat_extractor = cosyvoice.frontend.feat_extractor
+        # load one model at a time
+        del cosyvoice
+        gc.collect()
+    (ref_token, ref_speech, ref_rtf), (token, speech, rtf) = results
+    length = min(len(token), len(ref_token))
+    agreement = np.mean([token[i] == ref_token[i] for i in range(length)]) if length != 0 else 0.0
+    feat, ref_feat = feat_extractor(speech), feat_extractor(ref_speech)
+    length = min(feat.shape[2], ref_feat.shape[2])
+    mel_l1 = (feat[:, :, :length] - ref_feat[:, :, :length]).abs().mean().item()
+    logging.info('fp32 vs {}'.format(option))
+    logging.info('speech token length {} -> {}, token agreement {:.3f}'.format(len(ref_token), len(token), agreement))
+    logging.info('mel l1 {:.4f}, rtf {:.3f} -> {:.3f}'.format(mel_l1, ref_rtf, rtf))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import sys
+import time
+import numpy as np
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+from cosyvoice.utils.common import ras_sampling, top_k_top_p_filter, push_recent_tokens
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='check tensorized nucleus/ras sampling against the python loop version and time both on cpu')
+    parser.add_argument('--vocab_size',
+                        type=int,
+                        default=6564,
+                        help='speech token size + 3, same as llm decoder of cosyvoice2')
+    parser.add_argument('--batch_sizes',
+                        type=str,
+                        default='1,4,16',
+                        help='comma separated batch sizes')
+    parser.add_argument('--top_p',
+                        type=float,
+                        default=0.8)
+    parser.add_argument('--top_k',
+                        type=int,
+                        default=25)
+    parser.add_argument('--win_size',
+                        type=int,
+                        default=10)
+    parser.add_argument('--tau_r',
+                        type=float,
+                        default=0.1)
+    parser.add_argument('--num_draws',
+                        type=int,
+                        default=20000,
+                        help='number of draws of the frequency check')
+    parser.add_argument('--num_runs',
+                        type=int,
+                        default=200,
+                        help='number of measured runs')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def loop_nucleus_candidates(weighted_scores, top_p, top_k):
+    # candidates of the python loop nucleus_sampling before vectorization
+    prob, indices = [], []
+    cum_prob = 0.0
+    sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
+    for i in range(len(sorted_idx)):
+        # sampling both top-p and numbers.
+        if cum_prob < top_p and len(prob) < top_k:
+            cum_prob += sorted_value[i]
+            prob.append(sorted_value[i])
+            indices.append(sorted_idx[i])
+        else:
+            break
+    return torch.tensor(prob), torch.tensor(indices, dtype=torch.long)
+
+
+def loop_ras_sampling(weighted_scores, decoded_tokens, top_p, top_k, win_size, tau_r):
+    prob, indices = loop_nucleus_candidates(weighted_scores, top_p, top_k)
+    top_ids = indices[prob.multinomial(1, replacement=True)]
+    rep_num = (torch.tensor(decoded_tokens[-win_size:]).to(weighted_scores.device) == top_ids).sum().item()
+    if rep_num >= win_size * tau_r:
+        top_ids = weighted_scores.softmax(dim=0).multinomial(1, replacement=True)
+    return top_ids
+
+
+def random_scores(batch_size, args):
+    # peaky distribution like llm decoder output, so that top_p cuts before top_k for some rows
+    return (torch.randn(batch_size, args.vocab_size) * torch.rand(batch_size, 1) * 8).log_softmax(dim=-1)
+
+
+def check_candidates(args):
+    torch.manual_seed(0)
+    scores = random_scores(64, args)
+    prob, indices = top_k_top_p_filter(scores, top_p=args.top_p, top_k=args.top_k)
+    for i in range(scores.shape[0]):
+        ref_prob, ref_indices = loop_nucleus_candidates(scores[i], args.top_p, args.top_k)
+        n = ref_prob.shape[0]
+        assert torch.equal(indices[i, :n], ref_indices), 'candidate ids differ at row {}'.format(i)
+        assert torch.allclose(prob[i, :n], ref_prob), 'candidate probs differ at row {}'.format(i)
+        assert (prob[i, n:] == 0).all(), 'row {} keeps more candidates than loop version'.format(i)
+    logging.info('nucleus candidates of {} rows match loop version'.format(scores.shape[0]))
+
+
+def check_frequency(args):
+    torch.manual_seed(0)
+    scores = random_scores(1, args)
+    # every history token is a top candidate, so ras falls back to random sampling now and then
+    prob, indices = top_k_top_p_filter(scores, top_p=args.top_p, top_k=args.top_k)
+    decoded_tokens = indices[0, :2].tolist() * (args.win_size // 2)
+    recent_tokens = torch.tensor(decoded_tokens[-args.win_size:]).unsqueeze(dim=0).repeat(args.num_draws, 1)
+    torch.manual_seed(1)
+    ref = torch.concat([loop_ras_sampling(scores[0], decoded_tokens, args.top_p, args.top_k, args.win_size, args.tau_r)
+                        for _ in range(args.num_draws)])
+    torch.manual_seed(1)
+    new = ras_sampling(scores.repeat(args.num_draws, 1), recent_tokens, None,
+                       top_p=args.top_p, top_k=args.top_k, win_size=args.win_size, tau_r=args.tau_r)
+    ref_freq = torch.bincount(ref, minlength=args.vocab_size).float() / args.num_draws
+    new_freq = torch.bincount(new, minlength=args.vocab_size).float() / args.num_draws
+    tv_distance = (ref_freq - new_freq).abs().sum().item() / 2
+    assert tv_distance < 0.05, 'ras sampling frequency differs from loop version, total variation {:.4f}'.format(tv_distance)
+    logging.info('ras sampling frequency of {} draws matches loop version, total variation {:.4f}'.format(args.num_draws, tv_distance))
+
+
+def timeit(fn, num_runs):
+    fn()
+    latency = []
+    for _ in range(num_runs):
+        start_time = time.time()
+        fn()
+        latency.append(time.time() - start_time)
+    return np.mean(latency)
+
+
+def benchmark(batch_size, args):
+    torch.manual_seed(0)
+    scores = random_scores(batch_size, args)
+    decoded_tokens = torch.randint(0, args.vocab_size, (batch_size, args.win_size))
+    recent_tokens = decoded_tokens.clone()
+    lists = decoded_tokens.tolist()
+
+    def loop():
+        # one python loop sampling call per row, as LLMScheduler did before
+        for i in range(batch_size):
+            loop_ras_sampling(scores[i], lists[i], args.top_p, args.top_k, args.win_size, args.tau_r)
+
+    def batched():
+        top_ids = ras_sampling(scores, recent_tokens, None, top_p=args.top_p, top_k=args.top_k, win_size=args.win_size, tau_r=args.tau_r)
+        push_recent_tokens(recent_tokens, top_ids, top_ids < args.vocab_size - 3)
+
+    with torch.inference_mode():
+        return timeit(loop, args.num_runs), timeit(batched, args.num_runs)
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    check_candidates(args)
+    check_frequency(args)
+    for batch_size in [int(i) for i in args.batch_sizes.split(',')]:
+        latency, batched_latency = benchmark(batch_size, args)
+        logging.info('B={} latency per step {:.3f}ms -> {:.3f}ms'.format(batch_size, latency * 1000, batched_latency * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import time
+import numpy as np
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import CosyVoice2
+from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.utils.file_utils import load_wav
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='compare speculative llm decoding of CosyVoice2 with plain decoding, '
+                                                 'report tokens/sec, draft acceptance and tokens per forward')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice2-0.5B',
+                        help='local path')
+    parser.add_argument('--prompt_wav',
+                        type=str,
+                        required=True,
+                        help='prompt wav for zero shot inference')
+    parser.add_argument('--prompt_text',
+                        type=str,
+                        default='希望你以后能够做的比我还好呦。',
+                        help='transcription of prompt wav')
+    parser.add_argument('--tts_text',
+                        type=str,
+                        default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。',
+                        help='text to synthesize')
+    parser.add_argument('--num_draft',
+                        type=int,
+                        nargs='+',
+                        default=[2, 4, 8],
+                        help='num_draft values to compare with plain decoding, i.e. num_draft 0')
+    parser.add_argument('--num_runs',
+                        type=int,
+                        default=5,
+                        help='number of measured runs of every num_draft')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def decode(cosyvoice, model_input, num_draft):
+    # same inputs as CosyVoiceModel.llm_job, only the llm is run
+    llm, device = cosyvoice.model.llm, cosyvoice.model.device
+    start_time = time.time()
+    tokens = list(llm.inference(text=model_input['text'].to(device),
+                                text_len=torch.tensor([model_input['text'].shape[1]], dtype=torch.int32).to(device),
+                                prompt_text=model_input['prompt_text'].to(device),
+                                prompt_text_len=torch.tensor([model_input['prompt_text'].shape[1]], dtype=torch.int32).to(device),
+                                prompt_speech_token=model_input['llm_prompt_speech_token'].to(device),
+                                prompt_speech_token_len=torch.tensor([model_input['llm_prompt_speech_token'].shape[1]], dtype=torch.int32).to(device),
+                                embedding=model_input['llm_embedding'].to(device),
+                                num_draft=num_draft))
+    return len(tokens), time.time() - start_time
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    cosyvoice = CosyVoice2(args.model_dir)
+    prompt_speech_16k = load_wav(args.prompt_wav, 16000)
+    prompt_text = cosyvoice.frontend.text_normalize(args.prompt_text, split=False)
+    tts_text = cosyvoice.frontend.text_normalize(args.tts_text, split=False)
+    model_input = cosyvoice.frontend.frontend_zero_shot(tts_text, prompt_text, prompt_speech_16k, cosyvoice.sample_rate, '')
+    # warmup
+    decode(cosyvoice, model_input, 0)
+    for num_draft in [0] + args.num_draft:
+        set_all_random_seed(0)
+        before = cosyvoice.speculative_stats()
+        num_tokens, elapsed = [], []
+        for _ in range(args.num_runs):
+            i, j = decode(cosyvoice, model_input, num_draft)
+            num_tokens.append(i)
+            elapsed.append(j)
+        speed = np.sum(num_tokens) / np.sum(elapsed)
+        if num_draft == 0:
+            logging.info('plain decoding {:.1f} tokens/sec, {:.1f} tokens per run'.format(speed, np.mean(num_tokens)))
+            continue
+        after = cosyvoice.speculative_stats()
+        forwards, drafted, accepted, tokens = [after[k] - before[k] for k in ['forwards', 'drafted', 'accepted', 'tokens']]
+        logging.info('num_draft {} {:.1f} tokens/sec, acceptance {:.2f} ({}/{}), {:.2f} tokens per forward, {:.1f} tokens per run'.format(
+            num_draft, speed, accepted / max(drafted, 1), accepted, drafted, tokens / max(forwards, 1), np.mean(num_tokens)))
+
+
+if __name__ == '__main__':
+    main()
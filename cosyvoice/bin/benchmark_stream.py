@@ -0,0 +1,275 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import threading
+import time
+import numpy as np
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.model import TTSSession
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='benchmark first chunk latency of streaming inference')
+    parser.add_argument('--mode',
+                        default='wakeup',
+                        choices=['wakeup', 'model', 'encoder', 'decoder', 'hift'],
+                        help='wakeup compares polling with TTSSession without model, model measures a real CosyVoice2 model, '
+                             'encoder checks chunked flow encoder against full recompute, '
+                             'decoder checks chunked flow decoder estimator against forward with streaming=True, '
+                             'hift checks streaming HiFTGenerator.inference_chunk against inference')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice2-0.5B',
+                        help='local path')
+    parser.add_argument('--stream_hift',
+                        action='store_true',
+                        help='vocode streaming chunks with HiFTGenerator.inference_chunk in model mode')
+    parser.add_argument('--prompt_wav',
+                        type=str,
+                        required=False,
+                        help='prompt wav for zero shot inference, required in model mode')
+    parser.add_argument('--prompt_text',
+                        type=str,
+                        default='希望你以后能够做的比我还好呦。',
+                        help='transcription of prompt wav')
+    parser.add_argument('--tts_text',
+                        type=str,
+                        default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。',
+                        help='text to synthesize')
+    parser.add_argument('--token_interval',
+                        type=float,
+                        default=0.02,
+                        help='simulated llm decode time per token in wakeup mode')
+    parser.add_argument('--chunk_token_len',
+                        type=int,
+                        default=28,
+                        help='token_hop_len + pre_lookahead_len in wakeup mode')
+    parser.add_argument('--num_chunks',
+                        type=int,
+                        default=20,
+                        help='number of streaming chunks in encoder, decoder and hift mode')
+    parser.add_argument('--n_timesteps',
+                        type=int,
+                        default=10,
+                        help='ode steps in decoder mode')
+    parser.add_argument('--max_chunk_frames',
+                        type=int,
+                        default=60,
+                        help='mel frames of each chunk are drawn from [1, max_chunk_frames] in hift mode')
+    parser.add_argument('--prompt_token_len',
+                        type=int,
+                        default=87,
+                        help='prompt speech token length in encoder mode')
+    parser.add_argument('--num_runs',
+                        type=int,
+                        default=10,
+                        help='number of measured runs')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def fake_llm_job(session, token_interval, num_token):
+    for i in range(num_token):
+        time.sleep(token_interval)
+        session.append(i)
+    session.end()
+
+
+def wait_polling(session, num_token):
+    # the loop used before TTSSession, kept here as the baseline
+    while True:
+        time.sleep(0.1)
+        if session.token_len >= num_token:
+            return True
+        if session.llm_end is True:
+            return False
+
+
+def wait_event(session, num_token):
+    return session.wait(num_token)
+
+
+def benchmark_wakeup(args):
+    for name, wait_fn in [('polling', wait_polling), ('event', wait_event)]:
+        latency = []
+        for _ in range(args.num_runs):
+            session = TTSSession()
+            p = threading.Thread(target=fake_llm_job, args=(session, args.token_interval, args.chunk_token_len))
+            start_time = time.time()
+            p.start()
+            assert wait_fn(session, args.chunk_token_len) is True
+            latency.append(time.time() - start_time)
+            p.join()
+        ideal = args.token_interval * args.chunk_token_len
+        logging.info('{} first chunk wait {:.1f}ms mean, {:.1f}ms max, overhead {:.1f}ms over {:.1f}ms decode time'.format(
+            name, np.mean(latency) * 1000, np.max(latency) * 1000, (np.mean(latency) - ideal) * 1000, ideal * 1000))
+
+
+def benchmark_model(args):
+    from cosyvoice.cli.cosyvoice import CosyVoice2
+    from cosyvoice.utils.file_utils import load_wav
+    cosyvoice = CosyVoice2(args.model_dir, stream_hift=args.stream_hift)
+    prompt_speech_16k = load_wav(args.prompt_wav, 16000)
+    latency = []
+    # first run is warmup
+    for i in range(args.num_runs + 1):
+        start_time, first_chunk_time = time.time(), None
+        # consume the whole generator so that the next run does not share compute with this one
+        for _ in cosyvoice.inference_zero_shot(args.tts_text, args.prompt_text, prompt_speech_16k, stream=True):
+            if first_chunk_time is None:
+                first_chunk_time = time.time()
+        if i != 0:
+            latency.append(first_chunk_time - start_time)
+    logging.info('first chunk latency {:.1f}ms mean, {:.1f}ms max'.format(np.mean(latency) * 1000, np.max(latency) * 1000))
+
+
+def benchmark_encoder(args):
+    import torch
+    from cosyvoice.transformer.upsample_encoder import UpsampleConformerEncoder
+    torch.manual_seed(0)
+    # same as flow encoder in cosyvoice2.yaml, random weights are enough to check equivalence
+    encoder = UpsampleConformerEncoder(input_size=512, output_size=512, attention_heads=8, linear_units=2048, num_blocks=6,
+                                       input_layer='linear', pos_enc_layer_type='rel_pos_espnet', selfattention_layer_type='rel_selfattn',
+                                       use_cnn_module=False, macaron_style=False, static_chunk_size=25).eval()
+    chunk_size, pre_lookahead_len = encoder.static_chunk_size, encoder.pre_lookahead_layer.pre_lookahead_len
+    prompt_token_pad = int(np.ceil(args.prompt_token_len / chunk_size) * chunk_size - args.prompt_token_len)
+    token = torch.randn(1, args.prompt_token_len + prompt_token_pad + chunk_size * args.num_chunks + pre_lookahead_len, 512)
+    full_time, chunk_time, max_diff, cache = [], [], 0, {}
+    with torch.inference_mode():
+        for i in range(args.num_chunks):
+            end = args.prompt_token_len + prompt_token_pad + chunk_size * (i + 1)
+            xs, context = token[:, :end], token[:, end:end + pre_lookahead_len]
+            start_time = time.time()
+            h_full, _ = encoder(xs, torch.tensor([end]), context=context, streaming=True)
+            full_time.append(time.time() - start_time)
+            start_time = time.time()
+            h_chunk, cache = encoder.forward_chunk(xs[:, cache.get('offset', 0):], context, cache)
+            chunk_time.append(time.time() - start_time)
+            max_diff = max(max_diff, (h_full[:, -h_chunk.shape[1]:] - h_chunk).abs().max().item())
+    logging.info('max abs diff between chunked and full encoder output {:.2e}'.format(max_diff))
+    assert max_diff < 1e-4, 'chunked encoder output differs from full recompute'
+    logging.info('full recompute {:.1f}ms first chunk, {:.1f}ms last chunk, {:.1f}ms total'.format(
+        full_time[0] * 1000, full_time[-1] * 1000, np.sum(full_time) * 1000))
+    logging.info('chunked {:.1f}ms first chunk, {:.1f}ms last chunk, {:.1f}ms total'.format(
+        chunk_time[0] * 1000, chunk_time[-1] * 1000, np.sum(chunk_time) * 1000))
+
+
+def benchmark_decoder(args):
+    import torch
+    from omegaconf import DictConfig
+    from cosyvoice.flow.decoder import CausalConditionalDecoder
+    from cosyvoice.flow.flow_matching import CausalConditionalCFM
+    torch.manual_seed(0)
+    rng = np.random.RandomState(0)
+    # same as flow decoder in cosyvoice2.yaml, random weights are enough to check equivalence
+    estimator = CausalConditionalDecoder(in_channels=320, out_channels=80, channels=[256], dropout=0.0, attention_head_dim=64, n_blocks=4,
+                                         num_mid_blocks=12, num_heads=8, act_fn='gelu', static_chunk_size=50, num_decoding_left_chunks=-1)
+    cfm_params = DictConfig({'sigma_min': 1e-06, 'solver': 'euler', 't_scheduler': 'cosine', 'training_cfg_rate': 0.2,
+                             'inference_cfg_rate': 0.7, 'reg_loss_type': 'l1'})
+    decoder = CausalConditionalCFM(in_channels=240, cfm_params=cfm_params, n_spks=1, spk_emb_dim=80, estimator=estimator).eval()
+    chunk_size = estimator.static_chunk_size
+    # every chunk but the last ends on a static_chunk_size boundary, as in CosyVoice2Model.token2wav
+    chunk_frames = [chunk_size * rng.randint(1, 3) for _ in range(args.num_chunks - 1)] + [rng.randint(1, 2 * chunk_size + 1)]
+    mel_len = int(np.sum(chunk_frames))
+    mu, cond, spks = torch.randn(1, 80, mel_len), torch.randn(1, 80, mel_len), torch.randn(1, 80)
+    mask = torch.ones(1, 1, mel_len)
+    # cfg_rate 0 only runs the conditional half of the batch, cfg_interval switches between both within one request,
+    # heun calls the estimator twice per step and keeps one chunk cache per call
+    for flow_options in [{'solver': 'euler', 'cfg_rate': 0.7}, {'solver': 'euler', 'cfg_rate': 0.0},
+                         {'solver': 'heun', 'cfg_rate': 0.7}, {'solver': 'heun', 'cfg_rate': 0.0},
+                         {'solver': 'heun', 'cfg_rate': 0.7, 'cfg_interval': (0.0, 0.5)}]:
+        start_time = time.time()
+        mel_full, _ = decoder(mu, mask, args.n_timesteps, spks=spks, cond=cond, streaming=True, **flow_options)
+        full_time = time.time() - start_time
+        mel_chunk, chunk_time, cache, offset = [], [], [], 0
+        for i in chunk_frames:
+            start_time = time.time()
+            this_mel, cache = decoder(mu[:, :, offset:offset + i], mask[:, :, offset:offset + i], args.n_timesteps, spks=spks,
+                                      cond=cond[:, :, offset:offset + i], streaming=True, cache=cache, **flow_options)
+            chunk_time.append(time.time() - start_time)
+            mel_chunk.append(this_mel)
+            offset += i
+        mel_chunk = torch.concat(mel_chunk, dim=2)
+        max_diff = (mel_full - mel_chunk).abs().max().item()
+        logging.info('{} max abs diff between chunked and full decoder output {:.2e}, {} estimator caches'.format(
+            flow_options, max_diff, len(cache)))
+        assert max_diff < 1e-3, 'chunked decoder output differs from forward with streaming=True, {}'.format(flow_options)
+        logging.info('{} full forward {:.1f}ms, chunked {:.1f}ms total, {:.1f}ms last chunk'.format(
+            flow_options, full_time * 1000, np.sum(chunk_time) * 1000, chunk_time[-1] * 1000))
+
+
+def benchmark_hift(args):
+    from unittest import mock
+    import torch
+    from cosyvoice.hifigan.f0_predictor import ConvRNNF0Predictor
+    from cosyvoice.hifigan.generator import HiFTGenerator
+    torch.manual_seed(0)
+    rng = np.random.RandomState(0)
+    # same as hift in cosyvoice2.yaml, random weights are enough to check equivalence
+    hift = HiFTGenerator(sampling_rate=24000, upsample_rates=[8, 5, 3], upsample_kernel_sizes=[16, 11, 7],
+                         source_resblock_kernel_sizes=[7, 7, 11], source_resblock_dilation_sizes=[[1, 3, 5], [1, 3, 5], [1, 3, 5]],
+                         f0_predictor=ConvRNNF0Predictor(num_class=1, in_channels=80, cond_channels=512))
+    hift.remove_weight_norm()
+    hift.eval()
+    chunk_frames = rng.randint(1, args.max_chunk_frames + 1, size=args.num_chunks)
+    speech_feat = torch.randn(1, 80, int(np.sum(chunk_frames)))
+    # the additive noise of the source module is drawn per call, zero it so that both paths are deterministic
+    with mock.patch.object(torch, 'randn_like', torch.zeros_like):
+        start_time = time.time()
+        speech_full, _ = hift.inference(speech_feat=speech_feat)
+        full_time = time.time() - start_time
+        speech_chunk, chunk_time, cache, offset = [], [], {}, 0
+        for i, j in enumerate(chunk_frames):
+            start_time = time.time()
+            speech_chunk.append(hift.inference_chunk(speech_feat=speech_feat[:, :, offset:offset + j], cache=cache,
+                                                     finalize=i == len(chunk_frames) - 1))
+            chunk_time.append(time.time() - start_time)
+            offset += j
+    speech_chunk = torch.concat(speech_chunk, dim=1)
+    assert speech_chunk.shape == speech_full.shape, 'chunked hift output length {} differs from {}'.format(speech_chunk.shape, speech_full.shape)
+    max_diff = (speech_full - speech_chunk).abs().max().item()
+    logging.info('max abs diff between chunked and full hift output {:.2e} over chunks of {} mel frames'.format(max_diff, chunk_frames.tolist()))
+    assert max_diff < 1e-4, 'chunked hift output differs from full inference'
+    logging.info('full inference {:.1f}ms, chunked {:.1f}ms total, {:.1f}ms max per chunk'.format(
+        full_time * 1000, np.sum(chunk_time) * 1000, np.max(chunk_time) * 1000))
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    if args.mode == 'wakeup':
+        benchmark_wakeup(args)
+    elif args.mode == 'encoder':
+        benchmark_encoder(args)
+    elif args.mode == 'decoder':
+        benchmark_decoder(args)
+    elif args.mode == 'hift':
+        benchmark_hift(args)
+    else:
+        benchmark_model(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import time
+import random
+import numpy as np
+import torch
+from tqdm import tqdm
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import CosyVoice, CosyVoice2
+from cosyvoice.utils.common import OrtSessionWrapper
+from cosyvoice.utils.file_utils import logging
+
+
+class HiFTDecodeSpec(torch.nn.Module):
+    """Convolution part of HiFTGenerator.decode, stft of the source and istft are done outside the onnx graph."""
+    def __init__(self, hift):
+        super().__init__()
+        self.hift = hift
+
+    def forward(self, x, s_stft):
+        return self.hift.decode_spec(x, s_stft)
+
+
+def get_dummy_input(hift, batch_size, seq_len, device):
+    speech_feat = torch.rand((batch_size, 80, seq_len), dtype=torch.float32, device=device)
+    # same steps as HiFTGenerator.inference, so that s_stft has the length decode_spec expects
+    f0 = hift.f0_predictor(speech_feat)
+    s, _, _ = hift.m_source(hift.f0_upsamp(f0[:, None]).transpose(1, 2))
+    s_stft_real, s_stft_imag = hift._stft(s.transpose(1, 2).squeeze(1))
+    return speech_feat, torch.cat([s_stft_real, s_stft_imag], dim=1)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='export hift f0 predictor and decoder to onnx for onnxruntime inference')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice2-0.5B',
+                        help='local path')
+    parser.add_argument('--num_runs',
+                        type=int,
+                        default=5,
+                        help='number of measured runs of the rtf comparison')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def timeit(hift, speech_feat, num_runs):
+    hift.inference(speech_feat=speech_feat)
+    rtf = []
+    for _ in range(num_runs):
+        start_time = time.time()
+        speech, _ = hift.inference(speech_feat=speech_feat)
+        rtf.append((time.time() - start_time) / (speech.shape[1] / hift.sampling_rate))
+    return np.mean(rtf)
+
+
+@torch.no_grad()
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    try:
+        model = CosyVoice(args.model_dir)
+    except Exception:
+        try:
+            model = CosyVoice2(args.model_dir)
+        except Exception:
+            raise TypeError('no valid model_type!')
+
+    # weight norm is already folded by CosyVoiceModel.load
+    hift = model.model.hift
+    hift.eval()
+    device = model.model.device
+
+    # 1. export f0 predictor and decoder
+    speech_feat, s_stft = get_dummy_input(hift, 1, 256, device)
+    torch.onnx.export(
+        hift.f0_predictor,
+        (speech_feat,),
+        '{}/hift.f0_predictor.fp32.onnx'.format(args.model_dir),
+        export_params=True,
+        opset_version=18,
+        do_constant_folding=True,
+        input_names=['speech_feat'],
+        output_names=['f0'],
+        dynamic_axes={
+            'speech_feat': {0: 'batch_size', 2: 'seq_len'},
+            'f0': {0: 'batch_size', 1: 'seq_len'},
+        }
+    )
+    torch.onnx.export(
+        HiFTDecodeSpec(hift),
+        (speech_feat, s_stft),
+        '{}/hift.decode.fp32.onnx'.format(args.model_dir),
+        export_params=True,
+        opset_version=18,
+        do_constant_folding=True,
+        input_names=['x', 's_stft'],
+        output_names=['spec'],
+        dynamic_axes={
+            'x': {0: 'batch_size', 2: 'seq_len'},
+            's_stft': {0: 'batch_size', 2: 'stft_len'},
+            'spec': {0: 'batch_size', 2: 'stft_len'},
+        }
+    )
+
+    # 2. test computation consistency
+    hift_f0_predictor = OrtSessionWrapper('{}/hift.f0_predictor.fp32.onnx'.format(args.model_dir), device=device)
+    hift_decode_spec = OrtSessionWrapper('{}/hift.decode.fp32.onnx'.format(args.model_dir), device=device)
+    for _ in tqdm(range(10)):
+        speech_feat, s_stft = get_dummy_input(hift, random.randint(1, 4), random.randint(16, 512), device)
+        f0 = hift_f0_predictor.run({'speech_feat': speech_feat}, 'f0', (speech_feat.size(0), speech_feat.size(2)))
+        torch.testing.assert_close(f0, hift.f0_predictor(speech_feat), rtol=1e-2, atol=1e-4)
+        spec = hift_decode_spec.run({'x': speech_feat, 's_stft': s_stft}, 'spec', s_stft.shape)
+        torch.testing.assert_close(spec, hift.decode_spec(speech_feat, s_stft), rtol=1e-2, atol=1e-4)
+    logging.info('successfully export hift')
+
+    # 3. compare rtf of the whole vocoder, stft/istft and the source module run in pytorch in both cases
+    speech_feat = torch.rand((1, 80, 500), dtype=torch.float32, device=device)
+    rtf = timeit(hift, speech_feat, args.num_runs)
+    hift.ort_f0_predictor, hift.ort_decode_spec = hift_f0_predictor, hift_decode_spec
+    ort_rtf = timeit(hift, speech_feat, args.num_runs)
+    logging.info('hift rtf {:.4f} -> {:.4f} with onnxruntime'.format(rtf, ort_rtf))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import time
+import numpy as np
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import CosyVoice2
+from cosyvoice.flow.flow_matching import SOLVERS
+from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.utils.file_utils import load_wav
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='sweep flow decoder solver, step count or cfg schedule, report rtf and mel distance to the default')
+    parser.add_argument('--mode',
+                        default='solver',
+                        choices=['solver', 'cfg'],
+                        help='solver sweeps solvers and step counts against euler 10 steps, '
+                             'cfg sweeps classifier-free guidance schedules against inference_cfg_rate on every step')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice2-0.5B',
+                        help='local path')
+    parser.add_argument('--prompt_wav',
+                        type=str,
+                        required=True,
+                        help='prompt wav for zero shot inference')
+    parser.add_argument('--prompt_text',
+                        type=str,
+                        default='希望你以后能够做的比我还好呦。',
+                        help='transcription of prompt wav')
+    parser.add_argument('--tts_text',
+                        type=str,
+                        default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。',
+                        help='text to synthesize')
+    parser.add_argument('--solvers',
+                        type=str,
+                        default=','.join(SOLVERS.keys()),
+                        help='comma separated solvers, choose from {}'.format(list(SOLVERS.keys())))
+    parser.add_argument('--n_timesteps',
+                        type=str,
+                        default='4,5,6,8,10',
+                        help='comma separated step counts, the last one is used in cfg mode')
+    parser.add_argument('--t_scheduler',
+                        type=str,
+                        default='cosine',
+                        choices=['linear', 'cosine'],
+                        help='t scheduler of flow decoder')
+    parser.add_argument('--stream',
+                        action='store_true',
+                        default=False,
+                        help='run streaming inference')
+    parser.add_argument('--num_runs',
+                        type=int,
+                        default=3,
+                        help='number of measured runs per setting')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def synthesize(cosyvoice, args, prompt_speech_16k, **kwargs):
+    # same seed for every run so that llm decodes the same speech token and only flow decoder differs
+    set_all_random_seed(0)
+    start_time = time.time()
+    tts_speech = torch.concat([i['tts_speech'] for i in cosyvoice.inference_zero_shot(args.tts_text, args.prompt_text, prompt_speech_16k,
+                                                                                      stream=args.stream, **kwargs)], dim=1)
+    elapsed = time.time() - start_time
+    return tts_speech, elapsed / (tts_speech.shape[1] / cosyvoice.sample_rate)
+
+
+def mel_distance(cosyvoice, speech, ref_speech):
+    feat = cosyvoice.frontend.feat_extractor(speech)
+    ref_feat = cosyvoice.frontend.feat_extractor(ref_speech)
+    if feat.shape != ref_feat.shape:
+        logging.warning('speech length differs from reference, {} vs {}, compare the common part'.format(feat.shape, ref_feat.shape))
+    length = min(feat.shape[2], ref_feat.shape[2])
+    return (feat[:, :, :length] - ref_feat[:, :, :length]).abs().mean().item()
+
+
+def get_cfg_settings(n_timesteps, cfg_rate):
+    half = n_timesteps // 2
+    return [('default', {}),
+            ('off', {'cfg_rate': 0}),
+            ('first_half_steps', {'cfg_rate': [cfg_rate] * half + [0] * (n_timesteps - half)}),
+            ('interval_0_0.5', {'cfg_interval': (0, 0.5)}),
+            ('linear_decay', {'cfg_rate': [cfg_rate * (1 - i / n_timesteps) for i in range(n_timesteps)]})]
+
+
+def evaluate(cosyvoice, args, prompt_speech_16k, ref_speech, **kwargs):
+    rtf, distance = [], []
+    for _ in range(args.num_runs):
+        speech, this_rtf = synthesize(cosyvoice, args, prompt_speech_16k, **kwargs)
+        rtf.append(this_rtf)
+        distance.append(mel_distance(cosyvoice, speech, ref_speech))
+    return np.mean(rtf), np.mean(distance)
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    cosyvoice = CosyVoice2(args.model_dir)
+    prompt_speech_16k = load_wav(args.prompt_wav, 16000)
+    # warmup
+    synthesize(cosyvoice, args, prompt_speech_16k)
+    results = []
+    if args.mode == 'solver':
+        ref_speech, _ = synthesize(cosyvoice, args, prompt_speech_16k, n_timesteps=10, solver='euler', t_scheduler=args.t_scheduler)
+        for solver in args.solvers.split(','):
+            for n_timesteps in [int(i) for i in args.n_timesteps.split(',')]:
+                rtf, distance = evaluate(cosyvoice, args, prompt_speech_16k, ref_speech, n_timesteps=n_timesteps, solver=solver, t_scheduler=args.t_scheduler)
+                results.append(('{}/{}'.format(solver, n_timesteps), rtf, distance))
+                logging.info('{} rtf {:.3f} mel l1 {:.4f}'.format(*results[-1]))
+    else:
+        n_timesteps = int(args.n_timesteps.split(',')[-1])
+        ref_speech, _ = synthesize(cosyvoice, args, prompt_speech_16k, n_timesteps=n_timesteps, t_scheduler=args.t_scheduler)
+        for name, cfg_kwargs in get_cfg_settings(n_timesteps, cosyvoice.model.flow.decoder.inference_cfg_rate):
+            rtf, distance = evaluate(cosyvoice, args, prompt_speech_16k, ref_speech, n_timesteps=n_timesteps, t_scheduler=args.t_scheduler, **cfg_kwargs)
+            results.append((name, rtf, distance))
+            logging.info('{} rtf {:.3f} mel l1 {:.4f}'.format(*results[-1]))
+    print('{:<20} {:>8} {:>8}'.format('setting', 'rtf', 'mel_l1'))
+    for name, rtf, distance in results:
+        print('{:<20} {:>8.3f} {:>8.4f}'.format(name, rtf, distance))
+
+
+if __name__ == '__main__':
+    main()
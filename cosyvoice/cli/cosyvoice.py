@@ -12,7 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
+import queue
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Generator
 from tqdm import tqdm
 from hyperpyyaml import load_hyperpyyaml
@@ -21,12 +24,14 @@ import torch
 from cosyvoice.cli.frontend import CosyVoiceFrontEnd
 from cosyvoice.cli.model import CosyVoiceModel, CosyVoice2Model
 from cosyvoice.utils.file_utils import logging
+from cosyvoice.utils.common import CancellationToken
 from cosyvoice.utils.class_utils import get_model_type
 
 
 class CosyVoice:
 
-    def __init__(self, model_dir, load_jit=False, load_trt=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_jit=False, load_trt=False, fp16=False, trt_concurrent=1, quantize=None, dtype=None, load_onnx=False,
+                 load_hift_onnx=False, prompt_cache_bytes=256 * 1024 * 1024, prompt_cache_dir=''):
         self.instruct = True if '-Instruct' in model_dir else False
         self.model_dir = model_dir
         self.fp16 = fp16
@@ -43,15 +48,27 @@ class CosyVoice:
                                           '{}/campplus.onnx'.format(model_dir),
                                           '{}/speech_tokenizer_v1.onnx'.format(model_dir),
                                           '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
+                                          configs['allowed_special'],
+                                          prompt_cache_bytes=prompt_cache_bytes,
+                                          prompt_cache_dir=prompt_cache_dir)
         self.sample_rate = configs['sample_rate']
         if torch.cuda.is_available() is False and (load_jit is True or load_trt is True or fp16 is True):
             load_jit, load_trt, fp16 = False, False, False
             logging.warning('no cuda device, set load_jit/load_trt/fp16 to False')
-        self.model = CosyVoiceModel(configs['llm'], configs['flow'], configs['hift'], fp16)
+        if torch.cuda.is_available() is True and quantize is not None:
+            quantize = None
+            logging.warning('dynamic quantization only runs on cpu, set quantize to None')
+        assert dtype in [None, 'bf16'], 'unsupported dtype {}'.format(dtype)
+        if torch.cuda.is_available() is True and dtype is not None:
+            dtype = None
+            logging.warning('bf16 autocast only runs on cpu, use fp16 on cuda, set dtype to None')
+        assert dtype is None or quantize is None, 'bf16 autocast can not be used together with quantize'
+        self.model = CosyVoiceModel(configs['llm'], configs['flow'], configs['hift'], fp16, dtype == 'bf16')
         self.model.load('{}/llm.pt'.format(model_dir),
                         '{}/flow.pt'.format(model_dir),
                         '{}/hift.pt'.format(model_dir))
+        if quantize is not None:
+            self.model.load_quantize(quantize)
         if load_jit:
             self.model.load_jit('{}/llm.text_encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
                                 '{}/llm.llm.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
@@ -61,8 +78,19 @@ class CosyVoice:
                                 '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
                                 trt_concurrent,
                                 self.fp16)
+        elif load_onnx:
+            # trt_concurrent is the size of the onnxruntime session pool as well
+            self.model.load_onnx('{}/flow.decoder.estimator.fp32.onnx'.format(model_dir), trt_concurrent)
+        if load_hift_onnx:
+            self.model.load_hift_onnx('{}/hift.f0_predictor.fp32.onnx'.format(model_dir),
+                                      '{}/hift.decode.fp32.onnx'.format(model_dir),
+                                      trt_concurrent)
         del configs
 
+    def prompt_cache_stats(self):
+        """hits, misses, entries and bytes of the frontend prompt cache, None when it is disabled."""
+        return self.frontend.prompt_cache.stats() if self.frontend.prompt_cache is not None else None
+
     def list_available_spks(self):
         spks = list(self.frontend.spk2info.keys())
         return spks
@@ -78,61 +106,180 @@ class CosyVoice:
     def save_spkinfo(self):
         torch.save(self.frontend.spk2info, '{}/spk2info.pt'.format(self.model_dir))
 
-    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_sft(i, spk_id)
+    def synthesize(self, texts, frontend_fn, stream=False, speed=1.0, deadline=None, pipeline=False, max_parallel_segments=1, **kwargs):
+        # kwargs are passed to model.tts, e.g. n_timesteps, solver, t_scheduler, cfg_rate and cfg_interval of flow decoder
+        if stream is False and max_parallel_segments > 1 and len(texts) > 1:
+            for model_output in self.synthesize_parallel(texts, frontend_fn, speed=speed, deadline=deadline, max_parallel_segments=max_parallel_segments,
+                                                         **kwargs):
+                yield model_output
+            return
+        if pipeline is True and len(texts) > 1:
+            for model_output in self.synthesize_pipeline(texts, frontend_fn, stream=stream, speed=speed, deadline=deadline, **kwargs):
+                yield model_output
+            return
+        for i in tqdm(texts):
+            model_input = frontend_fn(i)
             start_time = time.time()
             logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+            for model_output in self.model.tts(**model_input, stream=stream, speed=speed, deadline=deadline, **kwargs):
                 speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
                 logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
                 yield model_output
                 start_time = time.time()
 
-    def inference_zero_shot(self, tts_text, prompt_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
+    def synthesize_pipeline(self, texts, frontend_fn, stream=False, speed=1.0, deadline=None, **kwargs):
+        """Overlap the stages of consecutive sentences and yield outputs in order.
+
+        Every sentence runs frontend and model.tts in its own thread. While sentence i is rendered
+        by flow and hift, sentence i + 1 is decoded by llm and sentence i + 2 runs frontend, then
+        waits for sentence i to finish before it starts llm decoding.
+        """
+        stop = threading.Event()
+        jobs = []
+
+        def start_job():
+            job = {'text': texts[len(jobs)], 'queue': queue.Queue(), 'done': threading.Event(),
+                   'wait_for': jobs[-2]['done'] if len(jobs) >= 2 else None, 'cancel_token': CancellationToken(deadline)}
+            job['thread'] = threading.Thread(target=self.synthesize_job, args=(job, frontend_fn, stream, speed, stop),
+                                             kwargs=kwargs)
+            job['thread'].start()
+            jobs.append(job)
+
+        try:
+            for _ in range(min(3, len(texts))):
+                start_job()
+            for index in tqdm(range(len(texts))):
+                job = jobs[index]
+                start_time = time.time()
+                logging.info('synthesis text {}'.format(job['text']))
+                while True:
+                    model_output = job['queue'].get()
+                    if model_output is None:
+                        break
+                    if isinstance(model_output, Exception):
+                        raise model_output
+                    speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
+                    logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
+                    yield model_output
+                    start_time = time.time()
+                if len(jobs) < len(texts):
+                    start_job()
+        finally:
+            stop.set()
+            # stop llm decoding of in-flight sentences within one step, and skip their flow and hift
+            for job in jobs:
+                job['cancel_token'].cancel()
+            for job in jobs:
+                job['thread'].join()
+
+    def synthesize_parallel(self, texts, frontend_fn, speed=1.0, deadline=None, max_parallel_segments=4, **kwargs):
+        """Synthesize all sentences of a non-streaming request concurrently and yield outputs in order.
+
+        Concurrent model.tts calls share the batched llm, flow and hift steps when the model has a
+        scheduler, see CosyVoice2Model.load_scheduler, otherwise they overlap in the thread pool.
+        """
+        def synthesize_segment(text, cancel_token):
+            model_input = frontend_fn(text)
+            if cancel_token.cancelled() is True:
+                return []
+            model_outputs = self.model.tts(**model_input, stream=False, speed=speed, cancel_token=cancel_token, **kwargs)
+            outputs = []
+            try:
+                for model_output in model_outputs:
+                    if cancel_token.cancelled() is True:
+                        break
+                    outputs.append(model_output)
+            finally:
+                # stop llm decoding at once if the consumer is gone
+                model_outputs.close()
+            return outputs
+
+        start_time = time.time()
+        executor = ThreadPoolExecutor(max_workers=max_parallel_segments)
+        # one token per segment, model.tts cancels its token when it finishes
+        cancel_tokens = [CancellationToken(deadline) for _ in texts]
+        try:
+            futures = [executor.submit(synthesize_segment, i, j) for i, j in zip(texts, cancel_tokens)]
+            for i, future in zip(tqdm(texts), futures):
+                for model_output in future.result():
+                    speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
+                    logging.info('synthesis text {}, yield speech len {}, elapsed {}'.format(i, speech_len, time.time() - start_time))
+                    yield model_output
+        finally:
+            # segments which are not started yet are dropped if the consumer stops early,
+            # running ones stop llm decoding within one step and skip flow and hift
+            for cancel_token in cancel_tokens:
+                cancel_token.cancel()
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def synthesize_job(self, job, frontend_fn, stream, speed, stop, **kwargs):
+        try:
+            model_input = frontend_fn(job['text'])
+            if job['wait_for'] is not None:
+                job['wait_for'].wait()
+            if stop.is_set() is False:
+                model_outputs = self.model.tts(**model_input, stream=stream, speed=speed, cancel_token=job['cancel_token'], **kwargs)
+                for model_output in model_outputs:
+                    job['queue'].put(model_output)
+                    if stop.is_set() is True:
+                        break
+                # stop llm decoding at once if the consumer is gone
+                model_outputs.close()
+        except Exception as e:
+            job['queue'].put(e)
+        finally:
+            job['queue'].put(None)
+            job['done'].set()
+
+    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, text_frontend=True, timeout=None, pipeline=False, max_parallel_segments=1,
+                      **kwargs):
+        deadline = None if timeout is None else time.time() + timeout
+        texts = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)
+        for model_output in self.synthesize(texts, lambda i: self.frontend.frontend_sft(i, spk_id),
+                                            stream=stream, speed=speed, deadline=deadline, pipeline=pipeline,
+                                            max_parallel_segments=max_parallel_segments, **kwargs):
+            yield model_output
+
+    def inference_zero_shot(self, tts_text, prompt_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True, timeout=None,
+                            pipeline=False, max_parallel_segments=1, **kwargs):
+        deadline = None if timeout is None else time.time() + timeout
         prompt_text = self.frontend.text_normalize(prompt_text, split=False, text_frontend=text_frontend)
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
+        texts = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)
+        for i in texts:
             if (not isinstance(i, Generator)) and len(i) < 0.5 * len(prompt_text):
                 logging.warning('synthesis text {} too short than prompt text {}, this may lead to bad performance'.format(i, prompt_text))
-            model_input = self.frontend.frontend_zero_shot(i, prompt_text, prompt_speech_16k, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+        for model_output in self.synthesize(texts, lambda i: self.frontend.frontend_zero_shot(i, prompt_text, prompt_speech_16k, self.sample_rate, zero_shot_spk_id),
+                                            stream=stream, speed=speed, deadline=deadline, pipeline=pipeline,
+                                            max_parallel_segments=max_parallel_segments, **kwargs):
+            yield model_output
 
-    def inference_cross_lingual(self, tts_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_cross_lingual(i, prompt_speech_16k, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+    def inference_cross_lingual(self, tts_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True, timeout=None,
+                                pipeline=False, max_parallel_segments=1, **kwargs):
+        deadline = None if timeout is None else time.time() + timeout
+        texts = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)
+        for model_output in self.synthesize(texts, lambda i: self.frontend.frontend_cross_lingual(i, prompt_speech_16k, self.sample_rate, zero_shot_spk_id),
+                                            stream=stream, speed=speed, deadline=deadline, pipeline=pipeline,
+                                            max_parallel_segments=max_parallel_segments, **kwargs):
+            yield model_output
 
-    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0, text_frontend=True):
+    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0, text_frontend=True, timeout=None,
+                           pipeline=False, max_parallel_segments=1, **kwargs):
+        deadline = None if timeout is None else time.time() + timeout
         assert isinstance(self.model, CosyVoiceModel), 'inference_instruct is only implemented for CosyVoice!'
         if self.instruct is False:
             raise ValueError('{} do not support instruct inference'.format(self.model_dir))
         instruct_text = self.frontend.text_normalize(instruct_text, split=False, text_frontend=text_frontend)
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_instruct(i, spk_id, instruct_text)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+        texts = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)
+        for model_output in self.synthesize(texts, lambda i: self.frontend.frontend_instruct(i, spk_id, instruct_text),
+                                            stream=stream, speed=speed, deadline=deadline, pipeline=pipeline,
+                                            max_parallel_segments=max_parallel_segments, **kwargs):
+            yield model_output
 
-    def inference_vc(self, source_speech_16k, prompt_speech_16k, stream=False, speed=1.0):
+    def inference_vc(self, source_speech_16k, prompt_speech_16k, stream=False, speed=1.0, timeout=None, **kwargs):
+        deadline = None if timeout is None else time.time() + timeout
         model_input = self.frontend.frontend_vc(source_speech_16k, prompt_speech_16k, self.sample_rate)
         start_time = time.time()
-        for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+        for model_output in self.model.tts(**model_input, stream=stream, speed=speed, deadline=deadline, **kwargs):
             speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
             logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
             yield model_output
@@ -141,7 +288,9 @@ class CosyVoice:
 
 class CosyVoice2(CosyVoice):
 
-    def __init__(self, model_dir, load_jit=False, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_jit=False, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1, max_batch_size=1, quantize=None,
+                 dtype=None, load_onnx=False, load_hift_onnx=False, prompt_cache_bytes=256 * 1024 * 1024, prompt_cache_dir='', stream_hift=False,
+                 num_draft=0):
         self.instruct = True if '-Instruct' in model_dir else False
         self.model_dir = model_dir
         self.fp16 = fp16
@@ -158,17 +307,33 @@ class CosyVoice2(CosyVoice):
                                           '{}/campplus.onnx'.format(model_dir),
                                           '{}/speech_tokenizer_v2.onnx'.format(model_dir),
                                           '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
+                                          configs['allowed_special'],
+                                          prompt_cache_bytes=prompt_cache_bytes,
+                                          prompt_cache_dir=prompt_cache_dir)
         self.sample_rate = configs['sample_rate']
         if torch.cuda.is_available() is False and (load_jit is True or load_trt is True or fp16 is True):
             load_jit, load_trt, fp16 = False, False, False
             logging.warning('no cuda device, set load_jit/load_trt/fp16 to False')
-        self.model = CosyVoice2Model(configs['llm'], configs['flow'], configs['hift'], fp16)
+        if torch.cuda.is_available() is True and quantize is not None:
+            quantize = None
+            logging.warning('dynamic quantization only runs on cpu, set quantize to None')
+        assert dtype in [None, 'bf16'], 'unsupported dtype {}'.format(dtype)
+        if torch.cuda.is_available() is True and dtype is not None:
+            dtype = None
+            logging.warning('bf16 autocast only runs on cpu, use fp16 on cuda, set dtype to None')
+        assert dtype is None or quantize is None, 'bf16 autocast can not be used together with quantize'
+        self.model = CosyVoice2Model(configs['llm'], configs['flow'], configs['hift'], fp16, dtype == 'bf16', stream_hift)
         self.model.load('{}/llm.pt'.format(model_dir),
                         '{}/flow.pt'.format(model_dir),
                         '{}/hift.pt'.format(model_dir))
+        if quantize is not None:
+            self.model.load_quantize(quantize)
         if load_vllm:
             self.model.load_vllm('{}/vllm'.format(model_dir))
+        if num_draft > 0:
+            self.model.load_speculative(num_draft)
+        if max_batch_size > 1:
+            self.model.load_scheduler(max_batch_size)
         if load_jit:
             self.model.load_jit('{}/flow.encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'))
         if load_trt:
@@ -176,19 +341,28 @@ class CosyVoice2(CosyVoice):
                                 '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
                                 trt_concurrent,
                                 self.fp16)
+        elif load_onnx:
+            # trt_concurrent is the size of the onnxruntime session pool as well
+            self.model.load_onnx('{}/flow.decoder.estimator.fp32.onnx'.format(model_dir), trt_concurrent)
+        if load_hift_onnx:
+            self.model.load_hift_onnx('{}/hift.f0_predictor.fp32.onnx'.format(model_dir),
+                                      '{}/hift.decode.fp32.onnx'.format(model_dir),
+                                      trt_concurrent)
         del configs
 
+    def speculative_stats(self):
+        """Cumulative drafts, accepted drafts, forwards and tokens of speculative llm decoding, see Qwen2LM.speculative_stats."""
+        return self.model.llm.speculative_stats()
+
     def inference_instruct(self, *args, **kwargs):
         raise NotImplementedError('inference_instruct is not implemented for CosyVoice2!')
 
-    def inference_instruct2(self, tts_text, instruct_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
+    def inference_instruct2(self, tts_text, instruct_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True, timeout=None,
+                            pipeline=False, max_parallel_segments=1, **kwargs):
+        deadline = None if timeout is None else time.time() + timeout
         assert isinstance(self.model, CosyVoice2Model), 'inference_instruct2 is only implemented for CosyVoice2!'
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_instruct2(i, instruct_text, prompt_speech_16k, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+        texts = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)
+        for model_output in self.synthesize(texts, lambda i: self.frontend.frontend_instruct2(i, instruct_text, prompt_speech_16k, self.sample_rate, zero_shot_spk_id),
+                                            stream=stream, speed=speed, deadline=deadline, pipeline=pipeline,
+                                            max_parallel_segments=max_parallel_segments, **kwargs):
+            yield model_output
@@ -11,9 +11,12 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from collections import OrderedDict
 from functools import partial
 from typing import Generator
+import hashlib
 import json
+import threading
 import onnxruntime
 import torch
 import numpy as np
@@ -36,6 +39,79 @@ from cosyvoice.utils.file_utils import logging
 from cosyvoice.utils.frontend_utils import contains_chinese, replace_blank, replace_corner_mark, remove_bracket, spell_out_number, split_paragraph, is_only_punctuation
 
 
+def copy_model_input(model_input):
+    # tensors are cloned so that callers can not modify cached or registered entries in place
+    return {k: v.clone() if isinstance(v, torch.Tensor) else v for k, v in model_input.items()}
+
+
+class PromptCache:
+    """LRU cache of prompt features, keyed by a hash of the prompt speech, prompt text and sample rate.
+
+    Entries are evicted once their tensors exceed max_bytes, and are also saved to cache_dir
+    when it is given so that they survive restarts. get returns copies of the stored entries.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, cache_dir: str = '', device: str = 'cpu'):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.device = device
+        if self.cache_dir != '':
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(prompt_speech_16k, prompt_text, resample_rate, mode):
+        h = hashlib.sha1()
+        h.update('{}|{}|{}|{}|'.format(mode, resample_rate, prompt_text, tuple(prompt_speech_16k.shape)).encode('utf-8'))
+        h.update(prompt_speech_16k.detach().cpu().contiguous().numpy().tobytes())
+        return h.hexdigest()
+
+    @staticmethod
+    def entry_bytes(entry):
+        return sum(v.nelement() * v.element_size() for v in entry.values() if isinstance(v, torch.Tensor))
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if entry is None and self.cache_dir != '' and os.path.exists('{}/{}.pt'.format(self.cache_dir, key)):
+            entry = torch.load('{}/{}.pt'.format(self.cache_dir, key), map_location=self.device)
+            self.put(key, entry, save=False)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            logging.debug('prompt cache {}, hits {}, misses {}, {} entries of {} bytes'.format(
+                'miss' if entry is None else 'hit', self.hits, self.misses, len(self.entries), self.num_bytes))
+        return None if entry is None else copy_model_input(entry)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'bytes': self.num_bytes}
+
+    def put(self, key, entry, save=True):
+        entry = copy_model_input(entry)
+        entry_bytes = self.entry_bytes(entry)
+        if entry_bytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.num_bytes -= self.entry_bytes(self.entries.pop(key))
+            self.entries[key] = entry
+            self.num_bytes += entry_bytes
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.num_bytes -= self.entry_bytes(evicted)
+        if save is True and self.cache_dir != '':
+            torch.save(entry, '{}/{}.pt'.format(self.cache_dir, key))
+
+
 class CosyVoiceFrontEnd:
 
     def __init__(self,
@@ -44,7 +120,9 @@ class CosyVoiceFrontEnd:
                  campplus_model: str,
                  speech_tokenizer_model: str,
                  spk2info: str = '',
-                 allowed_special: str = 'all'):
+                 allowed_special: str = 'all',
+                 prompt_cache_bytes: int = 256 * 1024 * 1024,
+                 prompt_cache_dir: str = ''):
         self.tokenizer = get_tokenizer()
         self.feat_extractor = feat_extractor
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -60,6 +138,7 @@ class CosyVoiceFrontEnd:
         else:
             self.spk2info = {}
         self.allowed_special = allowed_special
+        self.prompt_cache = PromptCache(prompt_cache_bytes, prompt_cache_dir, self.device) if prompt_cache_bytes > 0 else None
         self.use_ttsfrd = use_ttsfrd
         if self.use_ttsfrd:
             self.frd = ttsfrd.TtsFrontendEngine()
@@ -150,34 +229,45 @@ class CosyVoiceFrontEnd:
 
     def frontend_sft(self, tts_text, spk_id):
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
-        embedding = self.spk2info[spk_id]['embedding']
+        embedding = self.spk2info[spk_id]['embedding'].clone()
         model_input = {'text': tts_text_token, 'text_len': tts_text_token_len, 'llm_embedding': embedding, 'flow_embedding': embedding}
         return model_input
 
     def frontend_zero_shot(self, tts_text, prompt_text, prompt_speech_16k, resample_rate, zero_shot_spk_id):
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
-        if zero_shot_spk_id == '':
-            prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
-            prompt_speech_resample = torchaudio.transforms.Resample(orig_freq=16000, new_freq=resample_rate)(prompt_speech_16k)
-            speech_feat, speech_feat_len = self._extract_speech_feat(prompt_speech_resample)
-            speech_token, speech_token_len = self._extract_speech_token(prompt_speech_16k)
-            if resample_rate == 24000:
-                # cosyvoice2, force speech_feat % speech_token = 2
-                token_len = min(int(speech_feat.shape[1] / 2), speech_token.shape[1])
-                speech_feat, speech_feat_len[:] = speech_feat[:, :2 * token_len], 2 * token_len
-                speech_token, speech_token_len[:] = speech_token[:, :token_len], token_len
-            embedding = self._extract_spk_embedding(prompt_speech_16k)
-            model_input = {'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
-                           'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
-                           'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
-                           'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': speech_feat_len,
-                           'llm_embedding': embedding, 'flow_embedding': embedding}
+        if zero_shot_spk_id != '':
+            model_input = copy_model_input(self.spk2info[zero_shot_spk_id])
         else:
-            model_input = self.spk2info[zero_shot_spk_id]
+            model_input = self._extract_zero_shot_prompt(prompt_text, prompt_speech_16k, resample_rate)
         model_input['text'] = tts_text_token
         model_input['text_len'] = tts_text_token_len
         return model_input
 
+    def _extract_zero_shot_prompt(self, prompt_text, prompt_speech_16k, resample_rate):
+        if self.prompt_cache is not None:
+            key = self.prompt_cache.key(prompt_speech_16k, prompt_text, resample_rate, 'zero_shot')
+            model_input = self.prompt_cache.get(key)
+            if model_input is not None:
+                return model_input
+        prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
+        prompt_speech_resample = torchaudio.transforms.Resample(orig_freq=16000, new_freq=resample_rate)(prompt_speech_16k)
+        speech_feat, speech_feat_len = self._extract_speech_feat(prompt_speech_resample)
+        speech_token, speech_token_len = self._extract_speech_token(prompt_speech_16k)
+        if resample_rate == 24000:
+            # cosyvoice2, force speech_feat % speech_token = 2
+            token_len = min(int(speech_feat.shape[1] / 2), speech_token.shape[1])
+            speech_feat, speech_feat_len[:] = speech_feat[:, :2 * token_len], 2 * token_len
+            speech_token, speech_token_len[:] = speech_token[:, :token_len], token_len
+        embedding = self._extract_spk_embedding(prompt_speech_16k)
+        model_input = {'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
+                       'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
+                       'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
+                       'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': speech_feat_len,
+                       'llm_embedding': embedding, 'flow_embedding': embedding}
+        if self.prompt_cache is not None:
+            self.prompt_cache.put(key, model_input)
+        return model_input
+
     def frontend_cross_lingual(self, tts_text, prompt_speech_16k, resample_rate, zero_shot_spk_id):
         model_input = self.frontend_zero_shot(tts_text, '', prompt_speech_16k, resample_rate, zero_shot_spk_id)
         # in cross lingual mode, we remove prompt in llm
@@ -203,13 +293,25 @@ class CosyVoiceFrontEnd:
         return model_input
 
     def frontend_vc(self, source_speech_16k, prompt_speech_16k, resample_rate):
+        model_input = self._extract_vc_prompt(prompt_speech_16k, resample_rate)
+        source_speech_token, source_speech_token_len = self._extract_speech_token(source_speech_16k)
+        model_input['source_speech_token'] = source_speech_token
+        model_input['source_speech_token_len'] = source_speech_token_len
+        return model_input
+
+    def _extract_vc_prompt(self, prompt_speech_16k, resample_rate):
+        if self.prompt_cache is not None:
+            key = self.prompt_cache.key(prompt_speech_16k, '', resample_rate, 'vc')
+            model_input = self.prompt_cache.get(key)
+            if model_input is not None:
+                return model_input
         prompt_speech_token, prompt_speech_token_len = self._extract_speech_token(prompt_speech_16k)
         prompt_speech_resample = torchaudio.transforms.Resample(orig_freq=16000, new_freq=resample_rate)(prompt_speech_16k)
         prompt_speech_feat, prompt_speech_feat_len = self._extract_speech_feat(prompt_speech_resample)
         embedding = self._extract_spk_embedding(prompt_speech_16k)
-        source_speech_token, source_speech_token_len = self._extract_speech_token(source_speech_16k)
-        model_input = {'source_speech_token': source_speech_token, 'source_speech_token_len': source_speech_token_len,
-                       'flow_prompt_speech_token': prompt_speech_token, 'flow_prompt_speech_token_len': prompt_speech_token_len,
+        model_input = {'flow_prompt_speech_token': prompt_speech_token, 'flow_prompt_speech_token_len': prompt_speech_token_len,
                        'prompt_speech_feat': prompt_speech_feat, 'prompt_speech_feat_len': prompt_speech_feat_len,
                        'flow_embedding': embedding}
+        if self.prompt_cache is not None:
+            self.prompt_cache.put(key, model_input)
         return model_input
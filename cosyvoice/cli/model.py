@@ -13,7 +13,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
-from typing import Generator
+import queue
+from typing import Dict, Generator, Optional
 import torch
 import numpy as np
 import threading
@@ -21,9 +22,276 @@ import time
 from torch.nn import functional as F
 from contextlib import nullcontext
 import uuid
+from matcha.models.components.transformer import BasicTransformerBlock
 from cosyvoice.utils.common import fade_in_out
 from cosyvoice.utils.file_utils import convert_onnx_to_trt, export_cosyvoice2_vllm
-from cosyvoice.utils.common import TrtContextWrapper
+from cosyvoice.utils.common import TrtContextWrapper, OrtSessionWrapper, CancellationToken, push_recent_tokens, quantize_linear_dynamic, autocast
+from cosyvoice.utils.file_utils import logging
+
+
+class LLMScheduler:
+    """Continuous batching of Qwen2LM decoding on the HF backend.
+
+    Every active session owns one row of a left padded batched kv cache, and at each
+    decode step all rows are forwarded together by a single forward_one_step call.
+    New sessions are prefilled on their own and join the batch before the next step,
+    finished sessions leave the batch right after the step.
+    """
+
+    def __init__(self, llm: torch.nn.Module, max_batch_size: int = 8, fp16: bool = False, bf16: bool = False):
+        self.llm = llm
+        self.max_batch_size = max_batch_size
+        self.fp16 = fp16
+        self.bf16 = bf16
+        self.llm_context = torch.cuda.stream(torch.cuda.Stream(llm.llm_embedding.weight.device)) if torch.cuda.is_available() else nullcontext()
+        self.cond = threading.Condition()
+        self.pending = []
+        # row i of cache/cache_mask/recent_tokens belongs to sessions[i], cache is legacy tuple kv cache
+        self.sessions = []
+        self.cache = None
+        self.cache_mask = None
+        # recent sampled tokens of every session for repetition aware sampling
+        self.recent_tokens = None
+        self.recent_len = getattr(llm.sampling, 'keywords', {}).get('win_size', 10)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def inference(self, lm_input, sampling, min_len, max_len, cancel_token=None, prefix_len=0, prefix_key=None):
+        session = {'lm_input': lm_input, 'sampling': sampling, 'min_len': min_len, 'max_len': max_len, 'cancel_token': cancel_token,
+                   'prefix_len': prefix_len, 'prefix_key': prefix_key,
+                   'step': 0, 'output_queue': queue.Queue(), 'stop': False}
+        with self.cond:
+            self.pending.append(session)
+            self.cond.notify()
+        try:
+            while True:
+                top_ids = session['output_queue'].get()
+                if top_ids is None:
+                    break
+                if isinstance(top_ids, Exception):
+                    raise top_ids
+                yield top_ids
+        finally:
+            # consumer may stop early, scheduler will drop this session before next step
+            session['stop'] = True
+
+    def run(self):
+        while True:
+            with self.cond:
+                while len(self.pending) == 0 and len(self.sessions) == 0:
+                    self.cond.wait()
+                num_join = self.max_batch_size - len(self.sessions)
+                pending, self.pending = self.pending[:num_join], self.pending[num_join:]
+            for session in pending + self.sessions:
+                if session['stop'] is False and session['cancel_token'] is not None and session['cancel_token'].cancelled():
+                    session['stop'] = True
+                    session['output_queue'].put(None)
+            try:
+                with self.llm_context, autocast(self.fp16, self.bf16), torch.inference_mode():
+                    self.remove([i for i, session in enumerate(self.sessions) if session['stop'] is False])
+                    for session in pending:
+                        if session['stop'] is False:
+                            self.prefill(session)
+                    if len(self.sessions) != 0:
+                        self.step()
+            except Exception as e:
+                logging.error('llm scheduler failed, abort {} sessions'.format(len(pending) + len(self.sessions)))
+                for session in pending + self.sessions:
+                    session['output_queue'].put(e)
+                self.sessions, self.cache, self.cache_mask, self.recent_tokens = [], None, None, None
+
+    def prefill(self, session):
+        lm_input, cache = session['lm_input'], None
+        if session['prefix_key'] is not None and self.llm.prefix_cache is not None:
+            cache = self.llm.prefill_prefix(lm_input[:, :session['prefix_len']], session['prefix_key'])
+            lm_input = lm_input[:, session['prefix_len']:]
+        seq_len = lm_input.shape[1] if cache is None else lm_input.shape[1] + cache[0][0].size(2)
+        masks = torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool)
+        y_pred, cache = self.llm.llm.forward_one_step(lm_input, masks=masks, cache=cache)
+        logp = self.llm.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+        recent_tokens = torch.full((1, self.recent_len), -1, dtype=torch.long, device=logp.device)
+        recent_tokens, keep = self.sample([session], logp, recent_tokens)
+        if len(keep) != 0:
+            self.join(session, cache, masks[:, -1], recent_tokens)
+
+    def step(self):
+        # only the last position is fed, it differs from lm_input when a special token is sampled right after prefill
+        xs = torch.concat([session['lm_input'][:, -1:] for session in self.sessions], dim=0)
+        masks = torch.concat([self.cache_mask, torch.ones_like(self.cache_mask[:, :1])], dim=1)
+        position_ids = self.cache_mask.sum(dim=1, keepdim=True)
+        y_pred, self.cache = self.llm.llm.forward_one_step(xs, masks=masks.unsqueeze(dim=1), cache=self.cache, position_ids=position_ids)
+        self.cache_mask = masks
+        logp = self.llm.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+        self.recent_tokens, keep = self.sample(self.sessions, logp, self.recent_tokens)
+        self.remove(keep)
+
+    def sample(self, sessions, logp, recent_tokens):
+        """Sample next token of all sessions in one call, logp is (B, V) and recent_tokens (B, W).
+
+        Returns updated recent_tokens and indices of sessions which are not finished.
+        """
+        ignore_eos = torch.tensor([session['step'] < session['min_len'] for session in sessions], device=logp.device)
+        top_ids = self.llm.sampling_ids(logp, recent_tokens, sessions[0]['sampling'], ignore_eos=ignore_eos)
+        recent_tokens = push_recent_tokens(recent_tokens, top_ids, top_ids < self.llm.speech_token_size)
+        keep = []
+        for i, (session, top_id) in enumerate(zip(sessions, top_ids.tolist())):
+            session['step'] += 1
+            if top_id == self.llm.speech_token_size:
+                session['output_queue'].put(None)
+                continue
+            # same as inference_wrapper, tokens above speech_token_size are skipped and previous input is fed again
+            if top_id < self.llm.speech_token_size:
+                session['output_queue'].put(top_id)
+                session['lm_input'] = self.llm.speech_embedding.weight[top_id].reshape(1, 1, -1)
+            if session['step'] >= session['max_len']:
+                session['output_queue'].put(None)
+                continue
+            keep.append(i)
+        return recent_tokens, keep
+
+    def join(self, session, cache, cache_mask, recent_tokens):
+        if self.cache is not None:
+            pad_len = self.cache_mask.shape[1] - cache_mask.shape[1]
+            if pad_len > 0:
+                cache, cache_mask = self.pad_cache(cache, cache_mask, pad_len)
+            elif pad_len < 0:
+                self.cache, self.cache_mask = self.pad_cache(self.cache, self.cache_mask, -pad_len)
+            cache = tuple((torch.concat([k1, k2], dim=0), torch.concat([v1, v2], dim=0)) for (k1, v1), (k2, v2) in zip(self.cache, cache))
+            cache_mask = torch.concat([self.cache_mask, cache_mask], dim=0)
+            recent_tokens = torch.concat([self.recent_tokens, recent_tokens], dim=0)
+        self.cache, self.cache_mask, self.recent_tokens = cache, cache_mask, recent_tokens
+        self.sessions.append(session)
+
+    def remove(self, keep):
+        if len(keep) == len(self.sessions):
+            return
+        self.sessions = [self.sessions[i] for i in keep]
+        if len(keep) == 0:
+            self.cache, self.cache_mask, self.recent_tokens = None, None, None
+            return
+        index = torch.tensor(keep, device=self.cache_mask.device)
+        self.recent_tokens = self.recent_tokens[index]
+        cache_mask = self.cache_mask[index]
+        # drop leading columns which are padding for all remaining sessions
+        start = cache_mask.any(dim=0).int().argmax().item()
+        self.cache = tuple((k[index, :, start:], v[index, :, start:]) for k, v in self.cache)
+        self.cache_mask = cache_mask[:, start:]
+
+    @staticmethod
+    def pad_cache(cache, cache_mask, pad_len):
+        cache = tuple((F.pad(k, (0, 0, pad_len, 0)), F.pad(v, (0, 0, pad_len, 0))) for k, v in cache)
+        cache_mask = F.pad(cache_mask, (pad_len, 0), value=False)
+        return cache, cache_mask
+
+
+class MicroBatcher:
+    """Group concurrent calls of one model stage into a single batched call.
+
+    The first caller of a batch becomes its leader, it waits at most window seconds for other
+    callers with the same key, and stops waiting as soon as the batch is full or every active
+    session has joined. The leader then runs batch_fn(requests, key) and hands the results back.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=8, window=0.005, num_active=None):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self.num_active = num_active if num_active is not None else lambda: max_batch_size
+        self.cond = threading.Condition()
+        # open batch of each key which still accepts requests
+        self.batches = {}
+
+    def __call__(self, request, key=None):
+        with self.cond:
+            batch = self.batches.get(key)
+            is_leader = batch is None
+            if is_leader:
+                batch = {'requests': [], 'results': None, 'done': False}
+                self.batches[key] = batch
+            index = len(batch['requests'])
+            batch['requests'].append(request)
+            if len(batch['requests']) >= min(self.max_batch_size, self.num_active()):
+                self.batches.pop(key)
+                self.cond.notify_all()
+            if is_leader:
+                deadline = time.time() + self.window
+                while self.batches.get(key) is batch and time.time() < deadline:
+                    self.cond.wait(deadline - time.time())
+                if self.batches.get(key) is batch:
+                    self.batches.pop(key)
+            else:
+                while batch['done'] is False:
+                    self.cond.wait()
+        if is_leader:
+            try:
+                results = self.batch_fn(batch['requests'], key)
+            except Exception as e:
+                results = e
+            with self.cond:
+                batch['results'], batch['done'] = results, True
+                self.cond.notify_all()
+        if isinstance(batch['results'], Exception):
+            raise batch['results']
+        return batch['results'][index]
+
+
+class TTSSession:
+    """State of one tts request shared by the llm thread and the token2wav consumer.
+
+    Speech tokens are written into a preallocated int32 buffer, the consumer blocks on
+    the condition variable until enough tokens after token_offset are available instead
+    of polling the buffer.
+    """
+
+    def __init__(self, max_token_len: int = 2048, cancel_token: Optional[CancellationToken] = None, flow_options: Optional[Dict] = None,
+                 llm_options: Optional[Dict] = None):
+        self.cond = threading.Condition()
+        self.cancel_token = cancel_token if cancel_token is not None else CancellationToken()
+        # n_timesteps, solver, t_scheduler and cfg options of flow decoder, fixed for the whole request
+        self.flow_options = flow_options if flow_options is not None else {}
+        # extra kwargs of llm.inference, e.g. num_draft of Qwen2LM, fixed for the whole request
+        self.llm_options = llm_options if llm_options is not None else {}
+        self.token = torch.zeros(max_token_len, dtype=torch.int32)
+        self.token_len = 0
+        self.token_offset = 0
+        self.llm_end = False
+        # token2wav related cache
+        self.hift_cache = None
+        self.mel_overlap = torch.zeros(1, 80, 0)
+        self.flow_cache = torch.zeros(1, 80, 0, 2)
+        self.flow_encoder_cache = {}
+        self.flow_decoder_cache = {}
+        self.hift_stream_cache = {}
+
+    def append(self, token):
+        self.extend([token])
+
+    def extend(self, tokens):
+        with self.cond:
+            if self.token_len + len(tokens) > self.token.shape[0]:
+                token = torch.zeros(max(2 * self.token.shape[0], self.token_len + len(tokens)), dtype=torch.int32)
+                token[:self.token_len] = self.token[:self.token_len]
+                self.token = token
+            self.token[self.token_len:self.token_len + len(tokens)] = torch.tensor(tokens, dtype=torch.int32)
+            self.token_len += len(tokens)
+            self.cond.notify_all()
+
+    def end(self):
+        with self.cond:
+            self.llm_end = True
+            self.cond.notify_all()
+
+    def wait(self, num_token):
+        """Block until num_token tokens after token_offset are available, return False if llm ends before that."""
+        with self.cond:
+            while self.token_len - self.token_offset < num_token and self.llm_end is False:
+                self.cond.wait()
+            return self.token_len - self.token_offset >= num_token
+
+    def get_token(self, start=0, end=None):
+        with self.cond:
+            end = self.token_len if end is None else min(end, self.token_len)
+            return self.token[start:end].clone().unsqueeze(dim=0)
 
 
 class CosyVoiceModel:
@@ -32,12 +300,15 @@ class CosyVoiceModel:
                  llm: torch.nn.Module,
                  flow: torch.nn.Module,
                  hift: torch.nn.Module,
-                 fp16: bool = False):
+                 fp16: bool = False,
+                 bf16: bool = False):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.llm = llm
         self.flow = flow
         self.hift = hift
         self.fp16 = fp16
+        # bf16 autocast on cpu, weights stay in fp32 and hift always runs in fp32
+        self.bf16 = bf16
         if self.fp16 is True:
             self.llm.half()
             self.flow.half()
@@ -58,11 +329,7 @@ class CosyVoiceModel:
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
         self.lock = threading.Lock()
         # dict used to store session related variable
-        self.tts_speech_token_dict = {}
-        self.llm_end_dict = {}
-        self.mel_overlap_dict = {}
-        self.flow_cache_dict = {}
-        self.hift_cache_dict = {}
+        self.session_dict = {}
 
     def load(self, llm_model, flow_model, hift_model):
         self.llm.load_state_dict(torch.load(llm_model, map_location=self.device), strict=True)
@@ -72,8 +339,21 @@ class CosyVoiceModel:
         # in case hift_model is a hifigan model
         hift_state_dict = {k.replace('generator.', ''): v for k, v in torch.load(hift_model, map_location=self.device).items()}
         self.hift.load_state_dict(hift_state_dict, strict=True)
+        # weight norm is only needed for training, fold it so that conv weights are not recomputed every call
+        self.hift.remove_weight_norm()
         self.hift.to(self.device).eval()
 
+    def load_quantize(self, quantize):
+        """Quantize llm, flow encoder and estimator transformer blocks for cpu inference,
+        hift stays in fp32."""
+        assert quantize == 'int8', 'only int8 dynamic quantization is supported, got {}'.format(quantize)
+        for module in [getattr(self.llm, 'text_encoder', None), self.llm.llm, self.flow.encoder]:
+            if isinstance(module, torch.nn.Module) and not isinstance(module, torch.jit.ScriptModule):
+                quantize_linear_dynamic(module)
+        for module in self.flow.decoder.estimator.modules():
+            if isinstance(module, BasicTransformerBlock):
+                quantize_linear_dynamic(module)
+
     def load_jit(self, llm_text_encoder_model, llm_llm_model, flow_encoder_model):
         llm_text_encoder = torch.jit.load(llm_text_encoder_model, map_location=self.device)
         self.llm.text_encoder = llm_text_encoder
@@ -93,104 +373,130 @@ class CosyVoiceModel:
         assert estimator_engine is not None, 'failed to load trt {}'.format(flow_decoder_estimator_model)
         self.flow.decoder.estimator = TrtContextWrapper(estimator_engine, trt_concurrent=trt_concurrent, device=self.device)
 
+    def load_onnx(self, flow_decoder_onnx_model, ort_concurrent=1):
+        """Run the flow decoder estimator with a pool of onnxruntime sessions, mainly for cpu inference."""
+        assert os.path.exists(flow_decoder_onnx_model), '{} not found, export it with cosyvoice/bin/export_onnx.py'.format(flow_decoder_onnx_model)
+        del self.flow.decoder.estimator
+        self.flow.decoder.estimator = OrtSessionWrapper(flow_decoder_onnx_model, ort_concurrent=ort_concurrent, device=self.device)
+
+    def load_hift_onnx(self, hift_f0_predictor_model, hift_decode_model, ort_concurrent=1):
+        """Run f0 predictor and convolutions of hift with onnxruntime, stft/istft and the source module
+        stay in pytorch. Streaming hift, see HiFTGenerator.inference_chunk, keeps running in pytorch."""
+        for model in [hift_f0_predictor_model, hift_decode_model]:
+            assert os.path.exists(model), '{} not found, export it with cosyvoice/bin/export_onnx_hift.py'.format(model)
+        self.hift.ort_f0_predictor = OrtSessionWrapper(hift_f0_predictor_model, ort_concurrent=ort_concurrent, device=self.device)
+        self.hift.ort_decode_spec = OrtSessionWrapper(hift_decode_model, ort_concurrent=ort_concurrent, device=self.device)
+
     def get_trt_kwargs(self):
-        min_shape = [(2, 80, 4), (2, 1, 4), (2, 80, 4), (2, 80, 4)]
-        opt_shape = [(2, 80, 500), (2, 1, 500), (2, 80, 500), (2, 80, 500)]
-        max_shape = [(2, 80, 3000), (2, 1, 3000), (2, 80, 3000), (2, 80, 3000)]
-        input_names = ["x", "mask", "mu", "cond"]
+        # batch 1 is used by steps without classifier-free guidance
+        min_shape = [(1, 80, 4), (1, 1, 4), (1, 80, 4), (1,), (1, 80), (1, 80, 4)]
+        opt_shape = [(2, 80, 500), (2, 1, 500), (2, 80, 500), (2,), (2, 80), (2, 80, 500)]
+        max_shape = [(2, 80, 3000), (2, 1, 3000), (2, 80, 3000), (2,), (2, 80), (2, 80, 3000)]
+        input_names = ["x", "mask", "mu", "t", "spks", "cond"]
         return {'min_shape': min_shape, 'opt_shape': opt_shape, 'max_shape': max_shape, 'input_names': input_names}
 
     def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, uuid):
-        with self.llm_context, torch.cuda.amp.autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False):
-            if isinstance(text, Generator):
-                assert isinstance(self, CosyVoice2Model) and not hasattr(self.llm, 'vllm'), 'streaming input text is only implemented for CosyVoice2 and do not support vllm!'
-                for i in self.llm.inference_bistream(text=text,
-                                                     prompt_text=prompt_text.to(self.device),
-                                                     prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
-                                                     prompt_speech_token=llm_prompt_speech_token.to(self.device),
-                                                     prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                                     embedding=llm_embedding.to(self.device)):
-                    self.tts_speech_token_dict[uuid].append(i)
-            else:
-                for i in self.llm.inference(text=text.to(self.device),
-                                            text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
-                                            prompt_text=prompt_text.to(self.device),
-                                            prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
-                                            prompt_speech_token=llm_prompt_speech_token.to(self.device),
-                                            prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                            embedding=llm_embedding.to(self.device),
-                                            uuid=uuid):
-                    self.tts_speech_token_dict[uuid].append(i)
-        self.llm_end_dict[uuid] = True
+        session = self.session_dict[uuid]
+        try:
+            with self.llm_context, autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False, self.bf16):
+                if isinstance(text, Generator):
+                    assert isinstance(self, CosyVoice2Model) and not hasattr(self.llm, 'vllm'), 'streaming input text is only implemented for CosyVoice2 and do not support vllm!'
+                    for i in self.llm.inference_bistream(text=text,
+                                                         prompt_text=prompt_text.to(self.device),
+                                                         prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
+                                                         prompt_speech_token=llm_prompt_speech_token.to(self.device),
+                                                         prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                         embedding=llm_embedding.to(self.device),
+                                                         cancel_token=session.cancel_token):
+                        session.append(i)
+                else:
+                    for i in self.llm.inference(text=text.to(self.device),
+                                                text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
+                                                prompt_text=prompt_text.to(self.device),
+                                                prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
+                                                prompt_speech_token=llm_prompt_speech_token.to(self.device),
+                                                prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                embedding=llm_embedding.to(self.device),
+                                                uuid=uuid,
+                                                cancel_token=session.cancel_token,
+                                                **session.llm_options):
+                        session.append(i)
+        finally:
+            # always wake up the consumer, even if llm raises
+            session.end()
 
     def vc_job(self, source_speech_token, uuid):
-        self.tts_speech_token_dict[uuid] = source_speech_token.flatten().tolist()
-        self.llm_end_dict[uuid] = True
+        self.session_dict[uuid].extend(source_speech_token.flatten().tolist())
+        self.session_dict[uuid].end()
 
     def token2wav(self, token, prompt_token, prompt_feat, embedding, uuid, finalize=False, speed=1.0):
-        with torch.cuda.amp.autocast(self.fp16):
-            tts_mel, self.flow_cache_dict[uuid] = self.flow.inference(token=token.to(self.device),
+        session = self.session_dict[uuid]
+        with autocast(self.fp16, self.bf16):
+            tts_mel, session.flow_cache = self.flow.inference(token=token.to(self.device),
                                                                       token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
                                                                       prompt_token=prompt_token.to(self.device),
                                                                       prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
                                                                       prompt_feat=prompt_feat.to(self.device),
                                                                       prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
                                                                       embedding=embedding.to(self.device),
-                                                                      flow_cache=self.flow_cache_dict[uuid])
+                                                                      flow_cache=session.flow_cache,
+                                                                      **session.flow_options)
 
         # mel overlap fade in out
-        if self.mel_overlap_dict[uuid].shape[2] != 0:
-            tts_mel = fade_in_out(tts_mel, self.mel_overlap_dict[uuid], self.mel_window)
+        if session.mel_overlap.shape[2] != 0:
+            tts_mel = fade_in_out(tts_mel, session.mel_overlap, self.mel_window)
         # append hift cache
-        if self.hift_cache_dict[uuid] is not None:
-            hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
+        if session.hift_cache is not None:
+            hift_cache_mel, hift_cache_source = session.hift_cache['mel'], session.hift_cache['source']
             tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
         else:
             hift_cache_source = torch.zeros(1, 1, 0)
         # keep overlap mel and hift cache
         if finalize is False:
-            self.mel_overlap_dict[uuid] = tts_mel[:, :, -self.mel_overlap_len:]
+            session.mel_overlap = tts_mel[:, :, -self.mel_overlap_len:]
             tts_mel = tts_mel[:, :, :-self.mel_overlap_len]
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
-            self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
-                                          'source': tts_source[:, :, -self.source_cache_len:],
-                                          'speech': tts_speech[:, -self.source_cache_len:]}
+            if session.hift_cache is not None:
+                tts_speech = fade_in_out(tts_speech, session.hift_cache['speech'], self.speech_window)
+            session.hift_cache = {'mel': tts_mel[:, :, -self.mel_cache_len:],
+                                  'source': tts_source[:, :, -self.source_cache_len:],
+                                  'speech': tts_speech[:, -self.source_cache_len:]}
             tts_speech = tts_speech[:, :-self.source_cache_len]
         else:
             if speed != 1.0:
-                assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
+                assert session.hift_cache is None, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
+            if session.hift_cache is not None:
+                tts_speech = fade_in_out(tts_speech, session.hift_cache['speech'], self.speech_window)
         return tts_speech
 
     def tts(self, text=torch.zeros(1, 0, dtype=torch.int32), flow_embedding=torch.zeros(0, 192), llm_embedding=torch.zeros(0, 192),
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
+            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, deadline=None,
+            n_timesteps=10, solver=None, t_scheduler=None, cfg_rate=None, cfg_interval=None, cancel_token=None, **kwargs):
         # this_uuid is used to track variables related to this inference thread
         this_uuid = str(uuid.uuid1())
+        flow_options = {'n_timesteps': n_timesteps, 'solver': solver, 't_scheduler': t_scheduler,
+                        'cfg_rate': tuple(cfg_rate) if isinstance(cfg_rate, list) else cfg_rate,
+                        'cfg_interval': tuple(cfg_interval) if cfg_interval is not None else None}
         with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
-            self.hift_cache_dict[this_uuid] = None
-            self.mel_overlap_dict[this_uuid] = torch.zeros(1, 80, 0)
-            self.flow_cache_dict[this_uuid] = torch.zeros(1, 80, 0, 2)
+            # a caller supplied cancel_token may be shared by several tts calls, so it is only observed through
+            # the session token, which is cancelled on exit
+            self.session_dict[this_uuid] = session = TTSSession(cancel_token=CancellationToken(deadline, parent=cancel_token), flow_options=flow_options)
         if source_speech_token.shape[1] == 0:
             p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
         else:
             p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
         p.start()
-        if stream is True:
-            token_hop_len = self.token_min_hop_len
-            while True:
-                time.sleep(0.1)
-                if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
-                        .unsqueeze(dim=0)
+        try:
+            if stream is True:
+                token_hop_len = self.token_min_hop_len
+                # wake up as soon as enough tokens are decoded, returns False once llm ends without enough tokens
+                while session.wait(token_hop_len + self.token_overlap_len):
+                    this_tts_speech_token = session.get_token(session.token_offset, session.token_offset + token_hop_len + self.token_overlap_len)
                     this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                                      prompt_token=flow_prompt_speech_token,
                                                      prompt_feat=prompt_speech_feat,
@@ -198,40 +504,47 @@ class CosyVoiceModel:
                                                      uuid=this_uuid,
                                                      finalize=False)
                     yield {'tts_speech': this_tts_speech.cpu()}
-                    with self.lock:
-                        self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
+                    session.token_offset += token_hop_len
                     # increase token_hop_len for better speech quality
                     token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
+                p.join()
+                if session.cancel_token.timeout():
+                    raise TimeoutError('tts {} exceeds its deadline'.format(this_uuid))
+                # cancelled by the caller, do not render the partial tokens
+                if session.cancel_token.cancelled():
+                    return
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                this_tts_speech_token = session.get_token(session.token_offset)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 uuid=this_uuid,
+                                                 finalize=True)
+                yield {'tts_speech': this_tts_speech.cpu()}
+            else:
+                # deal with all tokens
+                p.join()
+                if session.cancel_token.timeout():
+                    raise TimeoutError('tts {} exceeds its deadline'.format(this_uuid))
+                # cancelled by the caller, do not render the partial tokens
+                if session.cancel_token.cancelled():
+                    return
+                this_tts_speech_token = session.get_token()
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 uuid=this_uuid,
+                                                 finalize=True,
+                                                 speed=speed)
+                yield {'tts_speech': this_tts_speech.cpu()}
+        finally:
+            # consumer stops iterating or an error is raised, stop llm decoding within one step
+            session.cancel_token.cancel()
             p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.mel_overlap_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
-            self.flow_cache_dict.pop(this_uuid)
+            with self.lock:
+                self.session_dict.pop(this_uuid)
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.current_stream().synchronize()
@@ -243,12 +556,19 @@ class CosyVoice2Model(CosyVoiceModel):
                  llm: torch.nn.Module,
                  flow: torch.nn.Module,
                  hift: torch.nn.Module,
-                 fp16: bool = False):
+                 fp16: bool = False,
+                 bf16: bool = False,
+                 stream_hift: bool = False):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.llm = llm
         self.flow = flow
         self.hift = hift
         self.fp16 = fp16
+        # bf16 autocast on cpu, weights stay in fp32 and hift always runs in fp32
+        self.bf16 = bf16
+        # vocode streaming chunks with HiFTGenerator.inference_chunk instead of mel cache and cross fade
+        assert stream_hift is False or hasattr(self.hift.m_source, 'forward_chunk'), 'streaming hift needs SourceModuleHnNSF2'
+        self.stream_hift = stream_hift
         if self.fp16 is True:
             self.llm.half()
             self.flow.half()
@@ -263,9 +583,14 @@ class CosyVoice2Model(CosyVoiceModel):
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
         self.lock = threading.Lock()
         # dict used to store session related variable
-        self.tts_speech_token_dict = {}
-        self.llm_end_dict = {}
-        self.hift_cache_dict = {}
+        self.session_dict = {}
+
+    def load(self, llm_model, flow_model, hift_model):
+        super().load(llm_model, flow_model, hift_model)
+        # text lm_head of qwen2 is never run, free its weight after loading when it is not tied to embed_tokens,
+        # a tied lm_head costs nothing and is kept
+        if self.llm.llm.model.config.tie_word_embeddings is False:
+            self.llm.llm.model.lm_head = torch.nn.Identity()
 
     def load_jit(self, flow_encoder_model):
         flow_encoder = torch.jit.load(flow_encoder_model, map_location=self.device)
@@ -282,105 +607,171 @@ class CosyVoice2Model(CosyVoiceModel):
         self.llm.lock = threading.Lock()
         del self.llm.llm.model.model.layers
 
+    def load_speculative(self, num_draft):
+        """Default num_draft of every request, see Qwen2LM.inference_speculative. Requests can override it
+        with the num_draft kwarg of tts, it is ignored by vllm and the batched scheduler."""
+        assert num_draft >= 0, 'num_draft should be >= 0, got {}'.format(num_draft)
+        self.llm.num_draft = num_draft
+
+    def load_scheduler(self, max_batch_size, batch_window=0.005):
+        # vllm already does continuous batching, only batch token2wav in that case
+        if not hasattr(self.llm, 'vllm'):
+            self.llm.scheduler = LLMScheduler(self.llm, max_batch_size=max_batch_size, fp16=self.fp16, bf16=self.bf16)
+        self.flow_batcher = MicroBatcher(self.flow_batch_job, max_batch_size=max_batch_size, window=batch_window,
+                                         num_active=lambda: len(self.session_dict))
+        self.hift_batcher = MicroBatcher(self.hift_batch_job, max_batch_size=max_batch_size, window=batch_window,
+                                         num_active=lambda: len(self.session_dict))
+
+    def flow_batch_job(self, flow_inputs, key):
+        # requests are only batched with the same stream mode and ode options
+        stream, flow_options = key[0], dict(key[1])
+        estimator = self.flow.decoder.estimator
+        # autocast is thread local, the one around flow_batcher in token2wav does not reach the batcher thread
+        with autocast(self.fp16, self.bf16):
+            if isinstance(estimator, torch.nn.Module) or (isinstance(estimator, OrtSessionWrapper) and estimator.dynamic_batch):
+                return self.flow.inference_batch(flow_inputs, streaming=stream, **flow_options)
+            # trt engine profile and fixed batch onnx only cover the cfg pair of one request, run one by one
+            return [self.flow.inference(**i, streaming=stream, **flow_options)[0] for i in flow_inputs]
+
+    def hift_batch_job(self, hift_inputs, key):
+        tts_speech, tts_source = self.hift.inference_batch(speech_feat=[i[0] for i in hift_inputs], cache_source=[i[1] for i in hift_inputs])
+        return list(zip(tts_speech, tts_source))
+
+    def hift_inference(self, speech_feat, cache_source):
+        if hasattr(self, 'hift_batcher'):
+            return self.hift_batcher((speech_feat, cache_source.to(self.device)))
+        return self.hift.inference(speech_feat=speech_feat, cache_source=cache_source)
+
     def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0):
-        with torch.cuda.amp.autocast(self.fp16):
-            tts_mel, _ = self.flow.inference(token=token.to(self.device),
-                                             token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_token=prompt_token.to(self.device),
-                                             prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_feat=prompt_feat.to(self.device),
-                                             prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
-                                             embedding=embedding.to(self.device),
-                                             streaming=stream,
-                                             finalize=finalize)
+        session = self.session_dict[uuid]
+        flow_input = {'token': token.to(self.device),
+                      'token_len': torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
+                      'prompt_token': prompt_token.to(self.device),
+                      'prompt_token_len': torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
+                      'prompt_feat': prompt_feat.to(self.device),
+                      'prompt_feat_len': torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
+                      'embedding': embedding.to(self.device),
+                      'finalize': finalize,
+                      # streaming chunks only encode new tokens, the last chunk uses full attention and is recomputed
+                      'encoder_cache': session.flow_encoder_cache if stream is True and finalize is False else None}
+        with autocast(self.fp16, self.bf16):
+            if hasattr(self, 'flow_batcher'):
+                tts_mel = self.flow_batcher(flow_input, key=(stream, tuple(sorted(session.flow_options.items()))))
+            else:
+                # decoder chunk cache is per request, so it is only used when flow is not batched across requests
+                tts_mel, _ = self.flow.inference(**flow_input, streaming=stream,
+                                                 decoder_cache=session.flow_decoder_cache if stream is True and finalize is False else None,
+                                                 **session.flow_options)
         tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
+        # streaming hift keeps conv, source phase and istft state, so every mel frame is vocoded once without cross fade
+        if self.stream_hift is True and (stream is True or len(session.hift_stream_cache) != 0):
+            assert speed == 1.0, 'speed change only support non-stream inference mode'
+            return self.hift.inference_chunk(speech_feat=tts_mel, cache=session.hift_stream_cache, finalize=finalize)
         # append hift cache
-        if self.hift_cache_dict[uuid] is not None:
-            hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
+        if session.hift_cache is not None:
+            hift_cache_mel, hift_cache_source = session.hift_cache['mel'], session.hift_cache['source']
             tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
         else:
             hift_cache_source = torch.zeros(1, 1, 0)
         # keep overlap mel and hift cache
         if finalize is False:
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
-            self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
-                                          'source': tts_source[:, :, -self.source_cache_len:],
-                                          'speech': tts_speech[:, -self.source_cache_len:]}
+            tts_speech, tts_source = self.hift_inference(speech_feat=tts_mel, cache_source=hift_cache_source)
+            if session.hift_cache is not None:
+                tts_speech = fade_in_out(tts_speech, session.hift_cache['speech'], self.speech_window)
+            session.hift_cache = {'mel': tts_mel[:, :, -self.mel_cache_len:],
+                                  'source': tts_source[:, :, -self.source_cache_len:],
+                                  'speech': tts_speech[:, -self.source_cache_len:]}
             tts_speech = tts_speech[:, :-self.source_cache_len]
         else:
             if speed != 1.0:
-                assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
+                assert session.hift_cache is None, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
+            tts_speech, tts_source = self.hift_inference(speech_feat=tts_mel, cache_source=hift_cache_source)
+            if session.hift_cache is not None:
+                tts_speech = fade_in_out(tts_speech, session.hift_cache['speech'], self.speech_window)
         return tts_speech
 
     def tts(self, text=torch.zeros(1, 0, dtype=torch.int32), flow_embedding=torch.zeros(0, 192), llm_embedding=torch.zeros(0, 192),
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
+            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, deadline=None,
+            n_timesteps=10, solver=None, t_scheduler=None, cfg_rate=None, cfg_interval=None, cancel_token=None, num_draft=None,
+            **kwargs):
         # this_uuid is used to track variables related to this inference thread
         this_uuid = str(uuid.uuid1())
+        flow_options = {'n_timesteps': n_timesteps, 'solver': solver, 't_scheduler': t_scheduler,
+                        'cfg_rate': tuple(cfg_rate) if isinstance(cfg_rate, list) else cfg_rate,
+                        'cfg_interval': tuple(cfg_interval) if cfg_interval is not None else None}
         with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
-            self.hift_cache_dict[this_uuid] = None
+            # a caller supplied cancel_token may be shared by several tts calls, so it is only observed through
+            # the session token, which is cancelled on exit
+            self.session_dict[this_uuid] = session = TTSSession(cancel_token=CancellationToken(deadline, parent=cancel_token), flow_options=flow_options,
+                                                                llm_options={} if num_draft is None else {'num_draft': num_draft})
         if source_speech_token.shape[1] == 0:
             p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
         else:
             p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
         p.start()
-        if stream is True:
-            token_offset = 0
-            prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
-            while True:
-                time.sleep(0.1)
-                this_token_hop_len = self.token_hop_len + prompt_token_pad if token_offset == 0 else self.token_hop_len
-                if len(self.tts_speech_token_dict[this_uuid]) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_offset + this_token_hop_len + self.flow.pre_lookahead_len]).unsqueeze(dim=0)
+        try:
+            if stream is True:
+                prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
+                while True:
+                    this_token_hop_len = self.token_hop_len + prompt_token_pad if session.token_offset == 0 else self.token_hop_len
+                    # wake up as soon as enough tokens are decoded, returns False once llm ends without enough tokens
+                    if session.wait(this_token_hop_len + self.flow.pre_lookahead_len) is False:
+                        break
+                    this_tts_speech_token = session.get_token(0, session.token_offset + this_token_hop_len + self.flow.pre_lookahead_len)
                     this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                                      prompt_token=flow_prompt_speech_token,
                                                      prompt_feat=prompt_speech_feat,
                                                      embedding=flow_embedding,
-                                                     token_offset=token_offset,
+                                                     token_offset=session.token_offset,
                                                      uuid=this_uuid,
                                                      stream=stream,
                                                      finalize=False)
-                    token_offset += this_token_hop_len
+                    session.token_offset += this_token_hop_len
                     yield {'tts_speech': this_tts_speech.cpu()}
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) - token_offset < this_token_hop_len + self.flow.pre_lookahead_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=token_offset,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
+                p.join()
+                if session.cancel_token.timeout():
+                    raise TimeoutError('tts {} exceeds its deadline'.format(this_uuid))
+                # cancelled by the caller, do not render the partial tokens
+                if session.cancel_token.cancelled():
+                    return
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                this_tts_speech_token = session.get_token()
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 token_offset=session.token_offset,
+                                                 uuid=this_uuid,
+                                                 finalize=True)
+                yield {'tts_speech': this_tts_speech.cpu()}
+            else:
+                # deal with all tokens
+                p.join()
+                if session.cancel_token.timeout():
+                    raise TimeoutError('tts {} exceeds its deadline'.format(this_uuid))
+                # cancelled by the caller, do not render the partial tokens
+                if session.cancel_token.cancelled():
+                    return
+                this_tts_speech_token = session.get_token()
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 token_offset=0,
+                                                 uuid=this_uuid,
+                                                 finalize=True,
+                                                 speed=speed)
+                yield {'tts_speech': this_tts_speech.cpu()}
+        finally:
+            # consumer stops iterating or an error is raised, stop llm decoding within one step
+            session.cancel_token.cancel()
             p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=0,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
+            with self.lock:
+                self.session_dict.pop(this_uuid)
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.current_stream().synchronize()
@@ -11,13 +11,13 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import Tuple
+from typing import Any, Dict, List, Optional, Tuple
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from einops import pack, rearrange, repeat
 from cosyvoice.utils.common import mask_to_bias
-from cosyvoice.utils.mask import add_optional_chunk_mask
+from cosyvoice.utils.mask import chunk_bias_cache, subsequent_chunk_mask_with_cache
 from matcha.models.components.decoder import SinusoidalPosEmb, Block1D, ResnetBlock1D, Downsample1D, TimestepEmbedding, Upsample1D
 from matcha.models.components.transformer import BasicTransformerBlock
 
@@ -61,6 +61,14 @@ class CausalConv1d(torch.nn.Conv1d):
         x = super(CausalConv1d, self).forward(x)
         return x
 
+    def forward_chunk(self, x: torch.Tensor, cache: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        # cache holds the last causal_padding input frames of previous chunk, None for the first chunk
+        if cache is None:
+            x = F.pad(x, (self.causal_padding, 0), value=0.0)
+        else:
+            x = torch.concat([cache, x], dim=2)
+        return super(CausalConv1d, self).forward(x), x[:, :, x.size(2) - self.causal_padding:]
+
 
 class CausalBlock1D(Block1D):
     def __init__(self, dim: int, dim_out: int):
@@ -77,6 +85,11 @@ class CausalBlock1D(Block1D):
         output = self.block(x * mask)
         return output * mask
 
+    def forward_chunk(self, x: torch.Tensor, mask: torch.Tensor, cache: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        output, new_cache = self.block[0].forward_chunk(x * mask, cache)
+        output = self.block[1:](output)
+        return output * mask, new_cache
+
 
 class CausalResnetBlock1D(ResnetBlock1D):
     def __init__(self, dim: int, dim_out: int, time_emb_dim: int, groups: int = 8):
@@ -84,6 +97,15 @@ class CausalResnetBlock1D(ResnetBlock1D):
         self.block1 = CausalBlock1D(dim, dim_out)
         self.block2 = CausalBlock1D(dim_out, dim_out)
 
+    def forward_chunk(self, x: torch.Tensor, mask: torch.Tensor, time_emb: torch.Tensor,
+                      cache: Optional[List[torch.Tensor]] = None) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+        cache = cache if cache is not None else [None, None]
+        h, block1_cache = self.block1.forward_chunk(x, mask, cache[0])
+        h += self.mlp(time_emb).unsqueeze(-1)
+        h, block2_cache = self.block2.forward_chunk(h, mask, cache[1])
+        output = h + self.res_conv(x * mask)
+        return output, [block1_cache, block2_cache]
+
 
 class ConditionalDecoder(nn.Module):
     def __init__(
@@ -207,6 +229,22 @@ class ConditionalDecoder(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
 
+    @staticmethod
+    def get_attn_bias(mask: torch.Tensor, dtype: torch.dtype, chunk_size: int, attn_biases: Dict[int, torch.Tensor]) -> torch.Tensor:
+        """Additive attention bias of padding mask (B, 1, T), it is broadcast over queries for full
+        context and (B, T, T) with the static chunk bias otherwise. The chunk bias comes from an LRU
+        shared by all ode steps and requests, the result is memorized in attn_biases per length.
+        """
+        # x stays fp32 under cpu bf16 autocast while attention runs in bf16, build the bias in the attention dtype
+        if torch.is_autocast_cpu_enabled():
+            dtype = torch.get_autocast_cpu_dtype()
+        if mask.size(2) not in attn_biases:
+            bias = mask_to_bias(mask.bool(), dtype)
+            if chunk_size > 0:
+                bias = bias + chunk_bias_cache.get(mask.size(2), chunk_size, dtype, mask.device)
+            attn_biases[mask.size(2)] = bias
+        return attn_biases[mask.size(2)]
+
     def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False):
         """Forward pass of the UNet1DConditional model.
 
@@ -238,12 +276,13 @@ class ConditionalDecoder(nn.Module):
 
         hiddens = []
         masks = [mask]
+        # attention bias of every length, shared by all transformer blocks
+        attn_biases = {}
         for resnet, transformer_blocks, downsample in self.down_blocks:
             mask_down = masks[-1]
             x = resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = self.get_attn_bias(mask_down, x.dtype, 0, attn_biases)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -260,8 +299,7 @@ class ConditionalDecoder(nn.Module):
         for resnet, transformer_blocks in self.mid_blocks:
             x = resnet(x, mask_mid, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = self.get_attn_bias(mask_mid, x.dtype, 0, attn_biases)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -276,8 +314,7 @@ class ConditionalDecoder(nn.Module):
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
             x = resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = self.get_attn_bias(mask_up, x.dtype, 0, attn_biases)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -432,15 +469,13 @@ class CausalConditionalDecoder(ConditionalDecoder):
 
         hiddens = []
         masks = [mask]
+        # attention bias of every length, shared by all transformer blocks
+        attn_biases = {}
         for resnet, transformer_blocks, downsample in self.down_blocks:
             mask_down = masks[-1]
             x = resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = self.get_attn_bias(mask_down, x.dtype, self.static_chunk_size if streaming is True else 0, attn_biases)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -457,11 +492,7 @@ class CausalConditionalDecoder(ConditionalDecoder):
         for resnet, transformer_blocks in self.mid_blocks:
             x = resnet(x, mask_mid, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = self.get_attn_bias(mask_mid, x.dtype, self.static_chunk_size if streaming is True else 0, attn_biases)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -476,11 +507,7 @@ class CausalConditionalDecoder(ConditionalDecoder):
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
             x = resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = self.get_attn_bias(mask_up, x.dtype, self.static_chunk_size if streaming is True else 0, attn_biases)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -492,3 +519,97 @@ class CausalConditionalDecoder(ConditionalDecoder):
         x = self.final_block(x, mask_up)
         output = self.final_proj(x * mask_up)
         return output * mask
+
+    def forward_chunk(self, x, mask, mu, t, spks=None, cond=None, cache: Optional[Dict[str, Any]] = None):
+        """Streaming forward of the new frames only, equivalent to forward with streaming=True
+        over all frames seen so far when every previous chunk ends on a static_chunk_size boundary.
+
+        Args:
+            x, mask, mu, cond: new frames only, shape (batch_size, *, new_time)
+            t, spks: same as forward
+            cache: returned by previous call of the same ode step, None or empty dict for the first chunk.
+                It keeps the number of cached frames, the left context of every causal conv and
+                the attention key & value of every transformer block.
+
+        Returns:
+            output of new frames (batch_size, out_channels, new_time) and the cache for next chunk
+        """
+        assert len(self.down_blocks) == 1, 'forward_chunk does not support downsampling'
+        cache = cache if cache is not None else {}
+        offset = cache.get('offset', 0)
+        assert offset % self.static_chunk_size == 0, 'previous chunk should end on a static_chunk_size boundary'
+        conv_cache, att_cache = iter(cache.get('conv', [])), iter(cache.get('att', []))
+        new_conv_cache, new_att_cache = [], []
+        t = self.time_embeddings(t).to(t.dtype)
+        t = self.time_mlp(t)
+
+        x = pack([x, mu], "b * t")[0]
+
+        if spks is not None:
+            spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
+            x = pack([x, spks], "b * t")[0]
+        if cond is not None:
+            x = pack([x, cond], "b * t")[0]
+        # no downsampling, all blocks share the same chunk mask
+        attn_mask = subsequent_chunk_mask_with_cache(offset, x.size(2), self.static_chunk_size, x.device).unsqueeze(0).unsqueeze(0)
+
+        hiddens = []
+        for resnet, transformer_blocks, downsample in self.down_blocks:
+            x, this_cache = resnet.forward_chunk(x, mask, t, next(conv_cache, None))
+            new_conv_cache.append(this_cache)
+            x = rearrange(x, "b c t -> b t c").contiguous()
+            for transformer_block in transformer_blocks:
+                x, this_cache = self.forward_transformer_chunk(transformer_block, x, attn_mask, next(att_cache, None))
+                new_att_cache.append(this_cache)
+            x = rearrange(x, "b t c -> b c t").contiguous()
+            hiddens.append(x)  # Save hidden states for skip connections
+            x, this_cache = downsample.forward_chunk(x * mask, next(conv_cache, None))
+            new_conv_cache.append(this_cache)
+
+        for resnet, transformer_blocks in self.mid_blocks:
+            x, this_cache = resnet.forward_chunk(x, mask, t, next(conv_cache, None))
+            new_conv_cache.append(this_cache)
+            x = rearrange(x, "b c t -> b t c").contiguous()
+            for transformer_block in transformer_blocks:
+                x, this_cache = self.forward_transformer_chunk(transformer_block, x, attn_mask, next(att_cache, None))
+                new_att_cache.append(this_cache)
+            x = rearrange(x, "b t c -> b c t").contiguous()
+
+        for resnet, transformer_blocks, upsample in self.up_blocks:
+            skip = hiddens.pop()
+            x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
+            x, this_cache = resnet.forward_chunk(x, mask, t, next(conv_cache, None))
+            new_conv_cache.append(this_cache)
+            x = rearrange(x, "b c t -> b t c").contiguous()
+            for transformer_block in transformer_blocks:
+                x, this_cache = self.forward_transformer_chunk(transformer_block, x, attn_mask, next(att_cache, None))
+                new_att_cache.append(this_cache)
+            x = rearrange(x, "b t c -> b c t").contiguous()
+            x, this_cache = upsample.forward_chunk(x * mask, next(conv_cache, None))
+            new_conv_cache.append(this_cache)
+        x, this_cache = self.final_block.forward_chunk(x, mask, next(conv_cache, None))
+        new_conv_cache.append(this_cache)
+        output = self.final_proj(x * mask)
+        return output * mask, {'offset': offset + x.size(2), 'conv': new_conv_cache, 'att': new_att_cache}
+
+    @staticmethod
+    def forward_transformer_chunk(transformer_block, x, attn_mask, cache=None):
+        """Same as BasicTransformerBlock.forward without cross attention, key & value
+        of the new frames are appended to cache instead of recomputed for cached frames.
+        """
+        attn = transformer_block.attn1
+        norm_hidden_states = transformer_block.norm1(x)
+        query, key, value = attn.to_q(norm_hidden_states), attn.to_k(norm_hidden_states), attn.to_v(norm_hidden_states)
+        if cache is not None:
+            key, value = torch.concat([cache[0], key], dim=1), torch.concat([cache[1], value], dim=1)
+        new_cache = (key, value)
+        batch_size, head_dim = x.size(0), key.size(-1) // attn.heads
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        attn_output = F.scaled_dot_product_attention(query, key, value, attn_mask=mask_to_bias(attn_mask, query.dtype))
+        attn_output = attn_output.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+        attn_output = attn.to_out[1](attn.to_out[0](attn_output))
+        x = attn_output + x
+        x = transformer_block.ff(transformer_block.norm3(x)) + x
+        return x, new_cache
@@ -13,7 +13,7 @@
 # limitations under the License.
 import logging
 import random
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
@@ -110,7 +110,12 @@ class MaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  flow_cache):
+                  flow_cache,
+                  n_timesteps=10,
+                  solver=None,
+                  t_scheduler=None,
+                  cfg_rate=None,
+                  cfg_interval=None):
         assert token.shape[0] == 1
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
@@ -139,9 +144,13 @@ class MaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
+            n_timesteps=n_timesteps,
             prompt_len=mel_len1,
-            cache=flow_cache
+            cache=flow_cache,
+            solver=solver,
+            t_scheduler=t_scheduler,
+            cfg_rate=cfg_rate,
+            cfg_interval=cfg_interval
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
@@ -232,18 +241,8 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         )
         return {'loss': loss}
 
-    @torch.inference_mode()
-    def inference(self,
-                  token,
-                  token_len,
-                  prompt_token,
-                  prompt_token_len,
-                  prompt_feat,
-                  prompt_feat_len,
-                  embedding,
-                  streaming,
-                  finalize):
-        assert token.shape[0] == 1
+    def prepare_decoder_input(self, token, token_len, prompt_token, prompt_token_len, prompt_feat, embedding, streaming, finalize,
+                              encoder_cache=None):
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
         embedding = self.spk_embed_affine_layer(embedding)
@@ -258,7 +257,10 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
             h, h_lengths = self.encoder(token, token_len, streaming=streaming)
         else:
             token, context = token[:, :-self.pre_lookahead_len], token[:, -self.pre_lookahead_len:]
-            h, h_lengths = self.encoder(token, token_len, context=context, streaming=streaming)
+            if encoder_cache is not None and streaming is True and hasattr(self.encoder, 'forward_chunk'):
+                h = self.encode_chunk(token, context, encoder_cache)
+            else:
+                h, h_lengths = self.encoder(token, token_len, context=context, streaming=streaming)
         mel_len1, mel_len2 = prompt_feat.shape[1], h.shape[1] - prompt_feat.shape[1]
         h = self.encoder_proj(h)
 
@@ -266,16 +268,127 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
         conds[:, :mel_len1] = prompt_feat
         conds = conds.transpose(1, 2)
+        return h.transpose(1, 2).contiguous(), conds, embedding, mel_len1, mel_len2
 
-        mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(h)
-        feat, _ = self.decoder(
-            mu=h.transpose(1, 2).contiguous(),
-            mask=mask.unsqueeze(1),
+    def encode_chunk(self, token, context, encoder_cache):
+        """Encode only the tokens after encoder_cache['offset'], encoder_cache is updated in place.
+
+        Encoder outputs of previous chunks are kept in the cache, so the returned h covers all
+        tokens exactly like a full recompute while the per chunk cost no longer grows with history.
+        """
+        h, new_cache = self.encoder.forward_chunk(token[:, encoder_cache.get('offset', 0):], context, encoder_cache)
+        if 'h' in encoder_cache:
+            h = torch.concat([encoder_cache['h'], h], dim=1)
+        encoder_cache.update(new_cache)
+        encoder_cache['h'] = h
+        return h
+
+    def decode_chunk(self, mu, mask, embedding, conds, decoder_cache, n_timesteps=10, solver=None, t_scheduler=None, cfg_rate=None, cfg_interval=None):
+        """Run the decoder on frames after decoder_cache['offset'] only, decoder_cache is updated in place.
+
+        Every estimator call keeps its own attention key & value and causal conv context of finished chunks,
+        so n_timesteps, solver and cfg options must stay the same for all chunks of one utterance.
+        """
+        offset = decoder_cache.get('offset', 0)
+        feat, estimator_cache = self.decoder(
+            mu=mu[:, :, offset:],
+            mask=mask[:, :, offset:],
             spks=embedding,
-            cond=conds,
-            n_timesteps=10,
-            streaming=streaming
+            cond=conds[:, :, offset:],
+            n_timesteps=n_timesteps,
+            streaming=True,
+            cache=decoder_cache.get('estimator', []),
+            solver=solver,
+            t_scheduler=t_scheduler,
+            cfg_rate=cfg_rate,
+            cfg_interval=cfg_interval
         )
+        if 'feat' in decoder_cache:
+            feat = torch.concat([decoder_cache['feat'], feat], dim=2)
+        decoder_cache.update({'offset': feat.size(2), 'estimator': estimator_cache, 'feat': feat})
+        return feat
+
+    @torch.inference_mode()
+    def inference(self,
+                  token,
+                  token_len,
+                  prompt_token,
+                  prompt_token_len,
+                  prompt_feat,
+                  prompt_feat_len,
+                  embedding,
+                  streaming,
+                  finalize,
+                  encoder_cache=None,
+                  decoder_cache=None,
+                  n_timesteps=10,
+                  solver=None,
+                  t_scheduler=None,
+                  cfg_rate=None,
+                  cfg_interval=None):
+        assert token.shape[0] == 1
+        mu, conds, embedding, mel_len1, mel_len2 = self.prepare_decoder_input(token, token_len, prompt_token, prompt_token_len,
+                                                                              prompt_feat, embedding, streaming, finalize,
+                                                                              encoder_cache=encoder_cache)
+        mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(mu)
+        if decoder_cache is not None and streaming is True and finalize is False and isinstance(self.decoder.estimator, torch.nn.Module):
+            feat = self.decode_chunk(mu, mask.unsqueeze(1), embedding, conds, decoder_cache,
+                                     n_timesteps=n_timesteps, solver=solver, t_scheduler=t_scheduler,
+                                     cfg_rate=cfg_rate, cfg_interval=cfg_interval)
+        else:
+            feat, _ = self.decoder(
+                mu=mu,
+                mask=mask.unsqueeze(1),
+                spks=embedding,
+                cond=conds,
+                n_timesteps=n_timesteps,
+                streaming=streaming,
+                solver=solver,
+                t_scheduler=t_scheduler,
+                cfg_rate=cfg_rate,
+                cfg_interval=cfg_interval
+            )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
         return feat.float(), None
+
+    @torch.inference_mode()
+    def inference_batch(self, inputs: List[Dict], streaming, n_timesteps=10, solver=None, t_scheduler=None, cfg_rate=None, cfg_interval=None):
+        """Run inference for several utterances at once.
+
+        Each element of inputs holds the kwargs of inference except streaming and the ode options,
+        which are shared by the whole batch. Text encoding
+        is done one by one, decoder inputs are right padded so that every ode step runs a
+        single estimator call for the whole batch. Causal convolutions and the padding mask
+        keep padded frames from leaking into valid frames.
+        """
+        mu, conds, embedding, mel_len1, mel_len2 = [], [], [], [], []
+        for i in inputs:
+            assert i['token'].shape[0] == 1
+            this_mu, this_conds, this_embedding, this_mel_len1, this_mel_len2 = self.prepare_decoder_input(
+                i['token'], i['token_len'], i['prompt_token'], i['prompt_token_len'], i['prompt_feat'], i['embedding'], streaming, i['finalize'],
+                encoder_cache=i.get('encoder_cache'))
+            mu.append(this_mu)
+            conds.append(this_conds)
+            embedding.append(this_embedding)
+            mel_len1.append(this_mel_len1)
+            mel_len2.append(this_mel_len2)
+        mel_len = torch.tensor([i + j for i, j in zip(mel_len1, mel_len2)])
+        max_len = mel_len.max().item()
+        mu = torch.concat([F.pad(i, (0, max_len - i.shape[2])) for i in mu], dim=0)
+        conds = torch.concat([F.pad(i, (0, max_len - i.shape[2])) for i in conds], dim=0)
+        embedding = torch.concat(embedding, dim=0)
+        mask = (~make_pad_mask(mel_len, max_len)).to(mu)
+        feat, _ = self.decoder(
+            mu=mu,
+            mask=mask.unsqueeze(1),
+            spks=embedding,
+            cond=conds,
+            n_timesteps=n_timesteps,
+            streaming=streaming,
+            solver=solver,
+            t_scheduler=t_scheduler,
+            cfg_rate=cfg_rate,
+            cfg_interval=cfg_interval
+        )
+        return [feat[i:i + 1, :, mel_len1[i]:mel_len1[i] + mel_len2[i]].float() for i in range(len(inputs))]
@@ -15,7 +15,66 @@
 import torch
 import torch.nn.functional as F
 from matcha.models.components.flow_matching import BASECFM
-from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.utils.common import set_all_random_seed, OrtSessionWrapper
+
+# every solver calls estimator(x, t, step) where step is the index of the solver step,
+# classifier-free guidance rate is chosen per step
+SOLVERS = {}
+
+
+def register_solver(name):
+    def decorator(fn):
+        SOLVERS[name] = fn
+        return fn
+    return decorator
+
+
+@register_solver('euler')
+def solve_euler(estimator, x, t_span):
+    """First order, one estimator call per step."""
+    for step in range(1, len(t_span)):
+        t, dt = t_span[step - 1], t_span[step] - t_span[step - 1]
+        x = x + dt * estimator(x, t, step - 1)
+    return x
+
+
+@register_solver('midpoint')
+def solve_midpoint(estimator, x, t_span):
+    """Second order, two estimator calls per step."""
+    for step in range(1, len(t_span)):
+        t, dt = t_span[step - 1], t_span[step] - t_span[step - 1]
+        x_mid = x + 0.5 * dt * estimator(x, t, step - 1)
+        x = x + dt * estimator(x_mid, t + 0.5 * dt, step - 1)
+    return x
+
+
+@register_solver('heun')
+def solve_heun(estimator, x, t_span):
+    """Second order, two estimator calls per step."""
+    for step in range(1, len(t_span)):
+        t, dt = t_span[step - 1], t_span[step] - t_span[step - 1]
+        dphi_dt = estimator(x, t, step - 1)
+        x_pred = x + dt * dphi_dt
+        x = x + 0.5 * dt * (dphi_dt + estimator(x_pred, t + dt, step - 1))
+    return x
+
+
+@register_solver('multistep')
+def solve_multistep(estimator, x, t_span):
+    """Second order multistep in the style of DPM-Solver++(2M), reuses the previous
+    velocity so only one estimator call per step is needed. First step falls back to euler.
+    """
+    last_dphi_dt, last_dt = None, None
+    for step in range(1, len(t_span)):
+        t, dt = t_span[step - 1], t_span[step] - t_span[step - 1]
+        dphi_dt = estimator(x, t, step - 1)
+        if last_dphi_dt is None:
+            x = x + dt * dphi_dt
+        else:
+            r = dt / last_dt
+            x = x + dt * ((1 + 0.5 * r) * dphi_dt - 0.5 * r * last_dphi_dt)
+        last_dphi_dt, last_dt = dphi_dt, dt
+    return x
 
 
 class ConditionalCFM(BASECFM):
@@ -34,7 +93,8 @@ class ConditionalCFM(BASECFM):
         self.estimator = estimator
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, cache=torch.zeros(1, 80, 0, 2)):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, cache=torch.zeros(1, 80, 0, 2),
+                solver=None, t_scheduler=None, cfg_rate=None, cfg_interval=None):
         """Forward diffusion
 
         Args:
@@ -47,6 +107,10 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): ode solver, cfm_params.solver is used when None. Defaults to None.
+            t_scheduler (str, optional): linear or cosine, cfm_params.t_scheduler is used when None. Defaults to None.
+            cfg_rate (float or list, optional): see get_cfg_rates. Defaults to None.
+            cfg_interval (tuple, optional): see get_cfg_rates. Defaults to None.
 
         Returns:
             sample: generated mel-spectrogram
@@ -63,14 +127,53 @@ class ConditionalCFM(BASECFM):
         mu_cache = torch.concat([mu[:, :, :prompt_len], mu[:, :, -34:]], dim=2)
         cache = torch.stack([z_cache, mu_cache], dim=-1)
 
+        t_span = self.get_t_span(n_timesteps, mu, t_scheduler)
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, solver=solver,
+                          cfg_rate=cfg_rate, cfg_interval=cfg_interval), cache
+
+    def get_t_span(self, n_timesteps, mu, t_scheduler=None):
+        t_scheduler = self.t_scheduler if t_scheduler is None else t_scheduler
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
-        if self.t_scheduler == 'cosine':
+        if t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), cache
+        elif t_scheduler != 'linear':
+            raise ValueError('unsupported t_scheduler {}'.format(t_scheduler))
+        return t_span
 
-    def solve_euler(self, x, t_span, mu, mask, spks, cond, streaming=False):
+    def get_cfg_rates(self, t_span, cfg_rate=None, cfg_interval=None):
+        """Classifier-free guidance rate of every solver step.
+
+        Args:
+            t_span (torch.Tensor): shape: (n_timesteps + 1,)
+            cfg_rate (float or list, optional): one rate for all steps, or one rate per step,
+                inference_cfg_rate is used when None. 0 turns guidance off. Defaults to None.
+            cfg_interval (tuple, optional): (t_start, t_end), guidance is only applied to steps
+                starting in [t_start, t_end). Defaults to None.
+
+        Returns:
+            list of float: shape: (n_timesteps,)
         """
-        Fixed euler solver for ODEs.
+        n_timesteps = len(t_span) - 1
+        cfg_rate = self.inference_cfg_rate if cfg_rate is None else cfg_rate
+        if isinstance(cfg_rate, (list, tuple)):
+            if len(cfg_rate) != n_timesteps:
+                raise ValueError('cfg_rate has {} steps but n_timesteps is {}'.format(len(cfg_rate), n_timesteps))
+            cfg_rates = [float(i) for i in cfg_rate]
+        else:
+            cfg_rates = [float(cfg_rate)] * n_timesteps
+        if cfg_interval is not None:
+            t_start, t_end = cfg_interval
+            cfg_rates = [rate if t_start <= t < t_end else 0.0 for rate, t in zip(cfg_rates, t_span[:-1].tolist())]
+        return cfg_rates
+
+    def support_batch_size(self, batch_size):
+        if isinstance(self.estimator, torch.nn.Module):
+            return True
+        return self.estimator.min_batch_size <= batch_size
+
+    def solve(self, x, t_span, mu, mask, spks, cond, streaming=False, cache=None, solver=None, cfg_rate=None, cfg_interval=None):
+        """
+        Fixed step solver for ODEs, see SOLVERS for the available methods.
         Args:
             x (torch.Tensor): random noise
             t_span (torch.Tensor): n_timesteps interpolated
@@ -82,60 +185,83 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            cache (list, optional): estimator chunk cache of every estimator call, only new frames are passed in
+                and the list is updated in place. Defaults to None.
+            solver (str, optional): name of the solver, cfm_params.solver is used when None. Defaults to None.
+            cfg_rate (float or list, optional): see get_cfg_rates. Defaults to None.
+            cfg_interval (tuple, optional): see get_cfg_rates. Defaults to None.
         """
-        t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
-        t = t.unsqueeze(dim=0)
-
-        # I am storing this because I can later plot it by putting a debugger here and saving it to a file
-        # Or in future might add like a return_all_steps flag
-        sol = []
+        solver = self.solver if solver is None else solver
+        if solver not in SOLVERS:
+            raise ValueError('unsupported solver {}, choose from {}'.format(solver, list(SOLVERS.keys())))
+        cfg_rates = self.get_cfg_rates(t_span, cfg_rate, cfg_interval)
 
         # Do not use concat, it may cause memory format changed and trt infer with wrong results!
-        x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        mask_in = torch.zeros([2, 1, x.size(2)], device=x.device, dtype=x.dtype)
-        mu_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        t_in = torch.zeros([2], device=x.device, dtype=x.dtype)
-        spks_in = torch.zeros([2, 80], device=x.device, dtype=x.dtype)
-        cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        for step in range(1, len(t_span)):
+        # first half of the batch is conditional, second half is unconditional for cfg
+        batch_size = x.size(0)
+        x_in = torch.zeros([2 * batch_size, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        mask_in = torch.zeros([2 * batch_size, 1, x.size(2)], device=x.device, dtype=x.dtype)
+        mu_in = torch.zeros([2 * batch_size, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        t_in = torch.zeros([2 * batch_size], device=x.device, dtype=x.dtype)
+        spks_in = torch.zeros([2 * batch_size, 80], device=x.device, dtype=x.dtype)
+        cond_in = torch.zeros([2 * batch_size, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        mask_in[:batch_size] = mask
+        mask_in[batch_size:] = mask
+        mu_in[:batch_size] = mu
+        spks_in[:batch_size] = spks
+        cond_in[:batch_size] = cond
+        num_call = 0
+
+        def estimator(x, t, step):
+            nonlocal num_call
             # Classifier-Free Guidance inference introduced in VoiceBox
-            x_in[:] = x
-            mask_in[:] = mask
-            mu_in[0] = mu
-            t_in[:] = t.unsqueeze(0)
-            spks_in[0] = spks
-            cond_in[0] = cond
-            dphi_dt = self.forward_estimator(
-                x_in, mask_in,
-                mu_in, t_in,
-                spks_in,
-                cond_in,
-                streaming
-            )
-            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
-            x = x + dt * dphi_dt
-            t = t + dt
-            sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
+            rate = cfg_rates[step]
+            # without guidance only the conditional half of the buffers is used, the slices stay contiguous
+            n = batch_size if rate == 0 and self.support_batch_size(batch_size) else 2 * batch_size
+            x_in[:batch_size] = x
+            if n != batch_size:
+                x_in[batch_size:] = x
+            t_in[:] = t
+            if cache is not None:
+                # only pytorch estimator supports chunk cache, one cache for every estimator call,
+                # the batch size of every call is the same for all chunks
+                if len(cache) <= num_call:
+                    cache.append(None)
+                dphi_dt, cache[num_call] = self.estimator.forward_chunk(x_in[:n], mask_in[:n], mu_in[:n], t_in[:n], spks_in[:n], cond_in[:n],
+                                                                        cache=cache[num_call])
+            else:
+                dphi_dt = self.forward_estimator(
+                    x_in[:n], mask_in[:n],
+                    mu_in[:n], t_in[:n],
+                    spks_in[:n],
+                    cond_in[:n],
+                    streaming
+                )
+            num_call += 1
+            if n == batch_size:
+                return dphi_dt
+            # keep dphi_dt referenced while its views are used, onnxruntime reuses released output buffers
+            cond_dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [batch_size, batch_size], dim=0)
+            return (1.0 + rate) * cond_dphi_dt - rate * cfg_dphi_dt
 
-        return sol[-1].float()
+        return SOLVERS[solver](estimator, x, t_span).float()
 
     def forward_estimator(self, x, mask, mu, t, spks, cond, streaming=False):
         if isinstance(self.estimator, torch.nn.Module):
             return self.estimator(x, mask, mu, t, spks, cond, streaming=streaming)
+        elif isinstance(self.estimator, OrtSessionWrapper):
+            return self.estimator.run({'x': x, 'mask': mask, 'mu': mu, 't': t, 'spks': spks, 'cond': cond}, 'estimator_out', x.shape).to(x.dtype)
         else:
             [estimator, stream], trt_engine = self.estimator.acquire_estimator()
             # NOTE need to synchronize when switching stream
             torch.cuda.current_stream().synchronize()
             with stream:
-                estimator.set_input_shape('x', (2, 80, x.size(2)))
-                estimator.set_input_shape('mask', (2, 1, x.size(2)))
-                estimator.set_input_shape('mu', (2, 80, x.size(2)))
-                estimator.set_input_shape('t', (2,))
-                estimator.set_input_shape('spks', (2, 80))
-                estimator.set_input_shape('cond', (2, 80, x.size(2)))
+                estimator.set_input_shape('x', (x.size(0), 80, x.size(2)))
+                estimator.set_input_shape('mask', (x.size(0), 1, x.size(2)))
+                estimator.set_input_shape('mu', (x.size(0), 80, x.size(2)))
+                estimator.set_input_shape('t', (x.size(0),))
+                estimator.set_input_shape('spks', (x.size(0), 80))
+                estimator.set_input_shape('cond', (x.size(0), 80, x.size(2)))
                 data_ptrs = [x.contiguous().data_ptr(),
                              mask.contiguous().data_ptr(),
                              mu.contiguous().data_ptr(),
@@ -200,7 +326,8 @@ class CausalConditionalCFM(ConditionalCFM):
         self.rand_noise = torch.randn([1, 80, 50 * 300])
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, streaming=False):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, streaming=False, cache=None, solver=None, t_scheduler=None,
+                cfg_rate=None, cfg_interval=None):
         """Forward diffusion
 
         Args:
@@ -213,15 +340,24 @@ class CausalConditionalCFM(ConditionalCFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            cache (list, optional): streaming chunk cache returned by previous call, mu, mask and cond
+                only hold the new frames when it is given. Empty list for the first chunk. Defaults to None.
+            solver (str, optional): ode solver, cfm_params.solver is used when None. Defaults to None.
+            t_scheduler (str, optional): linear or cosine, cfm_params.t_scheduler is used when None. Defaults to None.
+            cfg_rate (float or list, optional): see get_cfg_rates. Defaults to None.
+            cfg_interval (tuple, optional): see get_cfg_rates. Defaults to None.
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
+            cache: chunk cache for the next call, None if cache is not given
         """
 
-        z = self.rand_noise[:, :, :mu.size(2)].to(mu.device).to(mu.dtype) * temperature
+        offset = cache[0]['offset'] if cache else 0
+        z = self.rand_noise[:, :, offset:offset + mu.size(2)].repeat(mu.size(0), 1, 1).to(mu.device).to(mu.dtype) * temperature
         # fix prompt and overlap part mu and z
-        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
-        if self.t_scheduler == 'cosine':
-            t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming), None
+        t_span = self.get_t_span(n_timesteps, mu, t_scheduler)
+        if cache is not None:
+            cache = list(cache)
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming, cache=cache, solver=solver,
+                          cfg_rate=cfg_rate, cfg_interval=cfg_interval), cache
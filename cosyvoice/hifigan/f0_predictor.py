@@ -17,6 +17,7 @@ try:
     from torch.nn.utils.parametrizations import weight_norm
 except ImportError:
     from torch.nn.utils import weight_norm
+from cosyvoice.utils.common import fold_weight_norm
 
 
 class ConvRNNF0Predictor(nn.Module):
@@ -52,6 +53,11 @@ class ConvRNNF0Predictor(nn.Module):
         )
         self.classifier = nn.Linear(in_features=cond_channels, out_features=self.num_class)
 
+    def remove_weight_norm(self):
+        for l in self.condnet:
+            if isinstance(l, nn.Conv1d):
+                fold_weight_norm(l)
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = self.condnet(x)
         x = x.transpose(1, 2)
@@ -14,7 +14,7 @@
 
 """HIFI-GAN"""
 
-from typing import Dict, Optional, List
+from typing import Dict, Optional, List, Tuple
 import numpy as np
 from scipy.signal import get_window
 import torch
@@ -22,7 +22,6 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import Conv1d
 from torch.nn import ConvTranspose1d
-from torch.nn.utils import remove_weight_norm
 try:
     from torch.nn.utils.parametrizations import weight_norm
 except ImportError:
@@ -32,6 +31,7 @@ from torch.distributions.uniform import Uniform
 from cosyvoice.transformer.activation import Snake
 from cosyvoice.utils.common import get_padding
 from cosyvoice.utils.common import init_weights
+from cosyvoice.utils.common import fold_weight_norm
 
 
 """hifigan based generator implementation.
@@ -43,6 +43,56 @@ This code is modified from https://github.com/jik876/hifi-gan
 """
 
 
+def stream_conv1d(conv: nn.Conv1d, x: torch.Tensor, cache: Dict, key: str, finalize: bool) -> torch.Tensor:
+    """Streaming Conv1d with symmetric zero padding.
+
+    Only outputs whose receptive field is complete are returned, inputs which are still
+    needed by later outputs are kept in cache[key]. Concatenating the outputs of all calls
+    equals conv(x) over the whole input.
+    """
+    padding, stride, dilation = conv.padding[0], conv.stride[0], conv.dilation[0]
+    span = dilation * (conv.kernel_size[0] - 1) + 1
+    x = F.pad(x, (padding, 0)) if key not in cache else torch.concat([cache[key], x], dim=2)
+    if finalize:
+        x = F.pad(x, (0, padding))
+    n = (x.size(2) - span) // stride + 1 if x.size(2) >= span else 0
+    cache[key] = x[:, :, n * stride:]
+    if n == 0:
+        return x.new_zeros(x.size(0), conv.out_channels, 0)
+    return F.conv1d(x[:, :, :(n - 1) * stride + span], conv.weight, conv.bias, stride, 0, dilation, conv.groups)
+
+
+def stream_conv_transpose1d(conv: nn.ConvTranspose1d, x: torch.Tensor, cache: Dict, key: str, finalize: bool) -> torch.Tensor:
+    """Streaming ConvTranspose1d, the kernel_size - stride overlap tail is added to the next call."""
+    stride, padding = conv.stride[0], conv.padding[0]
+    tail = cache.get(key, x.new_zeros(x.size(0), conv.out_channels, 0))
+    if x.size(2) != 0:
+        y = F.conv_transpose1d(x, conv.weight, None, stride, 0, 0, conv.groups, conv.dilation[0])
+        y[:, :, :tail.size(2)] += tail
+    else:
+        y = tail
+    n = y.size(2) if finalize else x.size(2) * stride
+    y, cache[key] = y[:, :, :n], y[:, :, n:]
+    y = y + conv.bias.unsqueeze(-1)
+    # padding crops the first and last padding outputs of the whole sequence
+    skip = cache.get(key + '.skip', padding)
+    cache[key + '.skip'] = skip - min(skip, y.size(2))
+    y = y[:, :, min(skip, y.size(2)):]
+    if finalize:
+        y = y[:, :, :max(y.size(2) - padding, 0)]
+    return y
+
+
+def stream_add(xs: List[torch.Tensor], cache: Dict, key: str) -> torch.Tensor:
+    """Sum of streams which have outputted different number of frames, the frames that
+    can not be added yet are kept in cache[key]."""
+    if key in cache:
+        xs = [torch.concat([i, j], dim=2) for i, j in zip(cache[key], xs)]
+    n = min(i.size(2) for i in xs)
+    cache[key] = [i[:, :, n:] for i in xs]
+    return sum(i[:, :, :n] for i in xs)
+
+
 class ResBlock(torch.nn.Module):
     """Residual block module in HiFiGAN/BigVGAN."""
     def __init__(
@@ -100,10 +150,19 @@ class ResBlock(torch.nn.Module):
             x = xt + x
         return x
 
+    def forward_chunk(self, x: torch.Tensor, cache: Dict, finalize: bool) -> torch.Tensor:
+        for idx in range(len(self.convs1)):
+            xt = self.activations1[idx](x)
+            xt = stream_conv1d(self.convs1[idx], xt, cache, 'convs1.{}'.format(idx), finalize)
+            xt = self.activations2[idx](xt)
+            xt = stream_conv1d(self.convs2[idx], xt, cache, 'convs2.{}'.format(idx), finalize)
+            x = stream_add([xt, x], cache, 'residual.{}'.format(idx))
+        return x
+
     def remove_weight_norm(self):
         for idx in range(len(self.convs1)):
-            remove_weight_norm(self.convs1[idx])
-            remove_weight_norm(self.convs2[idx])
+            fold_weight_norm(self.convs1[idx])
+            fold_weight_norm(self.convs2[idx])
 
 
 class SineGen(torch.nn.Module):
@@ -338,6 +397,47 @@ class SineGen2(torch.nn.Module):
         sine_waves = sine_waves * uv + noise
         return sine_waves, uv, noise
 
+    def forward_chunk(self, f0, cache, finalize):
+        """ sine_tensor, uv = forward_chunk(f0)
+        input F0: tensor(batchsize, frames, dim=1), frame level f0 of new frames,
+                  forward upsamples it by nearest interpolation before calling SineGen2
+        output sine_tensor: tensor(batchsize, length, dim)
+        output uv: tensor(batchsize, length, 1)
+
+        Same as forward on the upsampled f0 of all frames seen so far. Instantaneous phase
+        is accumulated across calls, the linear phase upsampling looks one frame ahead, so
+        the last frame is kept in cache until next call unless finalize.
+        NOTE rand_ini of forward only changes the first sample, which is not used by the
+        phase downsampling, so it is omitted here.
+        """
+        assert self.flag_for_pulse is False
+        if f0.size(1) == 0 and finalize is False:
+            empty = f0.new_zeros(f0.size(0), 0, 1)
+            return empty.repeat(1, 1, self.dim), empty, empty.repeat(1, 1, self.dim)
+        fn = torch.multiply(f0, torch.FloatTensor([[range(1, self.harmonic_num + 2)]]).to(f0.device))
+        rad_values = (fn / self.sampling_rate) % 1
+        phase = torch.cumsum(rad_values, dim=1)
+        if 'rad_sum' in cache:
+            phase = phase + cache['rad_sum']
+        if phase.size(1) != 0:
+            cache['rad_sum'] = phase[:, -1:]
+        phase = phase * 2 * np.pi
+        # left context is the last emitted frame, replicate the first frame at the beginning
+        phase = torch.concat([cache.get('phase', phase[:, :1]), phase], dim=1)
+        f0 = torch.concat([cache['f0'], f0], dim=1) if 'f0' in cache else f0
+        if finalize:
+            phase = torch.concat([phase, phase[:, -1:]], dim=1)
+        n = phase.size(1) - 2
+        cache['phase'], cache['f0'] = phase[:, n:], f0[:, n:]
+        phase = torch.nn.functional.interpolate(phase.transpose(1, 2) * self.upsample_scale,
+                                                scale_factor=self.upsample_scale, mode="linear").transpose(1, 2)
+        sine_waves = torch.sin(phase[:, self.upsample_scale:self.upsample_scale * (n + 1)]) * self.sine_amp
+        uv = self._f02uv(f0[:, :n]).repeat_interleave(int(self.upsample_scale), dim=1)
+        noise_amp = uv * self.noise_std + (1 - uv) * self.sine_amp / 3
+        noise = noise_amp * torch.randn_like(sine_waves)
+        sine_waves = sine_waves * uv + noise
+        return sine_waves, uv, noise
+
 
 class SourceModuleHnNSF2(torch.nn.Module):
     """ SourceModule for hn-nsf
@@ -388,6 +488,16 @@ class SourceModuleHnNSF2(torch.nn.Module):
         noise = torch.randn_like(uv) * self.sine_amp / 3
         return sine_merge, noise, uv
 
+    def forward_chunk(self, x, cache, finalize):
+        """
+        Sine_source = SourceModuleHnNSF.forward_chunk(F0_frames)
+        F0_frames (batchsize, frames, 1), frame level f0
+        Sine_source (batchsize, length, 1)
+        """
+        with torch.no_grad():
+            sine_wavs, _, _ = self.l_sin_gen.forward_chunk(x, cache, finalize)
+        return self.l_tanh(self.l_linear(sine_wavs))
+
 
 class HiFTGenerator(nn.Module):
     """
@@ -486,20 +596,23 @@ class HiFTGenerator(nn.Module):
         self.reflection_pad = nn.ReflectionPad1d((1, 0))
         self.stft_window = torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32))
         self.f0_predictor = f0_predictor
+        # onnxruntime sessions of f0_predictor and decode_spec, see CosyVoiceModel.load_hift_onnx
+        self.ort_f0_predictor = None
+        self.ort_decode_spec = None
 
     def remove_weight_norm(self):
         print('Removing weight norm...')
         for l in self.ups:
-            remove_weight_norm(l)
+            fold_weight_norm(l)
         for l in self.resblocks:
             l.remove_weight_norm()
-        remove_weight_norm(self.conv_pre)
-        remove_weight_norm(self.conv_post)
-        self.m_source.remove_weight_norm()
-        for l in self.source_downs:
-            remove_weight_norm(l)
+        fold_weight_norm(self.conv_pre)
+        fold_weight_norm(self.conv_post)
+        # m_source and source_downs have no weight norm
         for l in self.source_resblocks:
             l.remove_weight_norm()
+        if hasattr(self.f0_predictor, 'remove_weight_norm'):
+            self.f0_predictor.remove_weight_norm()
 
     def _stft(self, x):
         spec = torch.stft(
@@ -517,10 +630,27 @@ class HiFTGenerator(nn.Module):
                                         self.istft_params["n_fft"], window=self.stft_window.to(magnitude.device))
         return inverse_transform
 
+    def predict_f0(self, speech_feat: torch.Tensor) -> torch.Tensor:
+        if self.ort_f0_predictor is not None:
+            return self.ort_f0_predictor.run({'speech_feat': speech_feat}, 'f0', (speech_feat.size(0), speech_feat.size(2)))
+        return self.f0_predictor(speech_feat)
+
     def decode(self, x: torch.Tensor, s: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
         s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
         s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
+        if self.ort_decode_spec is not None:
+            x = self.ort_decode_spec.run({'x': x, 's_stft': s_stft}, 'spec', s_stft.shape)
+        else:
+            x = self.decode_spec(x, s_stft)
+        magnitude = torch.exp(x[:, :self.istft_params["n_fft"] // 2 + 1, :])
+        phase = torch.sin(x[:, self.istft_params["n_fft"] // 2 + 1:, :])  # actually, sin is redundancy
 
+        x = self._istft(magnitude, phase)
+        x = torch.clamp(x, -self.audio_limit, self.audio_limit)
+        return x
+
+    def decode_spec(self, x: torch.Tensor, s_stft: torch.Tensor) -> torch.Tensor:
+        """Convolution part of decode between stft of source and istft, exported to onnx by export_onnx_hift.py."""
         x = self.conv_pre(x)
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, self.lrelu_slope)
@@ -543,11 +673,92 @@ class HiFTGenerator(nn.Module):
             x = xs / self.num_kernels
 
         x = F.leaky_relu(x)
-        x = self.conv_post(x)
+        return self.conv_post(x)
+
+    def _stft_chunk(self, x, cache, finalize):
+        """Streaming _stft, reflect padding of center=True is applied at the beginning and the end."""
+        n_fft, hop_len = self.istft_params["n_fft"], self.istft_params["hop_len"]
+        if 'stft' in cache:
+            x = torch.concat([cache['stft'], x], dim=1)
+        elif x.size(1) != 0:
+            x = torch.concat([x[:, 1:n_fft // 2 + 1].flip(-1), x], dim=1)
+        if finalize:
+            x = torch.concat([x, x[:, -(n_fft // 2 + 1):-1].flip(-1)], dim=1)
+        n = (x.size(1) - n_fft) // hop_len + 1 if x.size(1) >= n_fft else 0
+        if x.size(1) != 0:
+            cache['stft'] = x[:, n * hop_len:]
+        if n == 0:
+            empty = x.new_zeros(x.size(0), n_fft // 2 + 1, 0)
+            return empty, empty
+        spec = torch.stft(x[:, :(n - 1) * hop_len + n_fft], n_fft, hop_len, n_fft, window=self.stft_window.to(x.device),
+                          center=False, return_complex=True)
+        spec = torch.view_as_real(spec)  # [B, F, TT, 2]
+        return spec[..., 0], spec[..., 1]
+
+    def _istft_chunk(self, magnitude, phase, cache, finalize):
+        """Streaming _istft, the overlap-add tail of the last n_fft - hop_len samples is kept in cache."""
+        n_fft, hop_len = self.istft_params["n_fft"], self.istft_params["hop_len"]
+        magnitude = torch.clip(magnitude, max=1e2)
+        real = magnitude * torch.cos(phase)
+        img = magnitude * torch.sin(phase)
+        window = self.stft_window.to(magnitude.device)
+        frames = torch.fft.irfft(torch.complex(real, img), n=n_fft, dim=1) * window.unsqueeze(-1)
+        num_frames = frames.size(2)
+        if num_frames != 0:
+            # overlap-add of frames and of the squared window envelope, same as torch.istft
+            output_size = (1, (num_frames - 1) * hop_len + n_fft)
+            envelope = (window ** 2).unsqueeze(-1).repeat(1, num_frames).unsqueeze(0)
+            x = F.fold(frames, output_size, kernel_size=(1, n_fft), stride=(1, hop_len)).view(frames.size(0), -1)
+            envelope = F.fold(envelope, output_size, kernel_size=(1, n_fft), stride=(1, hop_len)).view(1, -1)
+        else:
+            x, envelope = frames.new_zeros(frames.size(0), 0), frames.new_zeros(1, 0)
+        if 'istft' in cache:
+            tail, envelope_tail = cache['istft']
+            pad = max(tail.size(1) - x.size(1), 0)
+            x, envelope = F.pad(x, (0, pad)), F.pad(envelope, (0, pad))
+            x[:, :tail.size(1)] += tail
+            envelope[:, :tail.size(1)] += envelope_tail
+        n = x.size(1) if finalize else num_frames * hop_len
+        cache['istft'] = (x[:, n:], envelope[:, n:])
+        x, envelope = x[:, :n], envelope[:, :n]
+        # center=True trims n_fft // 2 samples at the beginning and the end
+        skip = cache.get('istft.skip', n_fft // 2)
+        cache['istft.skip'] = skip - min(skip, x.size(1))
+        x, envelope = x[:, min(skip, x.size(1)):], envelope[:, min(skip, x.size(1)):]
+        if finalize:
+            n = max(x.size(1) - n_fft // 2, 0)
+            x, envelope = x[:, :n], envelope[:, :n]
+        return x / envelope
+
+    def decode_chunk(self, x: torch.Tensor, s: torch.Tensor, cache: Dict, finalize: bool) -> torch.Tensor:
+        """Streaming decode, see inference_chunk."""
+        s_stft_real, s_stft_imag = self._stft_chunk(s.squeeze(1), cache, finalize)
+        s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
+
+        x = stream_conv1d(self.conv_pre, x, cache, 'conv_pre', finalize)
+        for i in range(self.num_upsamples):
+            x = F.leaky_relu(x, self.lrelu_slope)
+            x = stream_conv_transpose1d(self.ups[i], x, cache, 'ups.{}'.format(i), finalize)
+
+            if i == self.num_upsamples - 1 and 'reflection_pad' not in cache and x.size(2) > 1:
+                x = self.reflection_pad(x)
+                cache['reflection_pad'] = True
+
+            # fusion
+            si = stream_conv1d(self.source_downs[i], s_stft, cache, 'source_downs.{}'.format(i), finalize)
+            si = self.source_resblocks[i].forward_chunk(si, cache.setdefault('source_resblocks.{}'.format(i), {}), finalize)
+            x = stream_add([x, si], cache, 'fusion.{}'.format(i))
+
+            xs = [self.resblocks[i * self.num_kernels + j].forward_chunk(x, cache.setdefault('resblocks.{}'.format(i * self.num_kernels + j), {}),
+                                                                         finalize) for j in range(self.num_kernels)]
+            x = stream_add(xs, cache, 'resblocks_sum.{}'.format(i)) / self.num_kernels
+
+        x = F.leaky_relu(x)
+        x = stream_conv1d(self.conv_post, x, cache, 'conv_post', finalize)
         magnitude = torch.exp(x[:, :self.istft_params["n_fft"] // 2 + 1, :])
         phase = torch.sin(x[:, self.istft_params["n_fft"] // 2 + 1:, :])  # actually, sin is redundancy
 
-        x = self._istft(magnitude, phase)
+        x = self._istft_chunk(magnitude, phase, cache, finalize)
         x = torch.clamp(x, -self.audio_limit, self.audio_limit)
         return x
 
@@ -570,7 +781,7 @@ class HiFTGenerator(nn.Module):
     @torch.inference_mode()
     def inference(self, speech_feat: torch.Tensor, cache_source: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
         # mel->f0
-        f0 = self.f0_predictor(speech_feat)
+        f0 = self.predict_f0(speech_feat)
         # f0->source
         s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
         s, _, _ = self.m_source(s)
@@ -580,3 +791,51 @@ class HiFTGenerator(nn.Module):
             s[:, :, :cache_source.shape[2]] = cache_source
         generated_speech = self.decode(x=speech_feat, s=s)
         return generated_speech, s
+
+    @torch.inference_mode()
+    def inference_batch(self, speech_feat: List[torch.Tensor], cache_source: List[torch.Tensor]) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        """Batched inference over utterances of different length.
+
+        Mels are right padded by repeating the last frame and outputs are cut back to each utterance
+        length. The convolutions are not causal, so when lengths differ the last few frames of the
+        shorter utterances may slightly differ from inference; equal lengths give the same result.
+        """
+        mel_len = [i.shape[2] for i in speech_feat]
+        max_len = max(mel_len)
+        speech_feat = torch.concat([F.pad(i, (0, max_len - i.shape[2]), mode='replicate') for i in speech_feat], dim=0)
+        # mel->f0
+        f0 = self.predict_f0(speech_feat)
+        # f0->source
+        s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
+        s, _, _ = self.m_source(s)
+        s = s.transpose(1, 2)
+        # use cache_source to avoid glitch
+        for i, j in enumerate(cache_source):
+            if j.shape[2] != 0:
+                s[i:i + 1, :, :j.shape[2]] = j
+        generated_speech = self.decode(x=speech_feat, s=s)
+        upsample_scale = s.shape[2] // max_len
+        return [generated_speech[i:i + 1, :j * upsample_scale] for i, j in enumerate(mel_len)], \
+            [s[i:i + 1, :, :j * upsample_scale] for i, j in enumerate(mel_len)]
+
+    @torch.inference_mode()
+    def inference_chunk(self, speech_feat: torch.Tensor, cache: Dict, finalize: bool = False) -> torch.Tensor:
+        """Streaming inference, speech_feat only holds the new mel frames.
+
+        Every layer keeps its own state in cache, i.e. unconsumed inputs of convolutions, the
+        overlap tail of ConvTranspose1d and iSTFT, and the accumulated phase of the source module.
+        Each mel frame is vocoded once. The convolutions are not causal, so the speech of the last
+        few frames is held back until their right context arrives or finalize is True.
+        Concatenating the outputs of all calls equals inference on all frames, except for the random
+        noise of the source module.
+        """
+        # mel->f0
+        f0 = speech_feat
+        for i, layer in enumerate(self.f0_predictor.condnet):
+            f0 = stream_conv1d(layer, f0, cache, 'f0_predictor.{}'.format(i), finalize) if isinstance(layer, nn.Conv1d) else layer(f0)
+        f0 = torch.abs(self.f0_predictor.classifier(f0.transpose(1, 2)).squeeze(-1))
+        # f0->source
+        s = self.m_source.forward_chunk(f0[:, :, None], cache.setdefault('m_source', {}), finalize)
+        s = s.transpose(1, 2)
+        # mel+source->speech
+        return self.decode_chunk(x=speech_feat, s=s, cache=cache, finalize=finalize)
@@ -14,9 +14,11 @@
 # limitations under the License.
 import queue
 import random
+import hashlib
 import time
 import threading
-from typing import Dict, Optional, Callable, List, Generator
+from collections import OrderedDict
+from typing import Dict, Optional, Callable, List, Generator, Union
 import torch
 from torch import nn
 import torch.nn.functional as F
@@ -24,11 +26,47 @@ from transformers import Qwen2ForCausalLM
 from torch.nn.utils.rnn import pad_sequence, unpad_sequence
 from cosyvoice.utils.common import IGNORE_ID
 from cosyvoice.transformer.label_smoothing_loss import LabelSmoothingLoss
-from cosyvoice.utils.common import th_accuracy
+from cosyvoice.utils.common import th_accuracy, CancellationToken, prompt_lookup_draft
 from cosyvoice.utils.file_utils import logging
 from cosyvoice.utils.mask import make_pad_mask
 
 
+class PrefixCache:
+    """LRU of llm kv caches for repeated prompt prefixes.
+
+    The key is built from the exact prefix token ids and speaker embedding, so the prompt
+    prefix of a speaker or instruct text is prefilled once and shared by later sentences.
+    Cached tensors are never modified in place by the decoding loops.
+    """
+
+    def __init__(self, max_size: int = 64):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def key(*tensors):
+        h = hashlib.sha1()
+        for i in tensors:
+            h.update('{}|{}|'.format(tuple(i.shape), i.dtype).encode('utf-8'))
+            h.update(i.detach().float().cpu().contiguous().numpy().tobytes())
+        return h.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
 class TransformerLM(torch.nn.Module):
     def __init__(
             self,
@@ -75,6 +113,12 @@ class TransformerLM(torch.nn.Module):
         # 4. sampling method
         self.sampling = sampling
 
+        # 5. prompt prefix kv cache
+        self.prefix_cache = PrefixCache()
+
+        # 6. decode on a preallocated kv cache, see TransformerEncoder.forward_static_step, jit llm falls back to forward_chunk
+        self.static_kv_cache = True
+
     def encode(
             self,
             text: torch.Tensor,
@@ -147,19 +191,22 @@ class TransformerLM(torch.nn.Module):
     def sampling_ids(
             self,
             weighted_scores: torch.Tensor,
-            decoded_tokens: List,
+            decoded_tokens: Union[List, torch.Tensor],
             sampling: int,
-            ignore_eos: bool = True,
+            ignore_eos: Union[bool, torch.Tensor] = True,
     ):
-        num_trials, max_trials = 0, 100
-        while True:
-            top_ids = self.sampling(weighted_scores, decoded_tokens, sampling)
-            if (not ignore_eos) or (self.speech_token_size not in top_ids):
-                break
-            num_trials += 1
-            if num_trials > max_trials:
-                raise RuntimeError('sampling reaches max_trials {} and still get eos when ignore_eos is True, check your input!'.format(max_trials))
-        return top_ids
+        """Sample top_ids (1,) from weighted_scores (V,), or (B,) from (B, V).
+
+        ignore_eos is a bool, or a (B,) bool tensor for every row, eos is suppressed by
+        masking its score so that one draw is enough.
+        """
+        # logits stay in bf16 under cpu autocast, top_p cumsum and multinomial run in fp32
+        weighted_scores = weighted_scores.float()
+        if isinstance(ignore_eos, torch.Tensor) or ignore_eos is True:
+            eos_score = weighted_scores[..., self.speech_token_size]
+            weighted_scores = weighted_scores.clone()
+            weighted_scores[..., self.speech_token_size] = -float('inf') if ignore_eos is True else eos_score.masked_fill(ignore_eos, -float('inf'))
+        return self.sampling(weighted_scores, decoded_tokens, sampling)
 
     @torch.inference_mode()
     def inference(
@@ -175,6 +222,7 @@ class TransformerLM(torch.nn.Module):
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
             uuid: str = '',
+            cancel_token: Optional[CancellationToken] = None,
     ) -> Generator[torch.Tensor, None, None]:
         device = text.device
         text = torch.concat([prompt_text, text], dim=1)
@@ -209,11 +257,25 @@ class TransformerLM(torch.nn.Module):
         out_tokens = []
         offset = 0
         att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
+        # NOTE text_encoder is not causal, so only sos and spk embedding are a prefix shared by different texts
+        prefix_len = 1 + embedding.shape[1]
+        if self.prefix_cache is not None:
+            att_cache, cnn_cache = self.prefill_prefix(lm_input[:, :prefix_len], self.prefix_cache.key(embedding))
+            lm_input, offset = lm_input[:, prefix_len:], prefix_len
+        static_cache = None
+        if self.static_kv_cache is True and hasattr(self.llm, 'init_static_cache') and self.llm.support_static_cache is True:
+            static_cache = self.llm.init_static_cache(offset + lm_input.shape[1] + max_len, lm_input.dtype, lm_input.device, att_cache=att_cache)
         for i in range(max_len):
-            y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
-                                                                  att_cache=att_cache, cnn_cache=cnn_cache,
-                                                                  att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
-                                                                                                 device=lm_input.device)).to(torch.bool))
+            if cancel_token is not None and cancel_token.cancelled():
+                logging.info('llm decoding of {} is cancelled at step {}'.format(uuid, i))
+                break
+            if static_cache is not None:
+                y_pred, static_cache = self.llm.forward_static_step(lm_input, static_cache)
+            else:
+                y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
+                                                                      att_cache=att_cache, cnn_cache=cnn_cache,
+                                                                      att_mask=torch.tril(torch.ones((1, lm_input.shape[1], att_cache.size(2) + lm_input.shape[1]),
+                                                                                                     device=lm_input.device), diagonal=att_cache.size(2)).to(torch.bool))
             logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
             # force continue decode first token
             if i == 0:
@@ -227,37 +289,123 @@ class TransformerLM(torch.nn.Module):
             offset += lm_input.size(1)
             lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
 
+    def prefill_prefix(self, prefix, key):
+        cache = self.prefix_cache.get(key)
+        if cache is None:
+            _, att_cache, cnn_cache = self.llm.forward_chunk(prefix, offset=0, required_cache_size=-1,
+                                                             att_cache=torch.zeros((0, 0, 0, 0), device=prefix.device),
+                                                             cnn_cache=torch.zeros((0, 0, 0, 0), device=prefix.device),
+                                                             att_mask=torch.tril(torch.ones((1, prefix.shape[1], prefix.shape[1]),
+                                                                                            device=prefix.device)).to(torch.bool))
+            cache = (att_cache, cnn_cache)
+            self.prefix_cache.put(key, cache)
+        return cache
+
 
 class Qwen2Encoder(torch.nn.Module):
     def __init__(self, pretrain_path):
         super().__init__()
+        # NOTE only the Qwen2Model backbone self.model.model is run, text lm_head is never used,
+        # it is built so that llm.pt keys stay the same, export_cosyvoice2_vllm installs its own lm_head.
+        # When tie_word_embeddings is True, as in Qwen2-0.5B, it shares weight with embed_tokens and is kept,
+        # otherwise CosyVoice2Model.load replaces it with Identity after loading llm.pt
         self.model = Qwen2ForCausalLM.from_pretrained(pretrain_path)
 
     def forward(self, xs: torch.Tensor, xs_lens: torch.Tensor):
         T = xs.size(1)
         masks = ~make_pad_mask(xs_lens, T)
-        outs = self.model(
+        outs = self.model.model(
             inputs_embeds=xs,
             attention_mask=masks,
-            output_hidden_states=True,
             return_dict=True,
         )
-        return outs.hidden_states[-1], masks.unsqueeze(1)
+        return outs.last_hidden_state, masks.unsqueeze(1)
 
-    def forward_one_step(self, xs, masks, cache=None):
+    def forward_one_step(self, xs, masks, cache=None, position_ids=None):
         input_masks = masks[:, -1, :]
-        outs = self.model(
+        outs = self.model.model(
             inputs_embeds=xs,
             attention_mask=input_masks,
-            output_hidden_states=True,
+            position_ids=position_ids,
             return_dict=True,
             use_cache=True,
             past_key_values=cache,
         )
-        xs = outs.hidden_states[-1]
+        xs = outs.last_hidden_state
         new_cache = outs.past_key_values
         return xs, new_cache
 
+    def init_static_cache(self, max_len: int, dtype: torch.dtype, device: torch.device, cache=None):
+        """Preallocate kv cache of max_len positions for single sequence decoding, see forward_static_step.
+
+        cache is an optional legacy kv cache returned by forward_one_step, e.g. a prefilled prompt prefix,
+        which is copied to the head of the buffer.
+        """
+        config = self.model.config
+        head_dim = config.hidden_size // config.num_attention_heads
+        length = 0 if cache is None else cache[0][0].size(2)
+        max_len = max(max_len, length + 1)
+        static_cache = {'key': torch.zeros(config.num_hidden_layers, 1, config.num_key_value_heads, max_len, head_dim, dtype=dtype, device=device),
+                        'value': torch.zeros(config.num_hidden_layers, 1, config.num_key_value_heads, max_len, head_dim, dtype=dtype, device=device),
+                        'length': length}
+        if cache is not None:
+            for i in range(config.num_hidden_layers):
+                static_cache['key'][i, :, :, :length] = cache[i][0]
+                static_cache['value'][i, :, :, :length] = cache[i][1]
+        # same rotary table as Qwen2RotaryEmbedding
+        inv_freq = 1.0 / (config.rope_theta ** (torch.arange(0, head_dim, 2, dtype=torch.int64, device=device).float() / head_dim))
+        freqs = torch.outer(torch.arange(max_len, dtype=torch.int64, device=device).float(), inv_freq)
+        emb = torch.concat([freqs, freqs], dim=-1)
+        static_cache['cos'], static_cache['sin'] = emb.cos(), emb.sin()
+        return static_cache
+
+    def forward_static_step(self, xs: torch.Tensor, static_cache: dict):
+        """Run xs (1, T, D) after static_cache['length'] cached positions, keys and values are written into the
+        preallocated buffer in place, which is doubled when full.
+
+        Shapes of a single token step only depend on buffer size, so static_step may be replaced by a
+        torch.compile version of _static_step, see compile_static_step.
+        """
+        length, max_len = static_cache['length'], static_cache['key'].size(3)
+        if length + xs.size(1) > max_len:
+            static_cache.update(self.init_static_cache(2 * max_len, static_cache['key'].dtype, static_cache['key'].device,
+                                                       cache=[(k[:, :, :length], v[:, :, :length]) for k, v in zip(static_cache['key'], static_cache['value'])]))
+        pos = torch.arange(length, length + xs.size(1), device=xs.device)
+        static_step = getattr(self, 'static_step', self._static_step) if xs.size(1) == 1 else self._static_step
+        xs = static_step(xs, pos, static_cache['key'], static_cache['value'], static_cache['cos'], static_cache['sin'])
+        static_cache['length'] = length + xs.size(1)
+        return xs, static_cache
+
+    def compile_static_step(self, **kwargs):
+        self.static_step = torch.compile(self._static_step, **kwargs)
+
+    def _static_step(self, xs, pos, key, value, cos, sin):
+        config = self.model.config
+        num_heads, num_kv_heads = config.num_attention_heads, config.num_key_value_heads
+        head_dim, T = config.hidden_size // num_heads, xs.size(1)
+        n_rep = num_heads // num_kv_heads
+        cos, sin = cos[pos].to(xs.dtype), sin[pos].to(xs.dtype)
+        # 1 row of mask per position, repeated for every query head sharing a kv head, see below
+        mask = (torch.arange(key.size(3), device=xs.device) <= pos.unsqueeze(dim=1)).repeat(n_rep, 1)
+        for i, layer in enumerate(self.model.model.layers):
+            attn = layer.self_attn
+            residual = xs
+            xs = layer.input_layernorm(xs)
+            q = attn.q_proj(xs).view(1, T, num_heads, head_dim).transpose(1, 2)
+            k = attn.k_proj(xs).view(1, T, num_kv_heads, head_dim).transpose(1, 2)
+            v = attn.v_proj(xs).view(1, T, num_kv_heads, head_dim).transpose(1, 2)
+            q = q * cos + torch.concat([-q[..., head_dim // 2:], q[..., :head_dim // 2]], dim=-1) * sin
+            k = k * cos + torch.concat([-k[..., head_dim // 2:], k[..., :head_dim // 2]], dim=-1) * sin
+            key[i].index_copy_(2, pos, k.to(key.dtype))
+            value[i].index_copy_(2, pos, v.to(value.dtype))
+            # query heads sharing one kv head are folded into the query length, so kv heads are not repeated
+            q = q.reshape(1, num_kv_heads, n_rep * T, head_dim)
+            xs = F.scaled_dot_product_attention(q, key[i], value[i], attn_mask=mask)
+            xs = xs.reshape(1, num_heads, T, head_dim).transpose(1, 2).reshape(1, T, num_heads * head_dim)
+            xs = residual + attn.o_proj(xs)
+            xs = xs + layer.mlp(layer.post_attention_layernorm(xs))
+        return self.model.model.norm(xs)
+
 
 class Qwen2LM(TransformerLM):
     def __init__(
@@ -301,6 +449,20 @@ class Qwen2LM(TransformerLM):
         self.stop_token_ids = [speech_token_size + i for i in range(3)]
         self.vllm_output_queue = {}
 
+        # 6. prompt prefix kv cache
+        self.prefix_cache = PrefixCache()
+
+        # 7. decode single session hf path on a preallocated kv cache, see Qwen2Encoder.forward_static_step
+        self.static_kv_cache = True
+
+        # 8. speculative decoding, num_draft > 0 drafts tokens with draft_fn(history, num_draft), see inference_speculative,
+        # draft_fn may be replaced by a small draft lm. num_draft is the default of every request, counters are
+        # cumulative over all requests, see speculative_stats
+        self.num_draft = 0
+        self.draft_fn = prompt_lookup_draft
+        self.speculative_lock = threading.Lock()
+        self.speculative_counters = {'forwards': 0, 'drafted': 0, 'accepted': 0, 'tokens': 0}
+
     def prepare_lm_input_target(self, text_token, text_token_emb, text_token_len, speech_token, speech_token_emb, speech_token_len):
         lm_target, lm_input = [], []
         text_token = unpad_sequence(text_token, text_token_len.cpu(), batch_first=True)
@@ -438,6 +600,8 @@ class Qwen2LM(TransformerLM):
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
             uuid: str = '',
+            cancel_token: Optional[CancellationToken] = None,
+            num_draft: Optional[int] = None,
     ) -> Generator[torch.Tensor, None, None]:
         device = text.device
         text = torch.concat([prompt_text, text], dim=1)
@@ -457,12 +621,35 @@ class Qwen2LM(TransformerLM):
         min_len = int((text_len - prompt_text_len) * min_token_text_ratio)
         max_len = int((text_len - prompt_text_len) * max_token_text_ratio)
 
-        # 5. step by step decode
-        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid):
+        # 5. step by step decode, sos and prompt_text are a prefix shared by sentences of the same speaker or instruct
+        prefix_len, prefix_key = 1 + prompt_text.shape[1], self.prefix_cache.key(prompt_text) if prompt_text.shape[1] != 0 else None
+        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid, cancel_token=cancel_token, prefix_len=prefix_len, prefix_key=prefix_key,
+                                            draft_history=prompt_speech_token.flatten().tolist(), num_draft=num_draft):
             yield token
 
+    def prefill_prefix(self, prefix, key):
+        cache = self.prefix_cache.get(key)
+        if cache is None:
+            _, cache = self.llm.forward_one_step(prefix,
+                                                 masks=torch.tril(torch.ones((1, prefix.shape[1], prefix.shape[1]), device=prefix.device)).to(torch.bool),
+                                                 cache=None)
+            self.prefix_cache.put(key, cache)
+        return cache
+
+    def decode_one_step(self, lm_input, cache):
+        """Decode step of the single session hf path, cache is a legacy kv cache or a static kv cache
+        returned by Qwen2Encoder.init_static_cache."""
+        if isinstance(cache, dict):
+            return self.llm.forward_static_step(lm_input, cache)
+        seq_len = lm_input.shape[1] if cache is None else lm_input.shape[1] + cache[0][0].size(2)
+        return self.llm.forward_one_step(lm_input,
+                                         masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
+                                         cache=cache)
+
     @torch.inference_mode()
-    def inference_wrapper(self, lm_input, sampling, min_len, max_len, uuid):
+    def inference_wrapper(self, lm_input, sampling, min_len, max_len, uuid, cancel_token=None, prefix_len=0, prefix_key=None, draft_history=None,
+                          num_draft=None):
+        num_draft = self.num_draft if num_draft is None else num_draft
         if hasattr(self, 'vllm'):
             from vllm import SamplingParams, RequestOutput
             sampling_params = SamplingParams(top_k=sampling,
@@ -474,6 +661,11 @@ class Qwen2LM(TransformerLM):
                 self.vllm_output_queue[uuid] = queue.Queue()
             out_tokens = []
             while True:
+                if cancel_token is not None and cancel_token.cancelled():
+                    logging.info('llm decoding of {} is cancelled at step {}'.format(uuid, len(out_tokens)))
+                    with self.lock:
+                        self.vllm.abort_request(uuid)
+                    break
                 with self.lock:
                     if self.vllm_output_queue[uuid].empty() is True:
                         request_outputs: List[RequestOutput] = self.vllm.step()
@@ -492,13 +684,28 @@ class Qwen2LM(TransformerLM):
                 time.sleep(0.001)
             with self.lock:
                 self.vllm_output_queue.pop(uuid)
+        elif hasattr(self, 'scheduler'):
+            # decode step is shared with other sessions, see cosyvoice.cli.model.LLMScheduler
+            for top_ids in self.scheduler.inference(lm_input, sampling, min_len, max_len, cancel_token=cancel_token, prefix_len=prefix_len, prefix_key=prefix_key):
+                yield top_ids
+        elif num_draft > 0 and self.static_kv_cache is True:
+            for top_ids in self.inference_speculative(lm_input, sampling, min_len, max_len, uuid, cancel_token=cancel_token,
+                                                      prefix_len=prefix_len, prefix_key=prefix_key, draft_history=draft_history, num_draft=num_draft):
+                yield top_ids
         else:
             out_tokens = []
             cache = None
+            if prefix_key is not None and self.prefix_cache is not None:
+                cache = self.prefill_prefix(lm_input[:, :prefix_len], prefix_key)
+                lm_input = lm_input[:, prefix_len:]
+            if self.static_kv_cache is True:
+                cache_len = 0 if cache is None else cache[0][0].size(2)
+                cache = self.llm.init_static_cache(cache_len + lm_input.shape[1] + max_len, lm_input.dtype, lm_input.device, cache=cache)
             for i in range(max_len):
-                y_pred, cache = self.llm.forward_one_step(lm_input,
-                                                          masks=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool),
-                                                          cache=cache)
+                if cancel_token is not None and cancel_token.cancelled():
+                    logging.info('llm decoding of {} is cancelled at step {}'.format(uuid, i))
+                    break
+                y_pred, cache = self.decode_one_step(lm_input, cache)
                 logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
                 top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False).item()
                 if top_ids == self.speech_token_size:
@@ -510,6 +717,73 @@ class Qwen2LM(TransformerLM):
                 out_tokens.append(top_ids)
                 lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
 
+    @torch.inference_mode()
+    def inference_speculative(self, lm_input, sampling, min_len, max_len, uuid, cancel_token=None, prefix_len=0, prefix_key=None, draft_history=None,
+                              num_draft=None):
+        """Single session decoding which verifies num_draft drafted tokens in one forward.
+
+        Every position is sampled by sampling_ids as in inference_wrapper, and a draft is accepted only when
+        it equals the sampled token, so the output follows the same distribution as token by token decoding.
+        Drafts come from draft_fn on prompt speech token and generated tokens.
+        """
+        num_draft = self.num_draft if num_draft is None else num_draft
+        cache = None
+        if prefix_key is not None and self.prefix_cache is not None:
+            cache = self.prefill_prefix(lm_input[:, :prefix_len], prefix_key)
+            lm_input = lm_input[:, prefix_len:]
+        cache_len = 0 if cache is None else cache[0][0].size(2)
+        cache = self.llm.init_static_cache(cache_len + lm_input.shape[1] + max_len + num_draft, lm_input.dtype, lm_input.device, cache=cache)
+        history = list(draft_history) if draft_history is not None else []
+        out_tokens = []
+        i, num_forward, num_drafted, num_accepted, finished = 0, 0, 0, 0, False
+        try:
+            while i < max_len and finished is False:
+                if cancel_token is not None and cancel_token.cancelled():
+                    logging.info('llm decoding of {} is cancelled at step {}'.format(uuid, i))
+                    break
+                drafts = self.draft_fn(history + out_tokens, min(num_draft, max_len - i - 1))
+                xs = torch.concat([lm_input, self.speech_embedding.weight[torch.tensor(drafts, dtype=torch.long, device=lm_input.device)].unsqueeze(dim=0)], dim=1)
+                length = cache['length']
+                y_pred, cache = self.decode_one_step(xs, cache)
+                logp = self.llm_decoder(y_pred[0, -(len(drafts) + 1):]).log_softmax(dim=-1)
+                num_forward, num_drafted = num_forward + 1, num_drafted + len(drafts)
+                # positions of xs whose kv stays in cache, kv of rejected drafts is overwritten later
+                consumed = lm_input.shape[1]
+                for j in range(len(drafts) + 1):
+                    top_ids = self.sampling_ids(logp[j], out_tokens, sampling, ignore_eos=True if i < min_len else False).item()
+                    i += 1
+                    if top_ids == self.speech_token_size:
+                        finished = True
+                        break
+                    if top_ids > self.speech_token_size:
+                        # same as inference_wrapper, previous input is fed again
+                        lm_input = xs[:, consumed - 1:consumed]
+                        break
+                    # in stream mode, yield token one by one
+                    yield top_ids
+                    out_tokens.append(top_ids)
+                    lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
+                    if j == len(drafts) or top_ids != drafts[j] or i >= max_len:
+                        break
+                    consumed, num_accepted = consumed + 1, num_accepted + 1
+                cache['length'] = length + consumed
+        finally:
+            # also counted when the consumer closes the generator early
+            with self.speculative_lock:
+                for k, v in zip(['forwards', 'drafted', 'accepted', 'tokens'], [num_forward, num_drafted, num_accepted, len(out_tokens)]):
+                    self.speculative_counters[k] += v
+            logging.info('speculative decoding of {} accepts {}/{} drafts, {:.2f} tokens per forward'.format(
+                uuid, num_accepted, num_drafted, len(out_tokens) / max(num_forward, 1)))
+
+    def speculative_stats(self):
+        """Cumulative counters of inference_speculative over all requests, acceptance is accepted / drafted
+        and tokens_per_forward is tokens / forwards, both 0 before any forward."""
+        with self.speculative_lock:
+            stats = dict(self.speculative_counters)
+        stats['acceptance'] = stats['accepted'] / max(stats['drafted'], 1)
+        stats['tokens_per_forward'] = stats['tokens'] / max(stats['forwards'], 1)
+        return stats
+
     @torch.inference_mode()
     def inference_bistream(
             self,
@@ -522,6 +796,7 @@ class Qwen2LM(TransformerLM):
             sampling: int = 25,
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
+            cancel_token: Optional[CancellationToken] = None,
     ) -> Generator[torch.Tensor, None, None]:
 
         device = prompt_text.device
@@ -536,11 +811,15 @@ class Qwen2LM(TransformerLM):
 
         # 2. iterate text
         out_tokens = []
-        cache = None
+        # static kv cache grows by doubling, as the total length is unknown before text ends
+        cache = self.llm.init_static_cache(1024, lm_input.dtype, device) if self.static_kv_cache is True else None
         # NOTE init prompt_text as text_cache as it is basically impossible prompt_speech_token/prompt_text < 15/5
         text_cache = self.llm.model.model.embed_tokens(prompt_text)
         next_fill_index = -1
         for this_text in text:
+            if cancel_token is not None and cancel_token.cancelled():
+                logging.info('llm decoding is cancelled at step {}'.format(len(out_tokens)))
+                return
             text_cache = torch.concat([text_cache, self.llm.model.model.embed_tokens(this_text)], dim=1)
             # prompt_speech_token_emb not empty, try append to lm_input
             while prompt_speech_token_emb.size(1) != 0:
@@ -568,10 +847,10 @@ class Qwen2LM(TransformerLM):
                         logging.info('not enough text token to decode, wait for more')
                         continue
                 while True:
-                    seq_len = lm_input.shape[1] if cache is None else lm_input.shape[1] + cache[0][0].size(2)
-                    y_pred, cache = self.llm.forward_one_step(lm_input,
-                                                              masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
-                                                              cache=cache)
+                    if cancel_token is not None and cancel_token.cancelled():
+                        logging.info('llm decoding is cancelled at step {}'.format(len(out_tokens)))
+                        return
+                    y_pred, cache = self.decode_one_step(lm_input, cache)
                     logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
                     if next_fill_index != -1 and len(out_tokens) == next_fill_index:
                         top_ids = self.speech_token_size + 2
@@ -594,10 +873,10 @@ class Qwen2LM(TransformerLM):
         lm_input = torch.concat([lm_input, text_cache, task_id_emb], dim=1)
         logging.info('no more text token, decode until met eos')
         while True:
-            seq_len = lm_input.shape[1] if cache is None else lm_input.shape[1] + cache[0][0].size(2)
-            y_pred, cache = self.llm.forward_one_step(lm_input,
-                                                      masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
-                                                      cache=cache)
+            if cancel_token is not None and cancel_token.cancelled():
+                logging.info('llm decoding is cancelled at step {}'.format(len(out_tokens)))
+                return
+            y_pred, cache = self.decode_one_step(lm_input, cache)
             logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
             top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=False).item()
             out_tokens.append(top_ids)
@@ -17,9 +17,10 @@
 """Multi-Head Attention layer definition."""
 
 import math
-from typing import Tuple
+from typing import Optional, Tuple
 
 import torch
+import torch.nn.functional as F
 from torch import nn
 
 
@@ -196,6 +197,39 @@ class MultiHeadedAttention(nn.Module):
         scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
         return self.forward_attention(v, scores, mask), new_cache
 
+    @torch.jit.unused
+    def forward_static(
+        self,
+        x: torch.Tensor,
+        mask: torch.Tensor,
+        pos_emb: torch.Tensor,
+        pos: torch.Tensor,
+        key_cache: torch.Tensor,
+        value_cache: torch.Tensor,
+    ) -> torch.Tensor:
+        """Self attention on a preallocated kv cache, keys and values of x are
+        written in place at positions pos.
+
+        Args:
+            x (torch.Tensor): Input tensor (1, time1, size).
+            mask (torch.Tensor): Mask tensor (1, time1, max_len).
+            pos_emb (torch.Tensor): Relative positional embedding of
+                distance 0 to max_len - 1 (1, max_len, size).
+            pos (torch.Tensor): Positions of x (time1,).
+            key_cache (torch.Tensor): Key cache (1, head, max_len, d_k).
+            value_cache (torch.Tensor): Value cache (1, head, max_len, d_k).
+
+        Returns:
+            torch.Tensor: Output tensor (1, time1, d_model).
+
+        """
+        q, k, v = self.forward_qkv(x, x, x)
+        # linear layers return bf16 under cpu autocast, the cache keeps its own dtype
+        key_cache.index_copy_(2, pos, k.to(key_cache.dtype))
+        value_cache.index_copy_(2, pos, v.to(value_cache.dtype))
+        scores = torch.matmul(q, key_cache.transpose(-2, -1)) / math.sqrt(self.d_k)
+        return self.forward_attention(value_cache, scores, mask)
+
 
 class RelPositionMultiHeadedAttention(MultiHeadedAttention):
     """Multi-Head Attention layer with relative position encoding.
@@ -328,3 +362,158 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
             self.d_k)  # (batch, head, time1, time2)
 
         return self.forward_attention(v, scores, mask), new_cache
+
+    @torch.jit.unused
+    def forward_static(
+        self,
+        x: torch.Tensor,
+        mask: torch.Tensor,
+        pos_emb: torch.Tensor,
+        pos: torch.Tensor,
+        key_cache: torch.Tensor,
+        value_cache: torch.Tensor,
+    ) -> torch.Tensor:
+        """See MultiHeadedAttention.forward_static, pos_emb[:, r] is the
+        espnet relative positional embedding of distance r between query and
+        key, which replaces rel_shift.
+        """
+        q, k, v = self.forward_qkv(x, x, x)
+        # linear layers return bf16 under cpu autocast, the cache keeps its own dtype
+        key_cache.index_copy_(2, pos, k.to(key_cache.dtype))
+        value_cache.index_copy_(2, pos, v.to(value_cache.dtype))
+        q = q.transpose(1, 2)  # (batch, time1, head, d_k)
+        q_with_bias_u = (q + self.pos_bias_u).transpose(1, 2)
+        q_with_bias_v = (q + self.pos_bias_v).transpose(1, 2)
+        matrix_ac = torch.matmul(q_with_bias_u, key_cache.transpose(-2, -1))
+        # linear_pos has no bias, so it is applied to the query of every head
+        # instead of max_len positions, (batch, head, time1, size)
+        q_with_bias_v = torch.matmul(q_with_bias_v, self.linear_pos.weight.view(self.h, self.d_k, -1))
+        # (batch, head, time1, max_len), indexed by distance
+        matrix_bd = torch.matmul(q_with_bias_v, pos_emb.transpose(-2, -1))
+        distance = (pos.unsqueeze(1) - torch.arange(key_cache.size(2), device=pos.device)).clamp(min=0)
+        matrix_bd = matrix_bd.gather(-1, distance.expand_as(matrix_ac))
+        scores = (matrix_ac + matrix_bd) / math.sqrt(self.d_k)
+        return self.forward_attention(value_cache, scores, mask)
+
+
+class SdpaMultiHeadedAttention(MultiHeadedAttention):
+    """Multi-Head Attention layer computed by torch.nn.functional.scaled_dot_product_attention.
+
+    Parameters are the same as MultiHeadedAttention, so checkpoints can be loaded by
+    either class. Fused kernels do not materialize the attention weights.
+    Rows without any valid position are not zeroed as in forward_attention, callers
+    make sure every row has at least one valid position, see add_optional_chunk_mask.
+    """
+
+    def forward_sdpa(
+        self,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
+        bias: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        """Compute attention context vector.
+
+        Args:
+            query (torch.Tensor): Transformed query, size
+                (#batch, n_head, time1, d_k).
+            key (torch.Tensor): Transformed key, size
+                (#batch, n_head, time2, d_k).
+            value (torch.Tensor): Transformed value, size
+                (#batch, n_head, time2, d_k).
+            mask (torch.Tensor): Mask, size (#batch, 1, time2) or
+                (#batch, time1, time2), (0, 0, 0) means fake mask.
+            bias (torch.Tensor, optional): Scaled score bias added before
+                softmax, size (#batch or 1, n_head, time1, time2).
+
+        Returns:
+            torch.Tensor: Transformed value (#batch, time1, d_model).
+
+        """
+        n_batch = query.size(0)
+        attn_mask = bias
+        if mask.size(2) > 0:  # time2 > 0
+            mask = mask.unsqueeze(1).eq(0)  # (batch, 1, *, time2)
+            # For last chunk, time2 might be larger than key.size(2)
+            mask = mask[:, :, :, :key.size(2)]  # (batch, 1, *, time2)
+            if attn_mask is None:
+                attn_mask = ~mask
+            else:
+                attn_mask = attn_mask.masked_fill(mask, -1.0e+10)
+        x = F.scaled_dot_product_attention(query, key, value, attn_mask=attn_mask,
+                                           dropout_p=self.dropout.p if self.training else 0.0)
+        x = (x.transpose(1, 2).contiguous().view(n_batch, -1,
+                                                 self.h * self.d_k)
+             )  # (batch, time1, d_model)
+
+        return self.linear_out(x)  # (batch, time1, d_model)
+
+    def forward(
+        self,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
+        pos_emb: torch.Tensor = torch.empty(0),
+        cache: torch.Tensor = torch.zeros((0, 0, 0, 0))
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Same as MultiHeadedAttention.forward."""
+        q, k, v = self.forward_qkv(query, key, value)
+        # see MultiHeadedAttention.forward for the cache layout
+        if cache.size(0) > 0:
+            key_cache, value_cache = torch.split(cache,
+                                                 cache.size(-1) // 2,
+                                                 dim=-1)
+            k = torch.cat([key_cache, k], dim=2)
+            v = torch.cat([value_cache, v], dim=2)
+        new_cache = torch.cat((k, v), dim=-1)
+
+        return self.forward_sdpa(q, k, v, mask), new_cache
+
+
+class SdpaRelPositionMultiHeadedAttention(SdpaMultiHeadedAttention, RelPositionMultiHeadedAttention):
+    """RelPositionMultiHeadedAttention computed by torch.nn.functional.scaled_dot_product_attention.
+
+    Matrix a and c are computed inside the fused kernel, matrix b and d are
+    passed in as attn_mask. Parameters are the same as RelPositionMultiHeadedAttention.
+    """
+
+    def forward(
+        self,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
+        pos_emb: torch.Tensor = torch.empty(0),
+        cache: torch.Tensor = torch.zeros((0, 0, 0, 0))
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Same as RelPositionMultiHeadedAttention.forward."""
+        q, k, v = self.forward_qkv(query, key, value)
+        q = q.transpose(1, 2)  # (batch, time1, head, d_k)
+        # see MultiHeadedAttention.forward for the cache layout
+        if cache.size(0) > 0:
+            key_cache, value_cache = torch.split(cache,
+                                                 cache.size(-1) // 2,
+                                                 dim=-1)
+            k = torch.cat([key_cache, k], dim=2)
+            v = torch.cat([value_cache, v], dim=2)
+        new_cache = torch.cat((k, v), dim=-1)
+
+        n_batch_pos = pos_emb.size(0)
+        p = self.linear_pos(pos_emb).view(n_batch_pos, -1, self.h, self.d_k)
+        p = p.transpose(1, 2)  # (batch, head, time1, d_k)
+
+        # (batch, head, time1, d_k)
+        q_with_bias_u = (q + self.pos_bias_u).transpose(1, 2)
+        # (batch, head, time1, d_k)
+        q_with_bias_v = (q + self.pos_bias_v).transpose(1, 2)
+
+        # compute matrix b and matrix d
+        # (batch, head, time1, time2)
+        matrix_bd = torch.matmul(q_with_bias_v, p.transpose(-2, -1))
+        # NOTE(Xiang Lyu): Keep rel_shift since espnet rel_pos_emb is used
+        if matrix_bd.size(0) != q_with_bias_u.size(0) or matrix_bd.size(3) != k.size(2):
+            matrix_bd = self.rel_shift(matrix_bd)
+
+        return self.forward_sdpa(q_with_bias_u, k, v, mask, matrix_bd / math.sqrt(self.d_k)), new_cache
@@ -382,6 +382,62 @@ class TransformerEncoder(BaseEncoder):
                                         dropout_rate, activation),
                 dropout_rate, normalize_before) for _ in range(num_blocks)
         ])
+        # forward_static_step computes relative positions of espnet rel_pos_emb only
+        self.support_static_cache = not selfattention_layer_type.startswith('rel_selfattn') or pos_enc_layer_type == 'rel_pos_espnet'
+
+    @torch.jit.unused
+    def init_static_cache(self, max_len: int, dtype: torch.dtype, device: torch.device,
+                          att_cache: torch.Tensor = torch.zeros(0, 0, 0, 0)):
+        """Preallocate kv cache of max_len positions for forward_static_step.
+
+        Args:
+            att_cache (torch.Tensor): optional cache returned by forward_chunk,
+                (elayers, head, cache_t1, d_k * 2), copied to the head of the
+                buffer.
+        """
+        attn = self.encoders[0].self_attn
+        length = att_cache.size(2) if att_cache.size(0) > 0 else 0
+        max_len = max(max_len, length + 1)
+        key = torch.zeros(len(self.encoders), 1, attn.h, max_len, attn.d_k, dtype=dtype, device=device)
+        value = torch.zeros(len(self.encoders), 1, attn.h, max_len, attn.d_k, dtype=dtype, device=device)
+        if length > 0:
+            key[:, 0, :, :length], value[:, 0, :, :length] = torch.split(att_cache, attn.d_k, dim=-1)
+        pos_enc = self.embed.pos_enc
+        if hasattr(pos_enc, 'extend_pe'):
+            pos_enc.extend_pe(torch.zeros(1, max_len, dtype=dtype, device=device))
+        # espnet rel_pos_emb puts distance max_len - 1 to 0 first, flip so that pos_emb[:, r] is distance r
+        pos_emb = self.embed.position_encoding(offset=0, size=max_len)[:, :max_len].flip(1)
+        return {'key': key, 'value': value, 'pos_emb': pos_emb, 'length': length}
+
+    @torch.jit.unused
+    def forward_static_step(self, xs: torch.Tensor, static_cache):
+        """Same as forward_chunk with required_cache_size=-1 and a causal
+        att_mask, on a preallocated kv cache written in place instead of
+        concatenated every step. The buffer is doubled when full.
+
+        Args:
+            xs (torch.Tensor): chunk input (b=1, time, mel-dim), at offset
+                static_cache['length'].
+            static_cache (dict): returned by init_static_cache.
+        """
+        assert xs.size(0) == 1
+        length, max_len = static_cache['length'], static_cache['key'].size(3)
+        if length + xs.size(1) > max_len:
+            att_cache = torch.concat([static_cache['key'][:, 0, :, :length], static_cache['value'][:, 0, :, :length]], dim=-1)
+            static_cache = self.init_static_cache(2 * max_len, xs.dtype, xs.device, att_cache=att_cache)
+        tmp_masks = torch.ones(1, 1, xs.size(1), device=xs.device, dtype=torch.bool)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, _, _ = self.embed(xs, tmp_masks, length)
+        pos = torch.arange(length, length + xs.size(1), device=xs.device)
+        # row t attends positions up to pos[t], later positions of the buffer are empty
+        att_mask = (torch.arange(static_cache['key'].size(3), device=xs.device) <= pos.unsqueeze(1)).unsqueeze(0)
+        for i, layer in enumerate(self.encoders):
+            xs = layer.forward_static(xs, att_mask, static_cache['pos_emb'], pos, static_cache['key'][i], static_cache['value'][i])
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        static_cache['length'] = length + xs.size(1)
+        return xs, static_cache
 
 
 class ConformerEncoder(BaseEncoder):
@@ -15,7 +15,7 @@
 # limitations under the License.
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Encoder definition."""
-from typing import Tuple
+from typing import Any, Dict, Tuple
 
 import torch
 from torch import nn
@@ -32,6 +32,7 @@ from cosyvoice.utils.class_utils import (
 )
 from cosyvoice.utils.mask import make_pad_mask
 from cosyvoice.utils.mask import add_optional_chunk_mask
+from cosyvoice.utils.mask import subsequent_chunk_mask_with_cache
 
 
 class Upsample1D(nn.Module):
@@ -318,3 +319,67 @@ class UpsampleConformerEncoder(torch.nn.Module):
         for layer in self.up_encoders:
             xs, chunk_masks, _, _ = layer(xs, chunk_masks, pos_emb, mask_pad)
         return xs
+
+    def forward_chunk(
+        self,
+        xs: torch.Tensor,
+        context: torch.Tensor,
+        cache: Dict[str, Any],
+    ) -> Tuple[torch.Tensor, Dict[str, Any]]:
+        """ Forward only the new tokens of a streaming request, equivalent to forward with
+            streaming=True over all tokens seen so far when every call except the last one
+            ends on a static_chunk_size boundary.
+
+        Args:
+            xs (torch.Tensor): new input tokens (1, T, D), not including tokens in cache
+            context (torch.Tensor): pre lookahead tokens (1, pre_lookahead_len, D)
+            cache (Dict): returned by previous call, empty dict for the first chunk
+
+        Returns:
+            torch.Tensor: output of the new tokens (1, T * stride, D)
+            Dict: cache for the next chunk, holding the number of encoded tokens, the
+                left context of pre lookahead conv and upsample conv, and the attention
+                key & value of every layer
+        """
+        assert xs.size(0) == 1, 'forward_chunk only supports batch size 1'
+        offset = cache.get('offset', 0)
+        assert self.static_chunk_size > 0 and offset % self.static_chunk_size == 0, \
+            'previous chunk should end on a static_chunk_size boundary'
+        T = xs.size(1)
+        masks = torch.ones(1, 1, T, dtype=torch.bool, device=xs.device)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, pos_emb, masks = self.embed(xs, masks, offset=offset)
+        if context.size(1) != 0:
+            context_masks = torch.ones(1, 1, context.size(1)).to(masks)
+            context, _, _ = self.embed(context, context_masks, offset=offset + T)
+        # conv2 of pre lookahead layer is causal, left context is kept so that frames near the chunk border
+        # see the same inputs as in full recompute
+        xs = torch.concat([cache.get('lookahead', xs[:, :0]), xs], dim=1)
+        lookahead_cache = xs[:, -(self.pre_lookahead_layer.conv2.kernel_size[0] - 1):]
+        xs = self.pre_lookahead_layer(xs, context=context)[:, xs.size(1) - T:]
+        chunk_masks = subsequent_chunk_mask_with_cache(offset, T, self.static_chunk_size, xs.device).unsqueeze(0)
+        att_cache = []
+        for i, layer in enumerate(self.encoders):
+            xs, _, new_att_cache, _ = layer(xs, chunk_masks, pos_emb, masks,
+                                            att_cache=cache['att'][i] if offset > 0 else torch.zeros((0, 0, 0, 0)))
+            att_cache.append(new_att_cache)
+
+        # upsample + conformer encoder, upsample conv looks back stride * 2 interpolated frames, i.e. 2 input frames
+        stride = self.up_layer.stride
+        xs = torch.concat([cache.get('up', xs[:, :0]), xs], dim=1)
+        up_cache = xs[:, -2:]
+        xs, _ = self.up_layer(xs.transpose(1, 2).contiguous(), torch.tensor([xs.size(1)], device=xs.device))
+        xs = xs.transpose(1, 2)[:, xs.size(2) - T * stride:].contiguous()
+        masks = torch.ones(1, 1, T * stride, dtype=torch.bool, device=xs.device)
+        xs, pos_emb, masks = self.up_embed(xs, masks, offset=offset * stride)
+        chunk_masks = subsequent_chunk_mask_with_cache(offset * stride, T * stride, self.static_chunk_size * stride, xs.device).unsqueeze(0)
+        up_att_cache = []
+        for i, layer in enumerate(self.up_encoders):
+            xs, _, new_att_cache, _ = layer(xs, chunk_masks, pos_emb, masks,
+                                            att_cache=cache['up_att'][i] if offset > 0 else torch.zeros((0, 0, 0, 0)))
+            up_att_cache.append(new_att_cache)
+
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        return xs, {'offset': offset + T, 'lookahead': lookahead_cache, 'att': att_cache, 'up': up_cache, 'up_att': up_att_cache}
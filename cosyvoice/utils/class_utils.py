@@ -29,7 +29,9 @@ from cosyvoice.transformer.embedding import (PositionalEncoding,
                                              LearnablePositionalEncoding,
                                              NoPositionalEncoding)
 from cosyvoice.transformer.attention import (MultiHeadedAttention,
-                                             RelPositionMultiHeadedAttention)
+                                             RelPositionMultiHeadedAttention,
+                                             SdpaMultiHeadedAttention,
+                                             SdpaRelPositionMultiHeadedAttention)
 from cosyvoice.transformer.embedding import EspnetRelPositionalEncoding
 from cosyvoice.transformer.subsampling import LegacyLinearNoSubsampling
 from cosyvoice.llm.llm import TransformerLM, Qwen2LM
@@ -71,6 +73,8 @@ COSYVOICE_EMB_CLASSES = {
 COSYVOICE_ATTENTION_CLASSES = {
     "selfattn": MultiHeadedAttention,
     "rel_selfattn": RelPositionMultiHeadedAttention,
+    "selfattn_sdpa": SdpaMultiHeadedAttention,
+    "rel_selfattn_sdpa": SdpaRelPositionMultiHeadedAttention,
 }
 
 
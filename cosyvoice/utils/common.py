@@ -18,10 +18,15 @@
 
 import queue
 import random
-from typing import List
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 
 IGNORE_ID = -1
 
@@ -97,6 +102,14 @@ def th_accuracy(pad_outputs: torch.Tensor, pad_targets: torch.Tensor,
     return (numerator / denominator).detach()
 
 
+def fold_weight_norm(module: torch.nn.Module):
+    """Fold weight norm of module into a plain weight, for both parametrizations.weight_norm and the legacy hook."""
+    if torch.nn.utils.parametrize.is_parametrized(module, 'weight'):
+        torch.nn.utils.parametrize.remove_parametrizations(module, 'weight')
+    else:
+        torch.nn.utils.remove_weight_norm(module)
+
+
 def get_padding(kernel_size, dilation=1):
     return int((kernel_size * dilation - dilation) / 2)
 
@@ -109,34 +122,70 @@ def init_weights(m, mean=0.0, std=0.01):
 
 # Repetition Aware Sampling in VALL-E 2
 def ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
+    """Repetition aware sampling, falls back to random sampling when the nucleus sample repeats too often
+    in the last win_size tokens.
+
+    weighted_scores is (V,) with decoded_tokens a list of previous tokens, or (B, V) with decoded_tokens
+    a (B, W) tensor of recent tokens of every row, see push_recent_tokens.
+    """
     top_ids = nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k)
-    rep_num = (torch.tensor(decoded_tokens[-win_size:]).to(weighted_scores.device) == top_ids).sum().item()
-    if rep_num >= win_size * tau_r:
-        top_ids = random_sampling(weighted_scores, decoded_tokens, sampling)
+    if isinstance(decoded_tokens, list):
+        decoded_tokens = torch.tensor(decoded_tokens[-win_size:], dtype=torch.long)
+    rep_num = (decoded_tokens[..., -win_size:].to(weighted_scores.device) == top_ids.unsqueeze(-1)).sum(dim=-1)
+    rep_mask = rep_num >= win_size * tau_r
+    if rep_mask.any():
+        top_ids = torch.where(rep_mask, random_sampling(weighted_scores, decoded_tokens, sampling), top_ids)
     return top_ids
 
 
+def top_k_top_p_filter(weighted_scores, top_p=0.8, top_k=25):
+    """Candidates of nucleus sampling, the first top_k tokens of the sorted distribution are kept
+    while the probability mass before them is below top_p.
+
+    Returns:
+        prob (*, top_k): probability of every candidate, 0 for dropped ones
+        indices (*, top_k): token id of every candidate
+    """
+    sorted_value, sorted_idx = weighted_scores.softmax(dim=-1).sort(dim=-1, descending=True, stable=True)
+    sorted_value, sorted_idx = sorted_value[..., :top_k], sorted_idx[..., :top_k]
+    cum_prob = F.pad(sorted_value.cumsum(dim=-1)[..., :-1], (1, 0))
+    return sorted_value.masked_fill(cum_prob >= top_p, 0), sorted_idx
+
+
 def nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
-    prob, indices = [], []
-    cum_prob = 0.0
-    sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
-    for i in range(len(sorted_idx)):
-        # sampling both top-p and numbers.
-        if cum_prob < top_p and len(prob) < top_k:
-            cum_prob += sorted_value[i]
-            prob.append(sorted_value[i])
-            indices.append(sorted_idx[i])
-        else:
-            break
-    prob = torch.tensor(prob).to(weighted_scores)
-    indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
-    top_ids = indices[prob.multinomial(1, replacement=True)]
-    return top_ids
+    """Sample top_ids (1,) from weighted_scores (V,), or (B,) from (B, V)."""
+    prob, indices = top_k_top_p_filter(weighted_scores, top_p=top_p, top_k=top_k)
+    top_ids = indices.gather(-1, prob.multinomial(1, replacement=True))
+    return top_ids if weighted_scores.dim() == 1 else top_ids.squeeze(dim=-1)
 
 
 def random_sampling(weighted_scores, decoded_tokens, sampling):
-    top_ids = weighted_scores.softmax(dim=0).multinomial(1, replacement=True)
-    return top_ids
+    top_ids = weighted_scores.softmax(dim=-1).multinomial(1, replacement=True)
+    return top_ids if weighted_scores.dim() == 1 else top_ids.squeeze(dim=-1)
+
+
+def push_recent_tokens(recent_tokens, top_ids, valid):
+    """Append top_ids (B,) to recent_tokens (B, W) for rows where valid is True, the oldest token
+    of these rows is dropped. Empty slots hold -1.
+    """
+    shifted = torch.concat([recent_tokens[:, 1:], top_ids.unsqueeze(dim=1).to(recent_tokens)], dim=1)
+    return torch.where(valid.unsqueeze(dim=1), shifted, recent_tokens)
+
+
+def prompt_lookup_draft(tokens, num_draft, max_ngram=3):
+    """Draft num_draft tokens by copying what followed the latest earlier occurrence of the
+    longest suffix n-gram of tokens, n from max_ngram down to 1. The copy may overlap the
+    drafted tokens, so a run of silence tokens is extended. Returns [] when nothing matches.
+    """
+    for n in range(min(max_ngram, len(tokens) - 1), 0, -1):
+        ngram = tokens[-n:]
+        for start in range(len(tokens) - n - 1, -1, -1):
+            if tokens[start:start + n] == ngram:
+                draft = []
+                for i in range(start + n, start + n + num_draft):
+                    draft.append(tokens[i] if i < len(tokens) else draft[i - len(tokens)])
+                return draft
+    return []
 
 
 def fade_in_out(fade_in_mel, fade_out_mel, window):
@@ -168,10 +217,30 @@ def mask_to_bias(mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
     return mask
 
 
+def autocast(fp16: bool = False, bf16: bool = False):
+    """fp16 autocast on cuda, or bf16 autocast on cpu when bf16 is True."""
+    if bf16 is True:
+        return torch.autocast('cpu', dtype=torch.bfloat16)
+    return torch.cuda.amp.autocast(fp16)
+
+
+def quantize_linear_dynamic(module, skip=('linear_pos',)):
+    """Dynamic int8 quantization of nn.Linear layers of module in place, for cpu inference.
+
+    Linear layers named in skip keep float weights, linear_pos weight is read directly by
+    RelPositionMultiHeadedAttention.forward_static.
+    """
+    qconfig_spec = {name: torch.ao.quantization.default_dynamic_qconfig for name, m in module.named_modules()
+                    if isinstance(m, torch.nn.Linear) and name.split('.')[-1] not in skip}
+    return torch.ao.quantization.quantize_dynamic(module, qconfig_spec, dtype=torch.qint8, inplace=True)
+
+
 class TrtContextWrapper:
     def __init__(self, trt_engine, trt_concurrent=1, device='cuda:0'):
         self.trt_context_pool = queue.Queue(maxsize=trt_concurrent)
         self.trt_engine = trt_engine
+        # onnx exported before batch axis became dynamic only accepts the unconditional and conditional pair
+        self.min_batch_size = trt_engine.get_tensor_profile_shape('x', 0)[0][0]
         for _ in range(trt_concurrent):
             trt_context = trt_engine.create_execution_context()
             trt_stream = torch.cuda.stream(torch.cuda.Stream(device))
@@ -184,3 +253,98 @@ class TrtContextWrapper:
 
     def release_estimator(self, context, stream):
         self.trt_context_pool.put([context, stream])
+
+
+class OrtSessionWrapper:
+    """Pool of onnxruntime sessions of one onnx model, see TrtContextWrapper."""
+    def __init__(self, onnx_model, ort_concurrent=1, device='cpu', max_buffer_shapes=4):
+        import onnxruntime
+        self.ort_session_pool = queue.Queue(maxsize=ort_concurrent)
+        self.device = torch.device(device)
+        # output buffers are kept for the most recently used shapes of every session, see get_output_buffer
+        self.max_buffer_shapes = max_buffer_shapes
+        option = onnxruntime.SessionOptions()
+        option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # sessions of the pool run concurrently, share the cores between them
+        option.intra_op_num_threads = max(1, torch.get_num_threads() // ort_concurrent)
+        providers = ['CUDAExecutionProvider'] if self.device.type == 'cuda' else ['CPUExecutionProvider']
+        for _ in range(ort_concurrent):
+            ort_session = onnxruntime.InferenceSession(onnx_model, sess_options=option, providers=providers)
+            self.ort_session_pool.put([ort_session, ort_session.io_binding(), OrderedDict()])
+        # onnx exported before batch axis became dynamic only accepts the unconditional and conditional pair
+        batch_size = ort_session.get_inputs()[0].shape[0]
+        self.dynamic_batch = not isinstance(batch_size, int)
+        self.min_batch_size = 1 if self.dynamic_batch else batch_size
+
+    def acquire_estimator(self):
+        return self.ort_session_pool.get()
+
+    def release_estimator(self, ort_session, io_binding, output_buffers):
+        self.ort_session_pool.put([ort_session, io_binding, output_buffers])
+
+    def get_output_buffer(self, output_buffers, output_shape) -> torch.Tensor:
+        """Two rotating fp32 output buffers per shape of one session, oldest first.
+
+        The buffer of the previous run is never overwritten, e.g. heun and multistep solvers still hold
+        the velocity of the previous call. The older one is reused only when no caller holds it anymore,
+        otherwise it is replaced by a new tensor, so outputs kept by concurrent requests stay intact.
+        """
+        key = tuple(output_shape)
+        buffers = output_buffers.pop(key, [])
+        output_buffers[key] = buffers
+        # lengths of non streaming requests vary, only keep the most recently used shapes
+        while len(output_buffers) > self.max_buffer_shapes:
+            output_buffers.popitem(last=False)
+        # references are the list slot and the argument of getrefcount
+        if len(buffers) == 2 and sys.getrefcount(buffers[0]) <= 2:
+            output = buffers.pop(0)
+        else:
+            output = torch.empty(key, dtype=torch.float32, device=self.device)
+            if len(buffers) == 2:
+                buffers.pop(0)
+        buffers.append(output)
+        return output
+
+    def run(self, inputs: Dict[str, torch.Tensor], output_name: str, output_shape) -> torch.Tensor:
+        """Run one session of the pool with IOBinding. Contiguous fp32 inputs are bound without copy,
+        the output is written to a rotating fp32 buffer of output_shape, see get_output_buffer. Views of
+        the output should not outlive the output itself, as the buffer is reused once it is released.
+        """
+        ort_session, io_binding, output_buffers = self.acquire_estimator()
+        device_id = self.device.index or 0
+        try:
+            # onnx models are exported in fp32, keep references until the run ends
+            inputs = {k: v.to(device=self.device, dtype=torch.float32).contiguous() for k, v in inputs.items()}
+            output = self.get_output_buffer(output_buffers, output_shape)
+            for name, i in inputs.items():
+                io_binding.bind_input(name, self.device.type, device_id, np.float32, tuple(i.shape), i.data_ptr())
+            io_binding.bind_output(output_name, self.device.type, device_id, np.float32, tuple(output.shape), output.data_ptr())
+            if self.device.type == 'cuda':
+                torch.cuda.current_stream().synchronize()
+            ort_session.run_with_iobinding(io_binding)
+            io_binding.clear_binding_inputs()
+            io_binding.clear_binding_outputs()
+        finally:
+            self.release_estimator(ort_session, io_binding, output_buffers)
+        return output
+
+
+class CancellationToken:
+    """Stop flag of one tts request, set by the consumer or by passing the deadline.
+
+    Decoding loops check cancelled() on every step, deadline is an absolute time.time() value.
+    A token with a parent is also cancelled by the parent, while cancel() never reaches the parent.
+    """
+    def __init__(self, deadline: Optional[float] = None, parent: Optional['CancellationToken'] = None):
+        self.deadline = deadline
+        self.parent = parent
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    def timeout(self) -> bool:
+        return (self.deadline is not None and time.time() > self.deadline) or (self.parent is not None and self.parent.timeout())
+
+    def cancelled(self) -> bool:
+        return self.event.is_set() or self.timeout() or (self.parent is not None and self.parent.cancelled())
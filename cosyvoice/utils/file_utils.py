@@ -69,9 +69,15 @@ def convert_onnx_to_trt(trt_model, trt_kwargs, onnx_model, fp16):
             for error in range(parser.num_errors):
                 print(parser.get_error(error))
             raise ValueError('failed to parse {}'.format(onnx_model))
-    # set input shapes
+    # set input shapes, static dims of the onnx model override the profile
+    network_shapes = {network.get_input(i).name: tuple(network.get_input(i).shape) for i in range(network.num_inputs)}
     for i in range(len(trt_kwargs['input_names'])):
-        profile.set_shape(trt_kwargs['input_names'][i], trt_kwargs['min_shape'][i], trt_kwargs['opt_shape'][i], trt_kwargs['max_shape'][i])
+        name = trt_kwargs['input_names'][i]
+        if name not in network_shapes or -1 not in network_shapes[name]:
+            continue
+        min_shape, opt_shape, max_shape = [tuple(k if k != -1 else j for j, k in zip(shape, network_shapes[name]))
+                                           for shape in [trt_kwargs['min_shape'][i], trt_kwargs['opt_shape'][i], trt_kwargs['max_shape'][i]]]
+        profile.set_shape(name, min_shape, opt_shape, max_shape)
     tensor_dtype = trt.DataType.HALF if fp16 else trt.DataType.FLOAT
     # set input and output data type
     for i in range(network.num_inputs):
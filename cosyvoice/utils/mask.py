@@ -14,7 +14,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import threading
+from collections import OrderedDict
 import torch
+from cosyvoice.utils.common import mask_to_bias
+
+# set COSYVOICE_DEBUG=1 to run sanity checks which synchronize with the device
+DEBUG = os.environ.get('COSYVOICE_DEBUG', '0') == '1'
 '''
 def subsequent_mask(
         size: int,
@@ -158,6 +165,83 @@ def subsequent_chunk_mask(
     return ret
 
 
+def subsequent_chunk_mask_with_cache(
+        offset: int,
+        size: int,
+        chunk_size: int,
+        device: torch.device = torch.device("cpu"),
+) -> torch.Tensor:
+    """Create mask (size, offset + size) for size new steps attending to offset
+       cached steps and themselves with chunk size, this is for chunk by chunk
+       streaming inference, all left chunks are visible
+
+    Args:
+        offset (int): number of cached steps
+        size (int): number of new steps
+        chunk_size (int): size of chunk
+        device (torch.device): "cpu" or "cuda" or torch.Tensor.device
+
+    Returns:
+        torch.Tensor: mask, equals to subsequent_chunk_mask(offset + size, chunk_size)[offset:]
+
+    Examples:
+        >>> subsequent_chunk_mask_with_cache(2, 2, 2)
+        [[1, 1, 1, 1],
+         [1, 1, 1, 1]]
+    """
+    pos_idx = torch.arange(offset, offset + size, device=device)
+    block_value = (torch.div(pos_idx, chunk_size, rounding_mode='trunc') + 1) * chunk_size
+    ret = torch.arange(offset + size, device=device).unsqueeze(0) < block_value.unsqueeze(1)
+    return ret
+
+
+class ChunkBiasCache:
+    """LRU of additive attention bias of subsequent_chunk_mask with all left chunks,
+    or of the boolean mask itself when dtype is torch.bool, see add_optional_chunk_mask.
+
+    One bias is kept per (chunk_size, dtype, device) and grown to the longest size seen,
+    shorter sizes are served by slicing since the chunk mask of a prefix is the prefix of
+    the chunk mask. Returned tensors are views of the cache and must not be modified in place.
+    """
+
+    def __init__(self, max_size: int = 8, size_multiple: int = 256):
+        self.max_size = max_size
+        self.size_multiple = size_multiple
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, size: int, chunk_size: int, dtype: torch.dtype, device: torch.device) -> torch.Tensor:
+        if torch.jit.is_tracing() or torch.onnx.is_in_onnx_export():
+            return self.build(size, chunk_size, dtype, device)
+        key = (chunk_size, dtype, torch.device(device))
+        with self.lock:
+            bias = self.entries.get(key)
+            if bias is None or bias.size(1) < size:
+                cache_size = (size + self.size_multiple - 1) // self.size_multiple * self.size_multiple
+                # the cache outlives the current inference_mode context
+                with torch.inference_mode(False):
+                    bias = self.build(cache_size, chunk_size, dtype, device)
+                self.entries[key] = bias
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return bias[:, :size, :size]
+
+    @staticmethod
+    def build(size: int, chunk_size: int, dtype: torch.dtype, device: torch.device) -> torch.Tensor:
+        mask = subsequent_chunk_mask(size, chunk_size, device=device).unsqueeze(0)
+        return mask if dtype == torch.bool else mask_to_bias(mask, dtype)
+
+
+chunk_bias_cache = ChunkBiasCache()
+
+
+@torch.jit.unused
+def get_chunk_mask(size: int, chunk_size: int, device: torch.device) -> torch.Tensor:
+    """Boolean subsequent_chunk_mask (1, size, size) from chunk_bias_cache, scripted encoders build it instead."""
+    return chunk_bias_cache.get(size, chunk_size, torch.bool, device)
+
+
 def add_optional_chunk_mask(xs: torch.Tensor,
                             masks: torch.Tensor,
                             use_dynamic_chunk: bool,
@@ -222,17 +306,23 @@ def add_optional_chunk_mask(xs: torch.Tensor,
         chunk_masks = masks & chunk_masks  # (B, L, L)
     elif static_chunk_size > 0:
         num_left_chunks = num_decoding_left_chunks
-        chunk_masks = subsequent_chunk_mask(xs.size(1), static_chunk_size,
-                                            num_left_chunks,
-                                            xs.device)  # (L, L)
-        chunk_masks = chunk_masks.unsqueeze(0)  # (1, L, L)
+        if torch.jit.is_scripting():
+            chunk_masks = subsequent_chunk_mask(xs.size(1), static_chunk_size,
+                                                num_left_chunks,
+                                                xs.device)  # (L, L)
+            chunk_masks = chunk_masks.unsqueeze(0)  # (1, L, L)
+        else:
+            # subsequent_chunk_mask ignores num_left_chunks, so the mask only depends on the length
+            # and is shared by every layer and request, e.g. streaming UpsampleConformerEncoder
+            chunk_masks = get_chunk_mask(xs.size(1), static_chunk_size, xs.device)  # (1, L, L)
         chunk_masks = masks & chunk_masks  # (B, L, L)
     else:
         chunk_masks = masks
     assert chunk_masks.dtype == torch.bool
-    if (chunk_masks.sum(dim=-1) == 0).sum().item() != 0:
+    if DEBUG and (chunk_masks.sum(dim=-1) == 0).sum().item() != 0:
         print('get chunk_masks all false at some timestep, force set to true, make sure they are masked in futuer computation!')
-        chunk_masks[chunk_masks.sum(dim=-1) == 0] = True
+    # force all false rows to true without host sync
+    chunk_masks = chunk_masks | (chunk_masks.sum(dim=-1, keepdim=True) == 0)
     return chunk_masks
 
 